@@ -1,4 +1,4 @@
-import binascii, utils, re, sys
+import binascii, utils, re, sys, bisect, os, marshal, collections, threading
 
 class identifier:
     """An identifier, because I'm too lazy to use quotes all over the place.
@@ -25,7 +25,7 @@ identifier("number")
 identifier("ascii")
 identifier("utf8")
 
-file_descriptor_byte_descriptions = [
+file_descriptor_byte_descriptions = utils.compile_bytemasks([
     #mask  byte  no match match
     (0x80, 0x80, None,    "RFU"),
     (0xC0, 0x40, "non shareable", "shareable"),
@@ -47,16 +47,16 @@ file_descriptor_byte_descriptions = [
     (0x87, 0x05, None,    "Linear variable, SIMPLE-TLV"),
     (0x87, 0x06, None,    "Cyclic, no further info"),
     (0x87, 0x07, None,    "Cyclic, SIMPLE-TLV"),
-]
+])
 
-data_coding_byte_descriptions = [
+data_coding_byte_descriptions = utils.compile_bytemasks([
     (0x60, 0x00, None,    "one-time write"),
     (0x60, 0x20, None,    "proprietary"),
     (0x60, 0x40, None,    "write OR"),
     (0x60, 0x60, None,    "write AND"),
-]
+])
 
-life_cycle_status_byte_descriptions = [
+life_cycle_status_byte_descriptions = utils.compile_bytemasks([
     (0xF0, 0x00, "Proprietary", None),
     (0xFF, 0x00, None,    "No information given"),
     (0xFF, 0x01, None,    "Creation state"),
@@ -64,13 +64,13 @@ life_cycle_status_byte_descriptions = [
     (0xFD, 0x05, None,    "Operational state (activated)"),
     (0xFD, 0x04, None,    "Operational state (deactivated)"),
     (0xFC, 0x0C, None,    "Termination state"),
-]
+])
 
 def decode_file_descriptor_byte(value, verbose = True):
     result = " %s" % utils.hexdump(value, short=True)
     
     if not verbose:
-        attributes = utils.parse_binary(ord(value[0]), file_descriptor_byte_descriptions, False)
+        attributes = list(utils.parse_binary(ord(value[0]), file_descriptor_byte_descriptions, False))
         if len(value) > 1:
             attributes.append(
                 "data coding byte, behavior of write functions: %s, data unit size in in nibbles: %i" % (
@@ -145,15 +145,60 @@ def parse_oid(value):
     
     return tuple(result)
     
-oidCache = {}
-def loadOids(filename="oids.txt"):
-    try:
+class oid_registry(object):
+    """Registry of OID descriptions, stored as a trie that is keyed by the integer arcs.
+    Each trie node is a list [entry, children] where entry is None or a (name, description)
+    tuple and children maps arcs to nodes. This format can be stored with marshal."""
+    CACHE_VERSION = 1
+    
+    def __init__(self):
+        self.root = [None, {}]
+        self.count = 0
+    
+    def __len__(self):
+        return self.count
+    
+    def add(self, oid, name, description):
+        node = self.root
+        for arc in oid:
+            child = node[1].get(arc, None)
+            if child is None:
+                child = [None, {}]
+                node[1][arc] = child
+            node = child
+        if node[0] is None:
+            self.count = self.count + 1
+        node[0] = (name, description)
+    
+    def lookup(self, oid):
+        """Find the longest registered prefix of oid. Returns (prefix length, (name, description)),
+        or (0, None) if not even the first arc is known."""
+        result = (0, None)
+        node = self.root
+        depth = 0
+        for arc in oid:
+            node = node[1].get(arc, None)
+            if node is None:
+                break
+            depth = depth + 1
+            if node[0] is not None:
+                result = (depth, node[0])
+        return result
+    
+    def items(self):
+        "Return a list of (dotted OID string, (name, description)) for all entries."
+        result = []
+        stack = [ ((), self.root) ]
+        while len(stack) > 0:
+            oid, node = stack.pop()
+            if node[0] is not None:
+                result.append( (".".join([str(a) for a in oid]), node[0]) )
+            for arc, child in node[1].items():
+                stack.append( (oid + (arc,), child) )
+        return result
+    
+    def load_text(self, filename):
         fp = file(filename, "r")
-    except (SystemExit,KeyboardInterrupt):
-        raise
-    except:
-        pass
-    else:
         try:
             lines = fp.readlines()
         finally:
@@ -164,24 +209,68 @@ def loadOids(filename="oids.txt"):
             parts = line.strip().split(None,2)
             if len(parts) < 3:
                 parts.append(parts[1])
-            oidCache[parts[0]] = tuple(parts[1:])
+            try:
+                oid = tuple([int(a) for a in parts[0].split(".")])
+            except ValueError:
+                continue
+            self.add(oid, parts[1], parts[2])
+    
+    def load(self, filename):
+        """Load the OIDs from the text file filename. A compiled version is kept in a cache file
+        next to it (if that location is writable) and is used as long as the text file does not change."""
+        st = os.stat(filename)
+        key = (self.CACHE_VERSION, st.st_mtime, st.st_size)
+        cachename = os.path.splitext(filename)[0] + ".cache"
+        
+        try:
+            fp = file(cachename, "rb")
+            try:
+                cached_key, count, root = marshal.load(fp)
+            finally:
+                fp.close()
+            if cached_key == key:
+                self.root, self.count = root, count
+                return
+        except (SystemExit,KeyboardInterrupt):
+            raise
+        except:
+            pass
+        
+        self.load_text(filename)
+        try:
+            fp = file(cachename, "wb")
+            try:
+                marshal.dump( (key, self.count, self.root), fp)
+            finally:
+                fp.close()
+        except (IOError, OSError):
+            pass
+
+oidRegistry = oid_registry()
+oidCache = {}
+def loadOids(filename="oids.txt"):
+    if not os.path.exists(filename) and not os.path.isabs(filename):
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    try:
+        oidRegistry.load(filename)
+    except (SystemExit,KeyboardInterrupt):
+        raise
+    except:
+        pass
+    else:
+        oidCache.update( oidRegistry.items() )
     
 def decode_oid(value):
     oid = parse_oid(value)
     str_rep = ".".join([str(a) for a in oid])
     
-    if len(oidCache) == 0:
+    if len(oidRegistry) == 0:
         loadOids()
-    description = oidCache.get(str_rep, None)
+    depth, description = oidRegistry.lookup(oid)
     if description is None:
-        steps = [oid[:e] for e in range(len(oid)-1, 0, -1)]
-        for step in steps:
-            new_str_rep = ".".join([str(a) for a in step])
-            if oidCache.has_key(new_str_rep):
-                description = ("%s %s" % (oidCache[new_str_rep][0], ".".join([str(a) for a in oid[len(step):]])),)
-                break
-        if description is None:
-            description = ("No description available",)
+        description = ("No description available",)
+    elif depth < len(oid):
+        description = ("%s %s" % (description[0], ".".join([str(a) for a in oid[depth:]])),)
 
     return " %s (%s)" % (str_rep, description[0])
 
@@ -337,82 +426,237 @@ BER_CLASSES = {
     0x3: "private",
 }
 
-def tlv_unpack(data):
-    ber_class = (ord(data[0]) & 0xC0) >> 6
-    constructed = (ord(data[0]) & 0x20) != 0 ## 0 = primitive, 0x20 = constructed
-    tag = ord(data[0]) 
-    data = data[1:]
-    if (tag & 0x1F) == 0x1F:
-        tag = (tag << 8) | ord(data[0])
-        while ord(data[0]) & 0x80 == 0x80:
-            data = data[1:]
-            tag = (tag << 8) | ord(data[0])
-        data = data[1:]
+def _tag_ber_class(tag):
+    "Return the BER class of a (possibly multi-byte) tag value"
+    while tag > 0xff:
+        tag = tag >> 8
+    return (tag & 0xC0) >> 6
+
+def tlv_header(data, pos = 0, end = None):
+    """Parse the tag and length of the TLV object starting at data[pos] without copying anything.
+    Returns (tag, constructed, value_start, value_end). Note that value_end is the end of the value
+    according to the length field and may lie beyond end if the data is truncated.
+    Raises IndexError if the header itself is not completely contained in data[pos:end]."""
+    if end is None:
+        end = len(data)
+    if pos >= end:
+        raise IndexError, "TLV header truncated"
     
-    length = ord(data[0])
-    if length < 0x80:
-        data = data[1:]
-    elif length & 0x80 == 0x80:
-        length_ = 0
-        data = data[1:]
-        for i in range(0,length & 0x7F):
-            length_ = length_ * 256 + ord(data[0])
-            data = data[1:]
-        length = length_
+    first = ord(data[pos])
+    constructed = (first & 0x20) != 0 ## 0 = primitive, 0x20 = constructed
+    tag = first
+    pos = pos + 1
+    if (first & 0x1F) == 0x1F:
+        while True:
+            if pos >= end:
+                raise IndexError, "TLV header truncated"
+            b = ord(data[pos])
+            tag = (tag << 8) | b
+            pos = pos + 1
+            if b & 0x80 != 0x80:
+                break
+    
+    if pos >= end:
+        raise IndexError, "TLV header truncated"
+    length = ord(data[pos])
+    pos = pos + 1
+    if length & 0x80 == 0x80:
+        count = length & 0x7F
+        if pos + count > end:
+            raise IndexError, "TLV header truncated"
+        length = 0
+        for i in range(pos, pos + count):
+            length = length * 256 + ord(data[i])
+        pos = pos + count
     
-    value = data[:length]
-    rest = data[length:]
+    return tag, constructed, pos, pos + length
+
+def tlv_records(data, start = 0, end = None, include_filler = False):
+    """Walk over the TLV objects in data[start:end] (not descending into constructed objects) and
+    yield a (tag, constructed, value_start, value_end) record for each of them. All offsets are
+    relative to data, nothing is copied. To get at the children of a constructed object call
+    tlv_records(data, value_start, min(value_end, end)).
+    Filler bytes (0x00 and 0xFF) are skipped, unless include_filler is true in which case they
+    are yielded as (byte, None, position, position+1)."""
+    if end is None:
+        end = len(data)
+    
+    pos = start
+    while pos < end:
+        c = data[pos]
+        if c == "\x00" or c == "\xff":
+            if include_filler:
+                yield (ord(c), None, pos, pos+1)
+            pos = pos + 1
+            continue
+        
+        record = tlv_header(data, pos, end)
+        yield record
+        pos = record[3]
+
+def tlv_unpack(data):
+    tag, constructed, value_start, value_end = tlv_header(data)
+    ber_class = _tag_ber_class(tag)
+    length = value_end - value_start
+    
+    value = data[value_start:value_end]
+    rest = data[value_end:]
     
     return ber_class, constructed, tag, length, value, rest
 
+## Interpretations of unknown primitive tags and descriptions of unknown constructed tags, by BER class
+_unknown_fields = dict([(ber_class, (binary, "Unknown field (%s class)" % name)) for ber_class, name in BER_CLASSES.items()])
+_unknown_structures = dict([(ber_class, "Unknown structure (%s class)" % name) for ber_class, name in BER_CLASSES.items()])
+
+class tlv_tag_table(dict):
+    """A dictionary of interpretations (context -> {tag: interpretation}) as accepted by decode.
+    When it is created, and again whenever a context is added, replaced or removed, it resolves
+    the table of interpretations and those of unknown tags for every context that it refers to."""
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._compile()
+    
+    def _compile(self):
+        self._default = dict.get(self, None, {})
+        contexts = dict.fromkeys(self.keys() + [None])
+        for entries in self.values():
+            for interpretation in entries.values():
+                if interpretation[0] is recurse:
+                    contexts[interpretation[2]] = None
+        self._resolved = dict([(context, self._resolve(context)) for context in contexts])
+    
+    def _resolve(self, context):
+        unknown = {}
+        for ber_class in BER_CLASSES.keys():
+            unknown[ber_class, False] = _unknown_fields[ber_class]
+            unknown[ber_class, True] = (recurse, _unknown_structures[ber_class], ber_class in (0, 1) and context or None)
+        return dict.get(self, context, self._default), unknown
+    
+    def resolve(self, context):
+        """Return (entries, unknown) for context: the dictionary of interpretations that applies
+        to it and the interpretations of tags without one, by (BER class, constructed)."""
+        resolved = self._resolved.get(context, None)
+        if resolved is None:
+            ## A context that no interpretation refers to, not worth keeping
+            resolved = self._resolve(context)
+        return resolved
+    
+    def unknown(self, context, tag, constructed):
+        "Return the interpretation of a tag that has none in context."
+        return self.resolve(context)[1][_tag_ber_class(tag), bool(constructed)]
+
+def _make_resetting(name):
+    method = getattr(dict, name)
+    def resetting(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._compile()
+    resetting.__name__ = name
+    return resetting
+
+for _name in ("__setitem__", "__delitem__", "clear", "pop", "popitem", "setdefault", "update"):
+    setattr(tlv_tag_table, _name, _make_resetting(_name))
+del _name
+
+TAG_TABLE_CACHE_SIZE = 16
+## id(tags) -> (tags, table) for plain dictionaries, the most recently used last
+_tag_tables = collections.OrderedDict()
+_tag_tables_lock = threading.Lock()
+def compile_tags(tags):
+    """Return tags as a tlv_tag_table (tags itself if it already is one). The tables for the
+    most recently used plain dictionaries (e.g. TLV_OBJECTS class constants) are cached, and
+    compiled again when a context of the dictionary has been added, replaced or removed."""
+    if isinstance(tags, tlv_tag_table):
+        return tags
+    
+    _tag_tables_lock.acquire()
+    try:
+        entry = _tag_tables.pop(id(tags), None)
+        if entry is None or entry[0] is not tags or entry[1] != tags:
+            entry = (tags, tlv_tag_table(tags))
+            if len(_tag_tables) >= TAG_TABLE_CACHE_SIZE:
+                _tag_tables.popitem(last=False)
+        _tag_tables[id(tags)] = entry
+    finally:
+        _tag_tables_lock.release()
+    return entry[1]
+
+tags = tlv_tag_table(tags)
+
 def decode(data, context = None, level = 0, tags=tags):
     result = []
-    while len(data) > 0:
-        if ord(data[0]) in (0x00, 0xFF):
-            data = data[1:]
-            continue
-        
-        ber_class, constructed, tag, length, value, data = tlv_unpack(data)
+    _decode(data, 0, len(data), context, level, compile_tags(tags), result.append, None, None)
+    return "".join(result)
+
+def decode_to_stream(data, stream, context = None, level = 0, tags=tags, max_depth = None, max_bytes = None):
+    """Like decode, but write the output piece by piece to stream (anything with a write method)
+    instead of returning it. Like with decode there is no newline after the last line.
+    If max_depth is given then constructed objects that are more than max_depth levels deep are
+    not decoded, if max_bytes is given then binary values are only dumped up to that many bytes."""
+    if max_depth is not None:
+        max_depth = level + max_depth
+    _decode(data, 0, len(data), context, level, compile_tags(tags), stream.write, max_depth, max_bytes)
+
+def _decode(data, start, end, context, level, tags, write, max_level, max_bytes):
+    indent = "\t"*level
+    subindent = "\n" + "\t"*(level+1)
+    entries, unknown = tags.resolve(context)
+    first = True
+    for tag, constructed, value_start, value_end in tlv_records(data, start, end):
+        length = value_end - value_start
+        value_end = min(value_end, end)
         
-        interpretation = tags.get(context, tags.get(None, {})).get(tag, None)
+        interpretation = entries.get(tag, None)
         if interpretation is None:
-            if not constructed: interpretation = [binary, "Unknown field"]
-            else: interpretation = [recurse, "Unknown structure", ber_class in (0, 1) and context or None]
-            
-            interpretation[1] = "%s (%s class)" % (interpretation[1], BER_CLASSES[ber_class])
-            interpretation = tuple(interpretation)
+            interpretation = unknown[_tag_ber_class(tag), constructed]
         
-        current = ["\t"*level]
-        current.append("Tag 0x%02X, Len 0x%02X, '%s':" % (tag, length, interpretation[1]))
+        if not first:
+            write("\n")
+        first = False
+        write("%sTag 0x%02X, Len 0x%02X, '%s':" % (indent, tag, length, interpretation[1]))
         
         if interpretation[0] is recurse:
-            current.append("\n")
-            current.append( decode(value, interpretation[2], level+1, tags=tags) )
-        elif interpretation[0] is number:
-            num = 0
-            for i in value:
-                num = num * 256
-                num = num + ord(i)
-            current.append( " 0x%02x (%i)" % (num, num))
-        elif interpretation[0] is ascii:
-            current.append( " %s" % value)
-        elif interpretation[0] is utf8:
-            current.append( " %s" % unicode(value, "utf-8"))
+            write("\n")
+            if max_level is not None and level >= max_level:
+                write("%s[%i bytes not decoded]" % (subindent[1:], value_end - value_start))
+            else:
+                _decode(data, value_start, value_end, interpretation[2], level+1, tags, write, max_level, max_bytes)
         elif interpretation[0] is binary:
+            truncated = 0
+            if max_bytes is not None and value_end - value_start > max_bytes:
+                truncated = value_end - value_start - max_bytes
+                value_end = value_start + max_bytes
+            value = data[value_start:value_end]
+            
             if len(value) < 0x10:
-                current.append( " %s" % utils.hexdump(value, short=True))
+                write( " %s" % utils.hexdump(value, short=True))
             else:
-                current.append( "\n" + "\t"*(level+1) )
-                current.append( ("\n" + "\t"*(level+1)).join( utils.hexdump(value).splitlines() ) )
-        elif callable(interpretation[0]):
-            current.append( ("\n"+"\t"*(level+1)).join(interpretation[0](value).splitlines()) )
-        
-        result.append( "".join(current) )
-    
-    return "\n".join(result)
+                for line in utils.hexdump_lines(value):
+                    write( subindent )
+                    write( line )
+            if truncated:
+                write( "%s[%i more bytes not shown]" % (subindent, truncated) )
+        else:
+            value = data[value_start:value_end]
+            if interpretation[0] is number:
+                num = 0
+                for i in value:
+                    num = num * 256
+                    num = num + ord(i)
+                write( " 0x%02x (%i)" % (num, num))
+            elif interpretation[0] is ascii:
+                write( " %s" % value)
+            elif interpretation[0] is utf8:
+                write( " %s" % unicode(value, "utf-8"))
+            elif callable(interpretation[0]):
+                write( subindent.join(interpretation[0](value).splitlines()) )
 
 def tlv_find_tag(tlv_data, tag, num_results = None):
     """Find (and return) all instances of tag in the given tlv structure (as returned by unpack).
+    tlv_data may also be the binary string itself, which is then searched without unpacking
+    the parts that don't match.
     If num_results is specified then at most that many results will be returned."""
     
     results = []
@@ -422,87 +666,483 @@ def tlv_find_tag(tlv_data, tag, num_results = None):
             if t == tag:
                 results.append(d)
             else:
-                if isinstance(v, list): # FIXME Refactor the whole TLV code into a class
+                if isinstance(v, (list, tlv_list)): # FIXME Refactor the whole TLV code into a class
                     find_recursive(v)
             
             if num_results is not None and len(results) >= num_results:
                 return
     
-    find_recursive(tlv_data)
+    def find_binary(start, end):
+        for t, constructed, value_start, value_end in tlv_records(tlv_data, start, end):
+            stop = min(value_end, end)
+            if t == tag:
+                if constructed:
+                    results.append( (t, value_end - value_start, _unpack(tlv_data, value_start, stop, None, 0, False)) )
+                else:
+                    results.append( (t, value_end - value_start, tlv_data[value_start:stop]) )
+            elif constructed:
+                find_binary(value_start, stop)
+            
+            if num_results is not None and len(results) >= num_results:
+                return
+    
+    if isinstance(tlv_data, str):
+        find_binary(0, len(tlv_data))
+    else:
+        find_recursive(tlv_data)
     
     return results
 
 def unpack(data, with_marks = None, offset = 0, include_filler=False):
+    return _unpack(data, 0, len(data), with_marks, offset, include_filler)
+
+def _unpack(data, start, end, with_marks, offset, include_filler):
+    ## offset is the position that data[0] has with respect to the marks
     result = []
-    while len(data) > 0:
-        if ord(data[0]) in (0x00, 0xFF):
-            if include_filler:
-                if with_marks is None:
-                    result.append( (ord(data[0]), None, None) )
-                else:
-                    result.append( (ord(data[0]), None, None, () ) )
-            data = data[1:]
-            offset = offset + 1
+    for tag, constructed, value_start, value_end in tlv_records(data, start, end, include_filler):
+        if constructed is None:
+            if with_marks is None:
+                result.append( (tag, None, None) )
+            else:
+                result.append( (tag, None, None, () ) )
             continue
         
-        l = len(data)
-        ber_class, constructed, tag, length, value, data = tlv_unpack(data)
-        stop = offset + (l - len(data))
-        start = stop - length
+        stop = min(value_end, end)
         
         if with_marks is not None:
             marks = []
             for type, mark_start, mark_stop in with_marks:
-                if (mark_start, mark_stop) == (start, stop):
+                if (mark_start, mark_stop) == (offset + value_start, offset + value_end):
                     marks.append(type)
             marks = (marks, )
         else:
             marks = ()
         
         if not constructed:
-            result.append( (tag, length, value) + marks )
+            result.append( (tag, value_end - value_start, data[value_start:stop]) + marks )
+        else:
+            result.append( (tag, value_end - value_start, _unpack(data, value_start, stop, with_marks, offset, False)) + marks )
+    
+    return result
+
+class tlv_node(object):
+    """A single TLV object that only records its position in the underlying buffer. It behaves
+    like the (tag, length, value) tuples returned by unpack, but the value is only sliced (for
+    primitive objects) or parsed (for constructed objects, see tlv_list) on first access."""
+    __slots__ = ("tag", "length", "constructed", "_data", "_value_start", "_value_end", "_value")
+    
+    def __init__(self, data, tag, constructed, value_start, value_end, end):
+        self.tag = tag
+        self.length = value_end - value_start
+        self.constructed = constructed
+        self._data = data
+        self._value_start = value_start
+        self._value_end = min(value_end, end)
+        self._value = None
+    
+    def value(self):
+        if self._value is None:
+            if self.constructed:
+                self._value = tlv_list(self._data, self._value_start, self._value_end)
+            else:
+                self._value = self._data[self._value_start:self._value_end]
+        return self._value
+    value = property(value)
+    
+    def _as_tuple(self):
+        return (self.tag, self.length, self.value)
+    
+    def __len__(self):
+        return 3
+    
+    def __iter__(self):
+        return iter(self._as_tuple())
+    
+    def __getitem__(self, index):
+        return self._as_tuple()[index]
+    
+    def __getslice__(self, i, j):
+        return self._as_tuple()[i:j]
+    
+    def __eq__(self, other):
+        if isinstance(other, (tuple, tlv_node)):
+            return self._as_tuple() == tuple(other)
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    __hash__ = None
+    
+    def __reduce__(self):
+        return (tlv_node, (self._data, self.tag, self.constructed, self._value_start,
+            self._value_start + self.length, self._value_end))
+    
+    def __repr__(self):
+        return repr(self._as_tuple())
+
+class tlv_list(collections.Sequence):
+    """A read-only sequence of tlv_node objects that is only parsed from the underlying buffer
+    when it is first accessed. It compares equal to the list returned by unpack for the same
+    data; slicing and concatenation return plain lists."""
+    __slots__ = ("_source", "_nodes")
+    
+    def __init__(self, data, start = 0, end = None):
+        if end is None:
+            end = len(data)
+        self._source = (data, start, end)
+        self._nodes = None
+    
+    def _expand(self):
+        if self._nodes is None:
+            data, start, end = self._source
+            self._nodes = [tlv_node(data, tag, constructed, value_start, value_end, end)
+                for tag, constructed, value_start, value_end in tlv_records(data, start, end)]
+        return self._nodes
+    
+    def is_expanded(self):
+        return self._nodes is not None
+    
+    def __len__(self):
+        return len(self._expand())
+    
+    def __getitem__(self, index):
+        return self._expand()[index]
+    
+    def __getslice__(self, i, j):
+        return self._expand()[i:j]
+    
+    def __iter__(self):
+        return iter(self._expand())
+    
+    def __contains__(self, item):
+        return item in self._expand()
+    
+    def __eq__(self, other):
+        if isinstance(other, tlv_list):
+            other = other._expand()
+        if isinstance(other, list):
+            return self._expand() == other
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    __hash__ = None
+    
+    def __add__(self, other):
+        return self._expand() + list(other)
+    
+    def __radd__(self, other):
+        return list(other) + self._expand()
+    
+    def __copy__(self):
+        return tlv_list(*self._source)
+    
+    def __deepcopy__(self, memo):
+        return tlv_list(*self._source)
+    
+    def __reduce__(self):
+        return (tlv_list, self._source)
+    
+    def __repr__(self):
+        return repr(self._expand())
+
+def unpack_lazy(data, start = 0, end = None):
+    """Like unpack, but return a tlv_list which parses the structure on demand. Use this for
+    big structures of which only a few parts are going to be looked at."""
+    return tlv_list(data, start, end)
+
+class tlv_stream_decoder(object):
+    """Push style decoder for a single (outer) TLV object that arrives in chunks, e.g. from
+    consecutive READ BINARY commands. Call feed() with each chunk, it returns the list of events
+    that became complete with this chunk:
+     ("start", tag, constructed, length) when the header of an object has been read,
+     ("value", tag, value) when the value of a primitive object has been read completely,
+     ("end", tag) when a constructed object has been read completely.
+    If callback is given it is additionally called with each event.
+    total_length is available as soon as the outer header is complete, remaining is the number
+    of bytes that are still missing and finished is set after the outer object is complete.
+    data is everything that has been fed so far."""
+    
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.total_length = None
+        self.finished = False
+        self._chunks = []     ## All chunks so far, joined on demand by data
+        self._length = 0
+        self._tail = []       ## The chunks that have not been parsed completely
+        self._tail_start = 0  ## Position of the first byte of _tail
+        self._need = 0        ## Parsing can't continue before _length reaches this
+        self._pos = 0
+        self._outer_start = None
+        self._outer_end = None
+        self._stack = []
+    
+    def data(self):
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        if len(self._chunks) == 0:
+            return ""
+        return self._chunks[0]
+    data = property(data)
+    
+    def remaining(self):
+        if self._outer_end is None:
+            return None
+        return max(self._outer_end - self._length, 0)
+    remaining = property(remaining)
+    
+    def _emit(self, events, event):
+        events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+    
+    def feed(self, chunk):
+        events = []
+        if self.finished or len(chunk) == 0:
+            return events
+        
+        self._chunks.append(chunk)
+        self._tail.append(chunk)
+        self._length = self._length + len(chunk)
+        if self._length < self._need:
+            return events ## Still waiting for the rest of a primitive value
+        self._need = 0
+        
+        ## Positions are absolute, data only holds the bytes from base on
+        base = self._tail_start
+        data = "".join(self._tail)
+        end = self._length
+        pos = self._pos
+        stack = self._stack
+        
+        while True:
+            while len(stack) > 0 and pos >= stack[-1][1]:
+                tag, value_end = stack.pop()
+                self._emit(events, ("end", tag))
+            
+            if self._outer_end is not None and len(stack) == 0 and pos >= self._outer_end:
+                self.finished = True
+                break
+            
+            if pos >= end:
+                break
+            
+            if data[pos - base] in ("\x00", "\xff"):
+                pos = pos + 1
+                continue
+            
+            try:
+                tag, constructed, value_start, value_end = tlv_header(data, pos - base, end - base)
+            except IndexError:
+                break ## Need more data
+            value_start, value_end = value_start + base, value_end + base
+            
+            if self._outer_end is None:
+                self._outer_start = pos
+                self._outer_end = value_end
+                self.total_length = value_end - pos
+            
+            if constructed:
+                self._emit(events, ("start", tag, constructed, value_end - value_start))
+                stack.append( (tag, value_end) )
+                pos = value_start
+            else:
+                if value_end > end:
+                    self._need = value_end
+                    break ## Need more data, the start event is sent together with the value
+                self._emit(events, ("start", tag, constructed, value_end - value_start))
+                self._emit(events, ("value", tag, data[value_start - base:value_end - base]))
+                pos = value_end
+        
+        self._pos = pos
+        self._tail = [data[pos - base:]]
+        self._tail_start = pos
+        return events
+    
+    def value(self):
+        "Return the data of the outer object (without any leading filler or trailing bytes)."
+        if self._outer_end is None:
+            return ""
+        return self.data[self._outer_start:self._outer_end]
+
+_tlv_path_step = re.compile(r"^([0-9a-fA-F]+)(?:\[(\d+)\])?$")
+_tlv_path_cache = {}
+def compile_tlv_path(path):
+    """Compile a path like "77/6F/A5/BF0C" or "30/A0/30[1]/04" into a tuple of (tag, index) steps.
+    Each step selects the children with the given (hexadecimal) tag, an optional [n] selects only
+    the n-th (counting from 0) of these children. Compiled paths are cached."""
+    steps = _tlv_path_cache.get(path, None)
+    if steps is None:
+        steps = []
+        for step in path.strip("/").split("/"):
+            match = _tlv_path_step.match(step.strip())
+            if match is None:
+                raise ValueError, "Invalid step '%s' in TLV path '%s'" % (step, path)
+            tag, index = match.groups()
+            steps.append( (int(tag, 16), index is not None and int(index) or None) )
+        steps = tuple(steps)
+        _tlv_path_cache[path] = steps
+    return steps
+
+class tlv_index(object):
+    """An index over a TLV structure (as returned by unpack or unpack_lazy, a binary string is
+    unpacked first). It is built once with a single walk over the structure, afterwards find()
+    and query() do not need to walk the structure again."""
+    
+    def __init__(self, tlv_data):
+        if isinstance(tlv_data, str):
+            tlv_data = unpack(tlv_data)
+        self.structure = tlv_data
+        
+        self._occurrences = {} ## tag -> [(preorder position, position of nearest ancestor with same tag, entry), ...]
+        self._positions = {}   ## tag -> [preorder position, ...]
+        self._ranges = {}      ## id(entry) -> (preorder position, end of subtree)
+        self._children = {}    ## id(list of entries) -> {tag: [entry, ...]}
+        self._count = 0
+        self._build(tlv_data, {})
+    
+    def _build(self, entries, open_tags):
+        children = {}
+        self._children[id(entries)] = children
+        for d in entries:
+            t, l, v = d[:3]
+            if l is None:
+                continue ## Filler
+            
+            pos = self._count
+            self._count = pos + 1
+            children.setdefault(t, []).append(d)
+            self._occurrences.setdefault(t, []).append( (pos, open_tags.get(t, -1), d) )
+            self._positions.setdefault(t, []).append(pos)
+            
+            if isinstance(v, (list, tlv_list)):
+                outer = open_tags.get(t, -1)
+                open_tags[t] = pos
+                self._build(v, open_tags)
+                open_tags[t] = outer
+            
+            self._ranges[id(d)] = (pos, self._count)
+    
+    def find(self, tag, num_results = None, within = None):
+        """Find all instances of tag, with the same semantics as tlv_find_tag. If within is given
+        then only search that entry (or list of entries, e.g. the value of a constructed entry
+        or the result of a previous find) and its descendants."""
+        occurrences = self._occurrences.get(tag, None)
+        if occurrences is None:
+            return []
+        
+        if within is None:
+            ranges = [ (0, self._count) ]
+        elif isinstance(within, (list, tlv_list)):
+            ranges = [ self._ranges[id(d)] for d in within if self._ranges.has_key(id(d)) ]
         else:
-            result.append( (tag, length, unpack(value, with_marks, offset = start)) + marks )
+            ranges = [ self._ranges[id(within)] ]
         
-        offset = stop
+        results = []
+        positions = self._positions[tag]
+        for start, stop in ranges:
+            for i in range(bisect.bisect_left(positions, start), bisect.bisect_left(positions, stop)):
+                pos, outer, d = occurrences[i]
+                if outer < start:
+                    results.append(d)
+                    if num_results is not None and len(results) >= num_results:
+                        return results
+        
+        return results
     
+    def query(self, path):
+        "Return all entries that match path (see compile_tlv_path)."
+        steps = compile_tlv_path(path)
+        current = [self.structure]
+        matches = []
+        for i in range(len(steps)):
+            tag, index = steps[i]
+            matches = []
+            for entries in current:
+                candidates = self._children.get(id(entries), {}).get(tag, [])
+                if index is not None:
+                    candidates = candidates[index:index+1]
+                matches.extend(candidates)
+            
+            current = [d[2] for d in matches if isinstance(d[2], (list, tlv_list))]
+        
+        return matches
+    
+    def get(self, path, default = None):
+        "Return the first entry that matches path, or default."
+        matches = self.query(path)
+        if len(matches) == 0:
+            return default
+        return matches[0]
+
+_tag_encoding_cache = {}
+def _encode_tag(tag):
+    result = ""
+    value = tag
+    while value > 0:
+        result = chr( value & 0xff ) + result
+        value = value >> 8
+    _tag_encoding_cache[tag] = result
     return result
 
-def pack(tlv_data, recalculate_length = False):
-    result = []
+_short_length_encodings = [chr(i) for i in range(0x7F)]
+def _encode_length(length):
+    if length < 0x7F:
+        return chr(length)
     
+    result = ""
+    while length > 0:
+        result = chr( length & 0xff ) + result
+        length = length >> 8
+    assert len(result) < 0x7f
+    return chr( 0x80 | len(result) ) + result
+
+def _pack_into(tlv_data, recalculate_length, pieces):
+    """Append the encoding of tlv_data to the flat list pieces. The header of each object is
+    only filled in after its value has been encoded, so all lengths are computed bottom-up in
+    one pass. Returns the number of bytes that were appended."""
+    size = 0
     for data in tlv_data:
         tag, length, value = data[:3]
         if tag in (0xff, 0x00):
-            result.append( chr(tag) )
+            pieces.append( chr(tag) )
+            size = size + 1
             continue
         
-        if not isinstance(value, str):
-            value = pack(value, recalculate_length)
-        
-        if recalculate_length:
-            length = len(value)
-        
-        t = ""
-        while tag > 0:
-            t = chr( tag & 0xff ) + t
-            tag = tag >> 8
+        slot = len(pieces)
+        pieces.append(None) ## Placeholder for the header
         
-        if length < 0x7F:
-            l = chr(length)
+        if isinstance(value, str):
+            pieces.append(value)
+            value_size = len(value)
         else:
-            l = ""
-            while length > 0:
-                l = chr( length & 0xff ) + l
-                length = length >> 8
-            assert len(l) < 0x7f
-            l = chr( 0x80 | len(l) ) + l
+            value_size = _pack_into(value, recalculate_length, pieces)
         
-        result.append(t)
-        result.append(l)
-        result.append(value)
+        if recalculate_length:
+            length = value_size
+        
+        header = (_tag_encoding_cache.get(tag) or _encode_tag(tag)) \
+            + (0 <= length < 0x7F and _short_length_encodings[length] or _encode_length(length))
+        pieces[slot] = header
+        size = size + len(header) + value_size
     
-    return "".join(result)
+    return size
+
+def pack(tlv_data, recalculate_length = False):
+    """Encode a TLV structure (as returned by unpack, with or without filler) into a binary string.
+    If recalculate_length is true then the length fields are computed from the values instead
+    of taking them from the structure."""
+    pieces = []
+    _pack_into(tlv_data, recalculate_length, pieces)
+    return "".join(pieces)
 
 if __name__ == "__main__":
     test = binascii.unhexlify("".join(("6f 2b 83 02 2f 00 81 02 01 00 82 03 05 41 26 85" \
@@ -0,0 +1,186 @@
+# -*- coding: iso-8859-1 -*-
+
+"""Binary traces of the communication with a card, written by
+readers.Recording_Reader and served back by readers.Replay_Reader.
+
+A trace file starts with the four bytes "CFTR", a version byte and the start
+time of the trace (big endian double, seconds since the epoch). It is
+followed by records, each with a type byte, the time relative to the start
+(big endian double), the length of the payload (big endian unsigned int) and
+the payload itself. The record types are RECORD_ATR, RECORD_COMMAND,
+RECORD_RESPONSE and RECORD_ERROR (the payload is the message of an exception
+that the reader raised instead of returning a response)."""
+
+import utils, struct, time, threading, collections
+
+MAGIC = "CFTR"
+VERSION = 1
+_FILE_HEADER = struct.Struct(">4sBd")
+_RECORD_HEADER = struct.Struct(">BdI")
+
+RECORD_ATR = 1
+RECORD_COMMAND = 2
+RECORD_RESPONSE = 3
+RECORD_ERROR = 4
+
+## Policies for matching a command against the trace
+MATCH_STRICT = "strict"     # All bytes must be equal
+MATCH_HEADER = "header"     # CLA, INS, P1 and P2 must be equal
+MATCH_INS = "ins"           # INS must be equal
+
+class ReplayError(Exception):
+    "Raised by Trace_Replayer when a command can not be found in the trace"
+    pass
+
+class Trace_Writer(object):
+    """Write a trace to a file (given by name or as a file object opened
+    for binary writing)"""
+    def __init__(self, target):
+        if isinstance(target, basestring):
+            target = open(target, "wb")
+        self.fp = target
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self.fp.write(_FILE_HEADER.pack(MAGIC, VERSION, self.start))
+
+    def write_record(self, type, payload, timestamp = None):
+        "Append one record, timestamp is a time.time() value (now if None)"
+        if timestamp is None:
+            timestamp = time.time()
+        self._lock.acquire()
+        try:
+            self.fp.write(_RECORD_HEADER.pack(type, timestamp - self.start, len(payload)) + payload)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+def read_trace(source):
+    """Read a trace from a file (given by name or as a file object opened for
+    binary reading). Returns (start, records), records is a list of
+    (type, timestamp, payload) tuples with time.time() timestamps."""
+    if isinstance(source, basestring):
+        fp = open(source, "rb")
+        try:
+            return read_trace(fp)
+        finally:
+            fp.close()
+
+    data = source.read()
+    if len(data) < _FILE_HEADER.size:
+        raise ValueError, "Not a trace file: too short"
+    magic, version, start = _FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError, "Not a trace file: wrong magic %r" % magic
+    if version != VERSION:
+        raise ValueError, "Unsupported trace file version %i" % version
+
+    records = []
+    pos = _FILE_HEADER.size
+    while pos + _RECORD_HEADER.size <= len(data):
+        type, offset, length = _RECORD_HEADER.unpack_from(data, pos)
+        pos = pos + _RECORD_HEADER.size
+        if pos + length > len(data):
+            break ## Truncated by a crash, ignore the last record
+        records.append( (type, start + offset, data[pos:pos+length]) )
+        pos = pos + length
+    return start, records
+
+class Trace(object):
+    """The contents of a trace file. atrs is the list of all ATRs, exchanges the
+    list of (command, response, command_time, response_time) tuples. response
+    is None when the reader raised an exception, errors maps the index of such
+    an exchange to the message of the exception."""
+    def __init__(self, source):
+        self.start, records = read_trace(source)
+        self.atrs = []
+        self.exchanges = []
+        self.errors = {}
+
+        command = None
+        for type, timestamp, payload in records:
+            if type == RECORD_ATR:
+                self.atrs.append(payload)
+            elif type == RECORD_COMMAND:
+                command = (payload, timestamp)
+            elif type in (RECORD_RESPONSE, RECORD_ERROR) and command is not None:
+                if type == RECORD_ERROR:
+                    self.errors[len(self.exchanges)] = payload
+                    payload = None
+                self.exchanges.append( (command[0], payload, command[1], timestamp) )
+                command = None
+
+    def get_card_time(self):
+        "Return the total time spent waiting for the card"
+        return sum([response_time - command_time for _, _, command_time, response_time in self.exchanges])
+
+    def has_extended_length(self):
+        "Return True if the trace contains extended length commands"
+        for command in [exchange[0] for exchange in self.exchanges]:
+            try:
+                if utils.C_APDU(command).extended:
+                    return True
+            except ValueError:
+                pass
+        return False
+
+def _match_key(policy, command):
+    if policy == MATCH_STRICT:
+        return command
+    elif policy == MATCH_HEADER:
+        return command[:4]
+    elif policy == MATCH_INS:
+        return command[1:2]
+    else:
+        raise ValueError, "Unknown match policy %r" % (policy,)
+
+class Trace_Replayer(object):
+    """Answer commands with the responses from a Trace.
+    Each command is matched according to the policy for its INS byte (from
+    policies, a dictionary mapping INS values to MATCH_* constants, or
+    default_policy) against the recorded commands that have not been used yet,
+    and answered with the response to the first one that matches. When the
+    commands are sent in the recorded order this is simply the next exchange
+    of the trace."""
+    def __init__(self, trace, policies = None, default_policy = MATCH_STRICT):
+        if not isinstance(trace, Trace):
+            trace = Trace(trace)
+        self.trace = trace
+        self.policies = policies or {}
+        self.default_policy = default_policy
+        self.reset()
+
+    def reset(self):
+        "Make all exchanges of the trace available again"
+        self._used = [False] * len(self.trace.exchanges)
+        self._index = {}
+
+    def _get_queue(self, policy, key):
+        if policy not in self._index:
+            index = {}
+            for i, exchange in enumerate(self.trace.exchanges):
+                if not self._used[i]:
+                    index.setdefault(_match_key(policy, exchange[0]), collections.deque()).append(i)
+            self._index[policy] = index
+        return self._index[policy].get(key, None)
+
+    def transceive(self, data):
+        "Return the recorded response for the command data"
+        policy = self.default_policy
+        if len(data) > 1:
+            policy = self.policies.get(ord(data[1]), policy)
+        queue = self._get_queue(policy, _match_key(policy, data))
+        while queue:
+            i = queue.popleft()
+            if not self._used[i]:
+                self._used[i] = True
+                response = self.trace.exchanges[i][1]
+                if response is None:
+                    raise IOError, self.trace.errors[i]
+                return response
+        raise ReplayError, "Command %s (match policy %s) not found in the trace" % (
+            utils.hexdump(data, short=True), policy)
@@ -0,0 +1,632 @@
+# -*- coding: iso-8859-1 -*-
+
+"""An in-process model of an ISO 7816-4 card, used by readers.Emulated_Reader
+to run the shell and the card drivers without a physical card.
+
+The card has a tree of DFs and EFs (transparent or record oriented) and
+understands SELECT, READ BINARY, READ RECORD, GET RESPONSE and GET CHALLENGE.
+With BAC keys it also does MUTUAL AUTHENTICATE and secure messaging as
+specified for machine readable travel documents (this needs pycrypto, see
+crypto_utils).
+
+The tree can be built in code, from an iso_node tree (e.g. the result of
+brutefid.py or a card driver's file listing) with from_iso_node(), or from a
+JSON spec with load_card()/from_spec(). A spec looks like this, all binary
+values are hex strings (spaces are ignored):
+
+{
+    "name": "Test passport",
+    "atr": "3B 85 80 01 80 73 00 00 40 B7",  (optional, see make_atr())
+    "protocol": 1,                      (0 simulates GET RESPONSE chaining)
+    "extended_length": true,
+    "latency": {"default": 0.001, "B0": 0.01},   (seconds, or one number)
+    "status_words": {"file_not_found": "6A82"},  (see STATUS_WORDS)
+    "responses": [ ["0084*", "6985"] ],  (fixed responses by command pattern)
+    "bac": {"mrz2": "L898902C<3UTO6908061F9406236ZE184226B<<<<<14"},
+    "mf": {"children": [
+        {"type": "df", "name": "A0000002471001", "children": [
+            {"type": "ef", "fid": "011E", "sfi": 30, "data": "60 05 ...", "protected": true}
+        ]},
+        {"type": "record", "fid": "2F00", "records": ["61 05 ...", "61 07 ..."]}
+    ]}
+}
+"""
+
+import utils, TLV_utils, binascii, fnmatch, os, struct, time
+from hashlib import sha1
+
+FID_MF = "\x3f\x00"
+
+def _from_hex(value):
+    return binascii.a2b_hex("".join(value.split()))
+
+class Emulated_File(object):
+    "Base class for all files on an Emulated_Card"
+    def __init__(self, fid = None, sfi = None, fcp = None, protected = False):
+        self.fid = fid
+        self.sfi = sfi
+        self.fcp = fcp
+        self.protected = protected
+        self.parent = None
+
+    def _fcp_contents(self):
+        contents = []
+        if self.fid is not None:
+            contents.append( (0x83, 2, self.fid) )
+        if self.sfi is not None:
+            contents.append( (0x88, 1, chr(self.sfi << 3)) )
+        return contents
+
+    def get_management_information(self, tag = 0x62):
+        "Return the FCP (tag 0x62), FCI (0x6F) or FMD (0x64) template of this file"
+        if self.fcp is not None:
+            return chr(tag) + self.fcp[1:]
+        return TLV_utils.pack( [ (tag, 0, self._fcp_contents()) ], recalculate_length = True)
+
+class Emulated_DF(Emulated_File):
+    def __init__(self, fid = None, name = None, children = (), **kwargs):
+        super(Emulated_DF, self).__init__(fid, **kwargs)
+        self.name = name
+        self.children = []
+        for child in children:
+            self.add_child(child)
+
+    def add_child(self, child):
+        child.parent = self
+        self.children.append(child)
+        return child
+
+    def find_child(self, fid, cls = Emulated_File):
+        for child in self.children:
+            if child.fid == fid and isinstance(child, cls):
+                return child
+        return None
+
+    def find_sfi(self, sfi):
+        for child in self.children:
+            if child.sfi == sfi and not isinstance(child, Emulated_DF):
+                return child
+        return None
+
+    def find_name(self, name):
+        "Find a DF by (a prefix of) its name in this DF and all DFs below it"
+        if self.name is not None and self.name.startswith(name):
+            return self
+        for child in self.children:
+            if isinstance(child, Emulated_DF):
+                result = child.find_name(name)
+                if result is not None:
+                    return result
+        return None
+
+    def _fcp_contents(self):
+        contents = [ (0x82, 1, "\x38") ] + super(Emulated_DF, self)._fcp_contents()
+        if self.name is not None:
+            contents.append( (0x84, len(self.name), self.name) )
+        return contents
+
+class Emulated_EF(Emulated_File):
+    "A transparent EF"
+    def __init__(self, fid = None, data = "", **kwargs):
+        super(Emulated_EF, self).__init__(fid, **kwargs)
+        self.data = data
+
+    def _fcp_contents(self):
+        return [ (0x80, 2, struct.pack(">H", len(self.data))), (0x82, 1, "\x01") ] \
+            + super(Emulated_EF, self)._fcp_contents()
+
+class Emulated_Record_EF(Emulated_File):
+    "A linear EF with records numbered from 1"
+    def __init__(self, fid = None, records = (), **kwargs):
+        super(Emulated_Record_EF, self).__init__(fid, **kwargs)
+        self.records = list(records)
+
+    def _fcp_contents(self):
+        return [ (0x82, 1, "\x02") ] + super(Emulated_Record_EF, self)._fcp_contents()
+
+class _Status(Exception):
+    "Raised by the command handlers to end a command with the status word for condition"
+    def __init__(self, condition):
+        Exception.__init__(self, condition)
+        self.condition = condition
+
+def make_atr(extended_length = False):
+    """Make an ATR for T=1 whose historical bytes announce the extended length
+    capability (see utils.atr_card_capabilities)"""
+    historical = "\x80\x73\x00\x00" + chr(extended_length and 0x40 or 0x00)
+    atr = chr(0x80 | len(historical)) + "\x80\x01" + historical
+    tck = 0
+    for c in atr:
+        tck = tck ^ ord(c)
+    return "\x3b" + atr + chr(tck)
+
+def derive_bac_keys(mrz2):
+    """Derive (Kenc, Kmac) from the second line of the MRZ, like
+    Passport_Application.cmd_perform_bac() does"""
+    mrz2 = mrz2.upper()
+    Kseed = sha1(mrz2[0:10] + mrz2[13:20] + mrz2[21:28]).digest()[:16]
+    return _derive_key(Kseed, 1), _derive_key(Kseed, 2)
+
+def _derive_key(Kseed, c):
+    return sha1(Kseed + struct.pack(">i", c)).digest()[:16]
+
+def _pad(data):
+    return data + "\x80" + "\x00" * (7 - len(data) % 8)
+
+def _unpad(data):
+    data = data.rstrip("\x00")
+    if not data.endswith("\x80"):
+        raise _Status("sm_objects_incorrect")
+    return data[:-1]
+
+def _mac(key, data):
+    "ISO 9797-1 MAC algorithm 3 with padding method 2"
+    import crypto_utils
+    a = crypto_utils.cipher(True, "des-cbc", key[:8], _pad(data))
+    b = crypto_utils.cipher(False, "des-ecb", key[8:16], a[-8:])
+    return crypto_utils.cipher(True, "des-ecb", key[:8], b)
+
+def _des3(do_encrypt, key, data):
+    import crypto_utils
+    return crypto_utils.cipher(do_encrypt, "des3-cbc", key, data)
+
+class _SM_Session(object):
+    def __init__(self, KSenc, KSmac, ssc):
+        self.KSenc = KSenc
+        self.KSmac = KSmac
+        self.ssc = ssc
+
+    def mac(self, data):
+        (ssc,) = struct.unpack(">Q", self.ssc)
+        self.ssc = struct.pack(">Q", (ssc + 1) & 0xffffffffffffffffL)
+        return _mac(self.KSmac, self.ssc + data)
+
+class Emulated_Card(object):
+    """The card model. transceive() takes a command APDU as a binary string and
+    returns the response APDU as a binary string."""
+
+    STATUS_WORDS = {
+        "ok": "\x90\x00",
+        "end_of_file": "\x62\x82",
+        "authentication_failed": "\x63\x00",
+        "wrong_length": "\x67\x00",
+        "incompatible_file": "\x69\x81",
+        "security_status": "\x69\x82",
+        "conditions_not_satisfied": "\x69\x85",
+        "no_current_ef": "\x69\x86",
+        "sm_objects_missing": "\x69\x87",
+        "sm_objects_incorrect": "\x69\x88",
+        "wrong_data": "\x6a\x80",
+        "file_not_found": "\x6a\x82",
+        "record_not_found": "\x6a\x83",
+        "wrong_p1p2": "\x6a\x86",
+        "wrong_offset": "\x6b\x00",
+        "ins_not_supported": "\x6d\x00",
+    }
+
+    INS_HANDLERS = {
+        0xa4: "_cmd_select",
+        0xb0: "_cmd_read_binary",
+        0xb2: "_cmd_read_record",
+        0xc0: "_cmd_get_response",
+        0x84: "_cmd_get_challenge",
+        0x82: "_cmd_mutual_authenticate",
+    }
+
+    def __init__(self, mf = None, name = "Emulated card", atr = None, protocol = 1,
+            extended_length = False, latency = 0, status_words = None, responses = (),
+            bac_keys = None):
+        """mf is the Emulated_DF at the root of the file tree (an empty one if None).
+        latency is a number of seconds to wait before each response, or a dictionary
+        mapping INS values (or None for all others) to seconds. status_words overrides
+        entries of STATUS_WORDS. responses is a list of (pattern, response) tuples: a
+        command whose hex representation (upper case, no spaces) matches the fnmatch
+        pattern is answered with the binary string response. bac_keys is a
+        (Kenc, Kmac) tuple, see derive_bac_keys()."""
+        if mf is None:
+            mf = Emulated_DF()
+        if mf.fid is None:
+            mf.fid = FID_MF
+        self.mf = mf
+        self.name = name
+        if atr is None:
+            atr = make_atr(extended_length)
+        self.atr = atr
+        self.protocol = protocol
+        self.extended_length = extended_length
+        self.latency = latency
+        self.status_words = dict(self.STATUS_WORDS)
+        if status_words is not None:
+            self.status_words.update(status_words)
+        self.responses = [ (pattern.upper(), response) for pattern, response in responses ]
+        self.bac_keys = bac_keys
+        self.reset()
+
+    def reset(self):
+        "Reset the card to its state after power on, return the ATR"
+        self._current_df = self.mf
+        self._current_ef = None
+        self._current_record = 0
+        self._pending = ""
+        self._challenge = None
+        self._sm = None
+        return self.atr
+
+    def get_ATR(self):
+        return self.atr
+
+    def get_latency(self, apdu):
+        "Return the number of seconds that the response to apdu is delayed"
+        if isinstance(self.latency, dict):
+            return self.latency.get(apdu.ins, self.latency.get(None, 0))
+        return self.latency
+
+    def transceive(self, data):
+        "Process one command APDU and return the response APDU, both binary strings"
+        try:
+            apdu = utils.C_APDU(data)
+        except ValueError:
+            return self.status_words["wrong_length"]
+
+        delay = self.get_latency(apdu)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.responses:
+            command = binascii.b2a_hex(data).upper()
+            for pattern, response in self.responses:
+                if fnmatch.fnmatchcase(command, pattern):
+                    return response
+
+        command = apdu
+        pending, self._pending = self._pending, ""
+        secure = False
+        try:
+            if apdu.extended and not self.extended_length:
+                raise _Status("wrong_length")
+            if apdu.cla & 0x0c == 0x0c:
+                apdu = self._sm_unwrap(apdu)
+                secure = True
+            elif self._sm is not None:
+                ## A command without secure messaging ends the session
+                self._sm = None
+
+            handler = self.INS_HANDLERS.get(apdu.ins, None)
+            if handler is None:
+                raise _Status("ins_not_supported")
+            if handler == "_cmd_get_response":
+                data, sw = self._cmd_get_response(apdu, pending)
+            else:
+                data, sw = getattr(self, handler)(apdu)
+                data = self._limit(apdu, data)
+        except _Status, e:
+            data, sw = "", self.status_words[e.condition]
+
+        if secure and self._sm is not None:
+            data = self._sm_wrap(data, sw)
+            secure = False
+
+        if data and self.protocol == 0 and command.case() in (1, 3, 4) and command.ins != 0xc0:
+            ## T=0: the card can't send data with the status word, announce it for GET RESPONSE
+            self._pending = data
+            return "\x61" + chr(min(len(data), 0x100) & 0xff)
+        return data + sw
+
+    def _limit(self, apdu, data):
+        "Cut data to the length that apdu asks for"
+        if not hasattr(apdu, "_Le"):
+            if self.protocol == 0:
+                return data
+            return ""
+        return data[:self._le(apdu)]
+
+    def _le(self, apdu):
+        if apdu.le == 0:
+            return apdu.extended and 0x10000 or 0x100
+        return apdu.le
+
+    def _ok(self, data = ""):
+        return data, self.status_words["ok"]
+
+    def _check_access(self, ef):
+        if ef.protected and self._sm is None:
+            raise _Status("security_status")
+
+    def _cmd_select(self, apdu):
+        p1, name = apdu.p1, apdu.data
+        target = None
+        if p1 == 0x00:
+            if name in ("", FID_MF):
+                target = self.mf
+            else:
+                target = self._current_df.find_child(name)
+                if target is None and self._current_df.fid == name:
+                    target = self._current_df
+                if target is None and self._current_df.parent is not None:
+                    target = self._current_df.parent.find_child(name)
+        elif p1 == 0x01:
+            target = self._current_df.find_child(name, Emulated_DF)
+        elif p1 == 0x02:
+            target = self._current_df.find_child(name, (Emulated_EF, Emulated_Record_EF))
+        elif p1 == 0x03:
+            target = self._current_df.parent or self.mf
+        elif p1 == 0x04:
+            target = self.mf.find_name(name)
+        elif p1 in (0x08, 0x09):
+            if len(name) % 2 != 0:
+                raise _Status("wrong_data")
+            target = p1 == 0x08 and self.mf or self._current_df
+            for i in range(0, len(name), 2):
+                if not isinstance(target, Emulated_DF):
+                    target = None
+                    break
+                target = target.find_child(name[i:i+2])
+                if target is None:
+                    break
+        else:
+            raise _Status("wrong_p1p2")
+
+        if target is None:
+            raise _Status("file_not_found")
+
+        if isinstance(target, Emulated_DF):
+            self._current_df = target
+            self._current_ef = None
+        else:
+            self._current_df = target.parent
+            self._current_ef = target
+        self._current_record = 0
+
+        response = apdu.p2 & 0x0c
+        if response == 0x0c:
+            return self._ok()
+        tag = {0x04: 0x62, 0x08: 0x64}.get(response, 0x6f)
+        return self._ok(target.get_management_information(tag))
+
+    def _select_sfi(self, sfi):
+        ef = self._current_df.find_sfi(sfi)
+        if ef is None:
+            raise _Status("file_not_found")
+        if ef is not self._current_ef:
+            self._current_ef = ef
+            self._current_record = 0
+        return ef
+
+    def _cmd_read_binary(self, apdu):
+        if apdu.p1 & 0x80:
+            ef = self._select_sfi(apdu.p1 & 0x1f)
+            offset = apdu.p2
+        else:
+            ef = self._current_ef
+            offset = (apdu.p1 << 8) | apdu.p2
+
+        if ef is None:
+            raise _Status("no_current_ef")
+        if not isinstance(ef, Emulated_EF):
+            raise _Status("incompatible_file")
+        self._check_access(ef)
+        if offset > len(ef.data):
+            raise _Status("wrong_offset")
+
+        le = self._le(apdu)
+        data = ef.data[offset:offset+le]
+        if len(data) < le and apdu.le != 0:
+            return data, self.status_words["end_of_file"]
+        return self._ok(data)
+
+    def _cmd_read_record(self, apdu):
+        sfi = apdu.p2 >> 3
+        if sfi != 0:
+            ef = self._select_sfi(sfi)
+        else:
+            ef = self._current_ef
+
+        if ef is None:
+            raise _Status("no_current_ef")
+        if not isinstance(ef, Emulated_Record_EF):
+            raise _Status("incompatible_file")
+        self._check_access(ef)
+
+        mode = apdu.p2 & 0x07
+        if mode == 0x04:
+            number = apdu.p1 or self._current_record
+        elif mode == 0x00:
+            number = 1
+        elif mode == 0x01:
+            number = len(ef.records)
+        elif mode == 0x02:
+            number = self._current_record + 1
+        elif mode == 0x03:
+            number = self._current_record - 1
+        else:
+            raise _Status("wrong_p1p2")
+
+        if not 0 < number <= len(ef.records):
+            raise _Status("record_not_found")
+        if mode != 0x04:
+            self._current_record = number
+        return self._ok(ef.records[number-1])
+
+    def _cmd_get_response(self, apdu, pending):
+        if not pending:
+            raise _Status("conditions_not_satisfied")
+        le = self._le(apdu)
+        data, pending = pending[:le], pending[le:]
+        if pending:
+            self._pending = pending
+            return data, "\x61" + chr(min(len(pending), 0x100) & 0xff)
+        return self._ok(data)
+
+    def _cmd_get_challenge(self, apdu):
+        length = 8
+        if hasattr(apdu, "_Le") and apdu.le != 0:
+            length = apdu.le
+        self._challenge = os.urandom(length)
+        return self._ok(self._challenge)
+
+    def _cmd_mutual_authenticate(self, apdu):
+        if self.bac_keys is None:
+            raise _Status("ins_not_supported")
+        Kenc, Kmac = self.bac_keys
+        challenge, self._challenge = self._challenge, None
+        self._sm = None
+        if len(apdu.data) != 40 or challenge is None or len(challenge) != 8:
+            raise _Status("conditions_not_satisfied")
+
+        Eifd, Mifd = apdu.data[:32], apdu.data[32:]
+        if _mac(Kmac, Eifd) != Mifd:
+            raise _Status("authentication_failed")
+        S = _des3(False, Kenc, Eifd)
+        rnd_ifd, rnd_icc, Kifd = S[:8], S[8:16], S[16:]
+        if rnd_icc != challenge:
+            raise _Status("authentication_failed")
+
+        Kicc = os.urandom(16)
+        Eicc = _des3(True, Kenc, rnd_icc + rnd_ifd + Kicc)
+
+        KSseed = "".join([chr(ord(a) ^ ord(b)) for a, b in zip(Kicc, Kifd)])
+        self._sm = _SM_Session(_derive_key(KSseed, 1), _derive_key(KSseed, 2), rnd_icc[-4:] + rnd_ifd[-4:])
+        return self._ok(Eicc + _mac(Kmac, Eicc))
+
+    def _sm_unwrap(self, apdu):
+        "Check and decrypt a command APDU with secure messaging, return the plain APDU"
+        if self._sm is None:
+            raise _Status("security_status")
+
+        objects = {}
+        mac_end = None
+        previous_end = 0
+        try:
+            for tag, constructed, start, end in TLV_utils.tlv_records(apdu.data):
+                if tag == 0x8e:
+                    mac_end = previous_end
+                objects[tag] = apdu.data[start:end]
+                previous_end = end
+        except IndexError:
+            mac_end = None
+        if mac_end is None:
+            self._sm = None
+            raise _Status("sm_objects_missing")
+
+        header = chr(apdu.cla) + chr(apdu.ins) + chr(apdu.p1) + chr(apdu.p2)
+        if self._sm.mac(_pad(header) + apdu.data[:mac_end]) != objects[0x8e]:
+            self._sm = None
+            raise _Status("sm_objects_incorrect")
+
+        kwargs = {}
+        if 0x87 in objects:
+            kwargs["data"] = _unpad(_des3(False, self._sm.KSenc, objects[0x87][1:]))
+        elif 0x85 in objects:
+            kwargs["data"] = _unpad(_des3(False, self._sm.KSenc, objects[0x85]))
+        if 0x97 in objects:
+            le = 0
+            for c in objects[0x97]:
+                le = (le << 8) | ord(c)
+            kwargs["le"] = le
+            if len(objects[0x97]) > 1:
+                kwargs["extended"] = True
+        return utils.C_APDU(cla = apdu.cla & ~0x0c, ins = apdu.ins, p1 = apdu.p1, p2 = apdu.p2, **kwargs)
+
+    def _sm_wrap(self, data, sw):
+        "Return the response data objects for data and sw with secure messaging"
+        objects = []
+        if data:
+            objects.append( (0x87, 0, "\x01" + _des3(True, self._sm.KSenc, _pad(data))) )
+        objects.append( (0x99, 0, sw) )
+        body = TLV_utils.pack(objects, recalculate_length = True)
+        return body + "\x8e\x08" + self._sm.mac(body)
+
+    def from_iso_node(cls, node, **kwargs):
+        """Build an Emulated_Card from an iso_node tree (see cards.iso_7816_4_card). A generic
+        iso_node at the root stands for the MF. Keyword arguments are passed to __init__."""
+        mf = _file_from_iso_node(node)
+        if not isinstance(mf, Emulated_DF):
+            mf = Emulated_DF(children = [mf])
+        return cls(mf, **kwargs)
+    from_iso_node = classmethod(from_iso_node)
+
+    def from_spec(cls, spec, **kwargs):
+        "Build an Emulated_Card from a JSON spec that has already been parsed, see the module docstring"
+        arguments = {
+            "mf": _file_from_spec(spec.get("mf", {}), "df"),
+            "name": spec.get("name", "Emulated card"),
+            "protocol": spec.get("protocol", 1),
+            "extended_length": spec.get("extended_length", False),
+            "responses": [ ("".join(pattern.split()), _from_hex(response))
+                for pattern, response in spec.get("responses", []) ],
+        }
+        if "atr" in spec:
+            arguments["atr"] = _from_hex(spec["atr"])
+
+        latency = spec.get("latency", 0)
+        if isinstance(latency, dict):
+            latency = {}
+            for key, value in spec["latency"].items():
+                if key == "default":
+                    latency[None] = value
+                else:
+                    latency[int(key, 16)] = value
+        arguments["latency"] = latency
+
+        arguments["status_words"] = dict([ (key, _from_hex(value))
+            for key, value in spec.get("status_words", {}).items() ])
+
+        bac = spec.get("bac", None)
+        if bac is not None:
+            if "mrz2" in bac:
+                arguments["bac_keys"] = derive_bac_keys(bac["mrz2"])
+            else:
+                arguments["bac_keys"] = (_from_hex(bac["kenc"]), _from_hex(bac["kmac"]))
+
+        arguments.update(kwargs)
+        return cls(**arguments)
+    from_spec = classmethod(from_spec)
+
+def _file_from_iso_node(node):
+    fid = getattr(node, "_fid", None)
+    fcp = getattr(node, "_management_information", None)
+    if fcp is not None and fcp[:1] not in ("\x62", "\x6f"):
+        fcp = None
+
+    if not hasattr(node, "_content"):
+        result = Emulated_DF(fid, fcp = fcp)
+        for child in node._children:
+            result.add_child(_file_from_iso_node(child))
+        return result
+
+    content = node._content
+    if isinstance(content, (list, tuple)):
+        return Emulated_Record_EF(fid, records = content, fcp = fcp)
+    return Emulated_EF(fid, data = content or "", fcp = fcp)
+
+def _file_from_spec(spec, type = None):
+    type = spec.get("type", type)
+    kwargs = {
+        "fid": spec.get("fid", None) and _from_hex(spec["fid"]),
+        "sfi": spec.get("sfi", None),
+        "protected": spec.get("protected", False),
+    }
+    if "fcp" in spec:
+        kwargs["fcp"] = _from_hex(spec["fcp"])
+
+    if type == "df":
+        if "name" in spec:
+            kwargs["name"] = _from_hex(spec["name"])
+        kwargs["children"] = [ _file_from_spec(child) for child in spec.get("children", []) ]
+        return Emulated_DF(**kwargs)
+    elif type == "ef":
+        return Emulated_EF(data = _from_hex(spec.get("data", "")), **kwargs)
+    elif type == "record":
+        return Emulated_Record_EF(records = [ _from_hex(record) for record in spec.get("records", []) ], **kwargs)
+    else:
+        raise ValueError, "Unknown file type %r, must be one of df, ef, record" % (type,)
+
+def load_card(filename, **kwargs):
+    "Load a JSON spec file and return the Emulated_Card, keyword arguments are passed to __init__"
+    import json
+    fp = open(filename)
+    try:
+        spec = json.load(fp)
+    finally:
+        fp.close()
+    return Emulated_Card.from_spec(spec, **kwargs)
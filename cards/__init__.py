@@ -10,6 +10,7 @@ from sys import modules as _modules
 from dircache import listdir as _listdir
 from new import classobj as _classobj
 import inspect as _inspect
+import TLV_utils as _TLV_utils
 
 for filename in _listdir(_modules[__name__].__path__[0]):
     if filename[-3:].lower() == ".py":
@@ -98,13 +99,15 @@ class Cardmultiplexer:
             if hasattr(cls, "__init__"):
                 cls.__init__(self, *self._init_args, **self._init_kwargs)
         
-        self._merge_attributes()
+        if newcls or delcls:
+            self._merge_attributes()
     
     def remove_classes(self, classes):
         """Remove classes from this Cardmultiplexer object."""
         (newcls, delcls) = self._update_classes([], list(classes))
         
-        self._merge_attributes()
+        if newcls or delcls:
+            self._merge_attributes()
     
     def _update_classes(self, addclasses, delclasses):
         """This handles the task of figuring out which classes to actually
@@ -196,3 +199,7 @@ class Cardmultiplexer:
         for cls in ordered_classes:
             if hasattr(cls, "post_merge"):
                 cls.post_merge(self)
+        
+        ## Compile the merged TLV_OBJECTS here, once per merge, instead of in every decode() call
+        if isinstance(getattr(self, "TLV_OBJECTS", None), dict):
+            self.TLV_OBJECTS = _TLV_utils.compile_tags(self.TLV_OBJECTS)
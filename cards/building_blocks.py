@@ -12,18 +12,14 @@ class Card_with_ls:
         return num
     _str_to_long = staticmethod(_str_to_long)
     
-    def _find_recursive(search_tag, data):
-        while len(data) > 0:
-            if ord(data[0]) in (0x00, 0xFF):
-                data = data[1:]
-                continue
-            
-            ber_class, constructed, tag, length, value, data = TLV_utils.tlv_unpack(data)
+    def _find_recursive(search_tag, data, start = 0, end = None):
+        if end is None: end = len(data)
+        for tag, constructed, value_start, value_end in TLV_utils.tlv_records(data, start, end):
             if not constructed:
                 if tag == search_tag:
-                    return value
+                    return data[value_start:value_end]
             else:
-                ret = Card_with_ls._find_recursive(search_tag, value)
+                ret = Card_with_ls._find_recursive(search_tag, data, value_start, min(value_end, end))
                 if ret is not None: return ret
         return None
     _find_recursive = staticmethod(_find_recursive)
@@ -99,38 +95,69 @@ class Card_with_read_binary:
     DATA_UNIT_SIZE=1
     HEXDUMP_LINELEN=16
     
-    def read_binary_file(self, offset = 0):
+    def read_binary_file(self, offset = 0, decoder = None):
         """Read from the currently selected EF.
-        Repeat calls to READ BINARY as necessary to get the whole EF."""
+        Repeat calls to READ BINARY as necessary to get the whole EF.
+        If decoder is given (e.g. a new TLV_utils.tlv_stream_decoder) then each chunk is fed to it as
+        soon as it arrives. Reading then stops as soon as decoder.finished is set, the last
+        READ BINARY only asks for decoder.remaining bytes and the contents returned are decoder.data.
+        If card and reader support extended length APDUs (see supports_extended_length()) then
+        each READ BINARY asks for up to get_max_le() bytes."""
         
         if offset >= 1<<15:
             raise ValueError, "offset is limited to 15 bits"
-        contents = ""
+        chunks = []
+        length = 0
         had_one = False
         
+        extended_le = None
+        if hasattr(self, "get_max_le") and self.get_max_le() > 0x100:
+            extended_le = self.get_max_le()
+        
+        template = utils.apdu_template(self.APDU_READ_BINARY)
         self.last_size = -1
         while True:
-            command = C_APDU(self.APDU_READ_BINARY, p1 = offset >> 8, p2 = (offset & 0xff))
+            command = template.make(p1 = offset >> 8, p2 = (offset & 0xff))
+            if hasattr(command, "_Le"):
+                size = extended_le or command.le or 256
+                if decoder is not None and decoder.remaining is not None and 0 < decoder.remaining < size:
+                    size = decoder.remaining
+                if size != (command.le or 256):
+                    command.le = size
+            
             result = self.send_apdu(command)
+            if extended_le is not None and len(result.data) == 0 and result.sw == "\x67\x00":
+                ## Wrong length: The extended length APDU was not accepted after all, fall back to short reads
+                extended_le = None
+                continue
             if len(result.data) > 0:
-                contents = contents + result.data
+                length = length + len(result.data)
                 offset = offset + (len(result.data) / self.DATA_UNIT_SIZE)
+                if decoder is not None:
+                    decoder.feed(result.data)
+                else:
+                    chunks.append(result.data)
             
-            if self.last_size == len(contents):
+            if self.last_size == length:
                 break
             else:
-                self.last_size = len(contents)
+                self.last_size = length
             
             if not self.check_sw(result.sw):
                 break
             else:
                 had_one = True
+            
+            if decoder is not None and decoder.finished:
+                break
         
         if had_one: ## If there was at least one successful pass, ignore any error SW. It probably only means "end of file"
             self.sw_changed = False
             self.last_delta = None
         
-        return contents, result.sw
+        if decoder is not None:
+            return decoder.data, result.sw
+        return "".join(chunks), result.sw
     
     def cmd_cat(self):
         "Print a hexdump of the currently selected file (e.g. consecutive READ BINARY)"
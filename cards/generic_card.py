@@ -1,5 +1,5 @@
 import smartcard
-import TLV_utils, crypto_utils, utils, binascii, fnmatch, re, time
+import TLV_utils, crypto_utils, utils, binascii, fnmatch, re, time, sys
 from utils import C_APDU, R_APDU
 
 DEBUG = True
@@ -11,6 +11,9 @@ class Card:
     DRIVER_NAME = [_GENERIC_NAME]
     COMMAND_GET_RESPONSE = None
     
+    ## Upper bound for GET RESPONSE and retry rounds in _send_with_retry()
+    MAX_RESPONSE_ROUNDS = 256
+    
     ## Constants for check_sw()
     PURPOSE_SUCCESS = 1 # Command executed successful
     PURPOSE_GET_RESPONSE = 2   # Command executed successful but needs GET RESPONSE with correct length
@@ -103,7 +106,8 @@ class Card:
             end = (lastlen + (int(end,0) % lastlen) ) % lastlen
         else:
             end = lastlen
-        print TLV_utils.decode(self.last_result.data[start:end], tags=self.TLV_OBJECTS, context = self.DEFAULT_CONTEXT)
+        TLV_utils.decode_to_stream(self.last_result.data[start:end], sys.stdout, tags=self.TLV_OBJECTS, context = self.DEFAULT_CONTEXT)
+        print
     
     _SHOW_APPLICATIONS_FORMAT_STRING = "%(aid)-50s %(name)-20s %(description)-30s"
     def cmd_show_applications(self):
@@ -133,7 +137,9 @@ class Card:
         apdu_binary = apdu.render()
         
         if DEBUG:
-            print ">> " + utils.hexdump(apdu_binary, indent = 3)
+            sys.stdout.write(">> ")
+            utils.hexdump_to_stream(apdu_binary, sys.stdout, indent = 3)
+            print
         
         result_binary = self.reader.transceive(apdu_binary)
         result = apdu.RESPONSE_CLASS(result_binary)
@@ -141,22 +147,51 @@ class Card:
         self.last_apdu = apdu
         
         if DEBUG:
-            print "<< " + utils.hexdump(result_binary, indent = 3)
+            sys.stdout.write("<< ")
+            utils.hexdump_to_stream(result_binary, sys.stdout, indent = 3)
+            print
         return result
     
+    def _make_get_response(self, apdu, result):
+        """Return the GET RESPONSE command that should be sent after result (the response to
+        apdu) asked for it, or None if the card has no GET RESPONSE command."""
+        return self.COMMAND_GET_RESPONSE
+    
     def _send_with_retry(self, apdu):
+        """Send apdu and follow GET RESPONSE (PURPOSE_GET_RESPONSE) and retry with
+        correct Le (PURPOSE_RETRY) status words for as many rounds as necessary, but
+        at most MAX_RESPONSE_ROUNDS. The data of all responses is collected and the final
+        response object is only built once."""
         result = self._real_send(apdu)
+        last = apdu
+        chunks = []
+        rounds = 0
         
-        while self.check_sw(result.sw, self.PURPOSE_GET_RESPONSE):
-            ## Need to call GetResponse
-            gr_apdu = self.COMMAND_GET_RESPONSE
-            tmp = self._real_send(gr_apdu)
-            
-            if not callable(result.append):
-                result = tmp
-                break
+        while True:
+            if self.check_sw(result.sw, self.PURPOSE_GET_RESPONSE):
+                ## Need to call GetResponse
+                next_apdu = self._make_get_response(apdu, result)
+                if next_apdu is None:
+                    break
+                if callable(result.append):
+                    chunks.append(result.data)
+            elif self.check_sw(result.sw, self.PURPOSE_RETRY) and isinstance(last, C_APDU) \
+                    and hasattr(last, "_Le") and last.Le != result.sw2:
+                ## Retry with correct Le
+                next_apdu = C_APDU(last, le = result.sw2)
             else:
-                result = result.append(tmp)
+                break
+            
+            rounds = rounds + 1
+            if rounds > self.MAX_RESPONSE_ROUNDS:
+                raise IOError, "Card still wants GET RESPONSE or retry after %i rounds, giving up" % self.MAX_RESPONSE_ROUNDS
+            
+            last = next_apdu
+            result = self._real_send(next_apdu)
+        
+        if len(chunks) > 0 and callable(result.append):
+            chunks.append(result.data)
+            result = R_APDU("".join(chunks) + result.sw)
         
         return result
     
@@ -186,6 +221,11 @@ class Card:
         self.last_result = result
         return result
     
+    def send_apdu_async(self, apdu):
+        """Like send_apdu(), but run it in the executor thread of the reader (see
+        readers.Smartcard_Reader.run_async()) and return a readers.ReaderJob for the result."""
+        return self.reader.run_async(self.send_apdu, apdu)
+    
     def check_sw(self, sw, purpose = None):
         if purpose is None: purpose = Card.PURPOSE_SUCCESS
         return self.match_statusword(self.STATUS_MAP[purpose], sw)
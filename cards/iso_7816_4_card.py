@@ -48,8 +48,7 @@ class iso_node(object):
                     child.print_node(indent+1, **kwargs)
 
     def _dump_internal(self, data, indent, do_tlv=True):
-        c = utils.hexdump(data)
-        r = map(lambda a: self.get_indent(indent)+a, c.splitlines(False))
+        r = [self.get_indent(indent)+a for a in utils.hexdump_lines(data)]
         if do_tlv:
             try:
                 if self._card_object is not None:
@@ -163,6 +162,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,ISO_Card):
     APDU_READ_RECORD = C_APDU(ins=0xb2,le=0)
     DRIVER_NAME = ["ISO 7816-4"]
     FID_MF = "\x3f\x00"
+    SFI_EF_ATR = 0x1d
     
     SELECT_FILE_P1 = 0x02
     SELECT_P2 = 0x0
@@ -177,7 +177,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,ISO_Card):
 
     def select_file(self, p1, p2, fid):
         result = self.send_apdu(
-            C_APDU(self.APDU_SELECT_FILE,
+            utils.apdu_template(self.APDU_SELECT_FILE).make(
             p1 = p1, p2 = p2,
             data = fid, le = self.SELECT_FILE_LE) )
         return result
@@ -218,7 +218,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,ISO_Card):
     
     def read_record(self, p1 = 0, p2 = 0, le = 0):
         "Read a record from the currently selected file"
-        command = C_APDU(self.APDU_READ_RECORD, p1 = p1, p2 = p2, le = le)
+        command = utils.apdu_template(self.APDU_READ_RECORD).make(p1 = p1, p2 = p2, le = le)
         result = self.send_apdu(command)
         return result.data
     
@@ -231,6 +231,21 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,ISO_Card):
         contents = self.read_record(p1 = int(p1,0), p2 = int(p2,0), le = int(le,0))
         print utils.hexdump(contents)
     
+    def cmd_read_ef_atr(self):
+        "Read EF.ATR/INFO (by its short EF identifier) and show the extended length information"
+        result = self.send_apdu(
+            utils.apdu_template(self.APDU_READ_BINARY).make(p1 = 0x80 | self.SFI_EF_ATR, p2 = 0) )
+        if len(result.data) > 0:
+            print TLV_utils.decode(result.data,tags=self.TLV_OBJECTS)
+            self.parse_ef_atr(result.data)
+        
+        supported, max_command, max_response = self.get_extended_length_info()
+        print "Extended length: %s (card), %s (card and reader)" % (
+            supported and "supported" or "not supported",
+            self.supports_extended_length() and "supported" or "not supported")
+        if max_command is not None:
+            print "Maximum length of command data: %i, of response data: %i" % (max_command, max_response)
+    
     def cmd_next_record(self, le = "0"):
         "Read the next record"
         return self.cmd_read_record(p1 = "0", p2 = "2", le = le)
@@ -305,6 +320,7 @@ class ISO_7816_4_Card(building_blocks.Card_with_read_binary,ISO_Card):
         "open": cmd_open,
         "read_record": cmd_read_record,
         "next_record": cmd_next_record,
+        "read_ef_atr": cmd_read_ef_atr,
         } )
 
     STATUS_WORDS = dict(ISO_Card.STATUS_WORDS)
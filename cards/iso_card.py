@@ -10,6 +10,12 @@ class ISO_Card(Card):
     
     APDU_VERIFY_PIN = C_APDU(ins=0x20)
     
+    ## Extended length APDUs: None means use what the ATR (or EF.ATR, see parse_ef_atr())
+    ## says, drivers may set True or False to override that
+    EXTENDED_LENGTH = None
+    ## Largest Le to use with extended length if the card doesn't announce its limits
+    EXTENDED_LENGTH_DEFAULT_LE = 0x1000
+    
     ## Map for check_sw()
     STATUS_MAP = {
         Card.PURPOSE_SUCCESS: ("\x90\x00", ),
@@ -90,6 +96,7 @@ class ISO_Card(Card):
         Card.__init__(self, reader)
         self.last_sw = None
         self.sw_changed = False
+        self._extended_length_info = None
     
     def post_merge(self):
         ## Called after cards.__init__.Cardmultiplexer._merge_attributes
@@ -126,21 +133,59 @@ class ISO_Card(Card):
         
         return result
 
-    def _send_with_retry(self, apdu):
-        result = self._real_send(apdu)
+    def _make_get_response(self, apdu, result):
+        return utils.apdu_template(self.COMMAND_GET_RESPONSE).make(le = result.sw2, cla=apdu.cla) # FIXME
+    
+    def get_extended_length_info(self):
+        """Return (supported, max_command_length, max_response_length) for extended length
+        APDUs as announced by the card, the maximums are None if unknown. Initially this is
+        taken from the card capabilities in the ATR, see parse_ef_atr() for more."""
+        if self._extended_length_info is None:
+            capabilities = utils.atr_card_capabilities(self.get_atr())
+            supported = len(capabilities) >= 3 and (ord(capabilities[2]) & 0x40) != 0
+            self._extended_length_info = (supported, None, None)
+        return self._extended_length_info
+    
+    def parse_ef_atr(self, data):
+        """Update the extended length information from the contents of EF.ATR/INFO: the
+        card capabilities (tag 47) and the extended length information (tag 7F66)."""
+        supported, max_command, max_response = self.get_extended_length_info()
+        structure = TLV_utils.unpack(data)
         
-        if self.check_sw(result.sw, self.PURPOSE_GET_RESPONSE):
-            ## Need to call GetResponse
-            gr_apdu = C_APDU(self.COMMAND_GET_RESPONSE, le = result.sw2, cla=apdu.cla) # FIXME
-            result = R_APDU(self._real_send(gr_apdu))
-        elif self.check_sw(result.sw, self.PURPOSE_RETRY) and apdu.Le == 0:
-            ## Retry with correct Le
-            gr_apdu = C_APDU(apdu, le = result.sw2)
-            result = R_APDU(self._real_send(gr_apdu))
+        capabilities = TLV_utils.tlv_find_tag(structure, 0x47, 1)
+        if len(capabilities) > 0 and len(capabilities[0][2]) >= 3:
+            supported = (ord(capabilities[0][2][2]) & 0x40) != 0
         
-        return result
-    
+        length_info = TLV_utils.tlv_find_tag(structure, 0x7F66, 1)
+        if len(length_info) > 0 and isinstance(length_info[0][2], list):
+            values = [int(binascii.b2a_hex(value), 16) for (tag, length, value) in length_info[0][2]
+                if tag == 0x02 and len(value) > 0]
+            if len(values) >= 2:
+                supported = True
+                max_command, max_response = values[:2]
+        
+        self._extended_length_info = (supported, max_command, max_response)
+        return self._extended_length_info
     
+    def supports_extended_length(self):
+        "Return True if both the card and the reader can handle extended length APDUs"
+        if self.EXTENDED_LENGTH is not None:
+            supported = self.EXTENDED_LENGTH
+        else:
+            supported = self.get_extended_length_info()[0]
+        
+        reader_supports = getattr(self.reader, "supports_extended_length", None)
+        return bool(supported) and reader_supports is not None and reader_supports()
+    
+    def get_max_le(self):
+        """Return the largest Le that should be requested in one command: 256 for
+        short APDUs, otherwise what the card announced or EXTENDED_LENGTH_DEFAULT_LE."""
+        if not self.supports_extended_length():
+            return 0x100
+        max_response = self.get_extended_length_info()[2]
+        if max_response is None:
+            max_response = self.EXTENDED_LENGTH_DEFAULT_LE
+        return max(0x100, min(max_response, 0xffff))
     
     def verify_pin(self, pin_number, pin_value):
         apdu = C_APDU(self.APDU_VERIFY_PIN, P2 = pin_number,
@@ -31,11 +31,11 @@ class MTCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
             0x4: "ICAO - basic access control",
         }.get(ord(value), "RFU")
     
-    reset_retry_counter_byte_descriptions = (
+    reset_retry_counter_byte_descriptions = utils.compile_bytemasks((
         (0xFF, 0x00, None, "Retry counter is unused"),
         (0x80, 0x00, None, "Retry counter is reset upon successful both Authentication and RESET RETRY COUNTER"),
         (0x80, 0x80, None, "Retry counter can only be reset using RESET RETRY COUNTER"),
-    )
+    ))
     def decode_retry_counter(value):
         results = [" %s" % utils.hexdump(value, short=True)]
         results.append("Number of further allowed attempts: %i" % ord(value[0]))
@@ -47,7 +47,7 @@ class MTCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
         ) )
         return "\n".join(results)
     
-    application_class_byte_descriptions = (
+    application_class_byte_descriptions = utils.compile_bytemasks((
         (0x80, 0x80, None, "Secret file"),
         (0xC0, 0x80, None, "RFU"),
         (0xC0, 0xC0, None, "Keyfile"),
@@ -55,14 +55,14 @@ class MTCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
         (0xC4, 0xC4, None, "Possible application area: Encryption"),
         (0xC2, 0xC2, None, "Possible application area: Cryptographic checksum (Secure Messaging)"),
         (0xC1, 0xC1, None, "Possible application area: Authentication"),
-    )
-    cryptographic_algorithm_byte_descriptions = (
+    ))
+    cryptographic_algorithm_byte_descriptions = utils.compile_bytemasks((
         (0x80, 0x00, None, "Symmetric Algorithm"),
         (0x8F, 0x08, None, "DES-Key"),
         (0x8E, 0x0C, None, "3DES-Key (Triple DES with 2 or 3 keys)"),
         (0x81, 0x00, None, " - ECB"),
         (0x81, 0x01, None, " - CBC"),
-    )
+    ))
     cryptographic_algorithm_byte_descriptions_old = (
         (0x80, 0x80, None, "Asymmetric Algorithm"),
         (0xC0, 0x80, None, "Private Key"),
@@ -183,12 +183,12 @@ class MTCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
         
         return "\n".join(results)
     
-    physical_access_byte_descriptions = (
+    physical_access_byte_descriptions = utils.compile_bytemasks((
         (0xFF, 0x01, None, "Access by contacts according to ISO 7816-3"),
         (0xFF, 0x02, None, "Access by contactless (radio frequency) according to ISO 14443"),
         (0xFF, 0x03, None, "Dual interface"),
         (0xFC, 0x00, "RFU", None),
-    )
+    ))
     def decode_physical_access(value):
         return "\n"+"\n".join( 
             utils.parse_binary( 
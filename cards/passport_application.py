@@ -31,29 +31,36 @@ class Passport_Security_Environment(TCOS_Security_Environment):
         self.set_config( tcos_card.SE_APDU,  tcos_card.TEMPLATE_CT, SE_Config(enc_config) )
         self.set_config( tcos_card.SE_RAPDU, tcos_card.TEMPLATE_CT, SE_Config(enc_config) )
     
+    ## Fancy APDU templates for the SM transformation of each ISO case, the
+    ## header is filled in from the original APDU
+    SM_TEMPLATES = {
+        1: "00000000 YY 8E()00",
+        2: "00000000 YY 97({0}) 8E()00",
+        3: "00000000 YY 87[01{0}] 8E()00",
+        4: "00000000 YY 87[01{0}] 97({1}) 8E()00",
+    }
+    
     def before_send(self, apdu):
         self.last_vanilla_c_apdu = C_APDU(apdu)
         if (apdu.cla & 0x80 != 0x80) and (apdu.CLA & 0x0C != 0x0C):
             # Transform for SM
             apdu.CLA = apdu.CLA | 0x0C
-            apdu_string = binascii.b2a_hex(apdu.render())
-            new_apdu = [apdu_string[:8]]
-            new_apdu.append("YY")
+            case = apdu.case()
+            values = []
             
-            if apdu.case() in (3,4):
-                new_apdu.append("87[01")
-                new_apdu.append(binascii.b2a_hex(apdu.data))
-                new_apdu.append("]")
+            if case in (3,4):
+                values.append(apdu.data)
             
-            if apdu.case() in (2,4):
+            if case in (2,4):
                 if apdu.Le == 0:
                     apdu.Le = 0xe7 # FIXME: Probably not the right way
-                new_apdu.append("97(%02x)" % apdu.Le)
-            
-            new_apdu.append("8E()00")
+                if apdu.Le > 0xff:
+                    values.append(chr(apdu.Le >> 8) + chr(apdu.Le & 0xff))
+                else:
+                    values.append(chr(apdu.Le))
             
-            new_apdu_string = "".join(new_apdu)
-            apdu = C_APDU.parse_fancy(new_apdu_string)
+            apdu = C_APDU.compile_fancy(self.SM_TEMPLATES[case]).fill(*values,
+                cla = apdu.cla, ins = apdu.ins, p1 = apdu.p1, p2 = apdu.p2, extended = apdu.extended)
         
         return TCOS_Security_Environment.before_send(self, apdu)
     
@@ -226,8 +233,9 @@ class Passport_Application(Application):
         s = SMIME.SMIME()
         
         # TODO: ugly hack for M2Crypto
-        body = TLV_utils.tlv_find_tag(TLV_utils.unpack(data), 0xA0,  1)[0][2]
-        thecert = TLV_utils.tlv_find_tag(body, 0xA0,  2)[1][2]
+        index = TLV_utils.tlv_index(data)
+        body = index.find(0xA0,  1)[0][2]
+        thecert = index.find(0xA0,  2,  within=body)[1][2]
 
         cert_bio = BIO.MemoryBuffer(TLV_utils.pack(thecert))
         
@@ -645,7 +653,7 @@ class CBEFF:
     def from_data(cls, data, offset = 0, length = None, **kwargs):
         if length is None:
             length = len(data) - offset
-        structure = TLV_utils.unpack(data[offset:offset+length])
+        structure = TLV_utils.unpack_lazy(data, offset, offset+length)
         return cls(structure=structure, **kwargs)
     from_data = classmethod(from_data)
 
@@ -956,11 +964,11 @@ class Passport(object):
             
             p.result_map_select[fid] = result.sw
             if card.check_sw(result.sw):
-                contents, sw = card.read_binary_file()
+                contents, sw = card.read_binary_file(decoder = TLV_utils.tlv_stream_decoder())
                 if not card.check_sw(sw) and not tried_bac and not mrz_data is _default_empty_mrz_data:
                     tried_bac = True
                     card.cmd_perform_bac(mrz_data[1], verbose=0)
-                    contents, sw = card.read_binary_file()
+                    contents, sw = card.read_binary_file(decoder = TLV_utils.tlv_stream_decoder())
                 
                 p.result_map_read[fid] = sw
                 if contents != "":
@@ -1059,7 +1067,7 @@ class Passport(object):
     
     
     def parse_DG1(self, contents):
-        structure = TLV_utils.unpack(contents)
+        structure = TLV_utils.unpack_lazy(contents)
         try:
             mrz = TLV_utils.tlv_find_tag(structure, 0x5F1F, 1)[0][2]
         except IndexError:
@@ -294,7 +294,7 @@ class TCOS_Security_Environment(object):
             buffer.append(block_)
             del block[:]
             if print_buffer:
-                print "|| " + "\n|| ".join( utils.hexdump( block_, offset = offset ).splitlines() )
+                print "|| " + "\n|| ".join( utils.hexdump_lines( block_, offset = offset ) )
         
         buffer = []
         if startblock != "":
@@ -462,14 +462,14 @@ class TCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
             ("3bba96008131865d0064........31809000..", None),
         ]
     
-    file_status_descriptions = (
+    file_status_descriptions = utils.compile_bytemasks((
         (0xF9, 0x01, None, "Not invalidated"),
         (0xF9, 0x00, None, "Invalidated"),
         (0xFC, 0x04, None, "Not permanent"),
         (0xFC, 0x00, None, "Permanent"),
         (0xF2, 0x00, "RFU", None),
-    )
-    iftd_byte_1_descriptions = (
+    ))
+    iftd_byte_1_descriptions = utils.compile_bytemasks((
         (0x80, 0x00, None, "Data file"),
         (0xFC, 0x00, None, "RFU"),
         (0x83, 0x00, None, " - general data file"),
@@ -485,8 +485,8 @@ class TCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
         (0xC2, 0xC2, None, "    - mac"),
         (0xC1, 0xC1, None, "    - authenticate"),
         (0xCF, 0xC0, None, "RFU"),
-    )
-    iftd_byte_3_descriptions = (
+    ))
+    iftd_byte_3_descriptions = utils.compile_bytemasks((
         (0x10, 0x00, None, "Symmetric algorithm"),
         (0x1C, 0x00, None, " - RFU"),
         (0x1C, 0x04, None, " - IDEA"),
@@ -496,7 +496,7 @@ class TCOS_Card(ISO_7816_4_Card,building_blocks.Card_with_80_aa):
         (0x9C, 0x10, None, " - RSA, Public Key"),
         (0x9C, 0x90, None, " - RSA, Private Key"),
         (0x63, 0x00, "RFU", None),
-    )
+    ))
     
     @classmethod
     def decode_file_descriptor_extension(cls, value):
@@ -710,7 +710,7 @@ def decode_access_rule(mask, value):
             result.append("__");
     return " " + " ".join(result)
 
-compact_access_descriptions = (
+compact_access_descriptions = utils.compile_bytemasks((
     (0xc0, 0xc0, None, "proprietary"), 
     (0xa0, 0xa0, None, "proprietary"), 
     (0x90, 0x90, None, "proprietary"), 
@@ -722,7 +722,7 @@ compact_access_descriptions = (
     (0x04, 0x04, None, "DF: CREATE FILE (DF);     EF: APPEND RECORD;              DO: MANAGE SECURITY ENVIRONMENT"), 
     (0x02, 0x02, None, "DF: CREATE FILE (EF);     EF: UPDATE BINARY/RECORD;       DO: PUT DATA"), 
     (0x01, 0x01, None, "DF: DELETE FILE (child);  EF: READ/SEARCH BINARY/RECORD;  DO: GET DATA"), 
-)
+))
 
 def decode_compact_access_bitmap(value):
     return (" %s \n" % utils.hexdump(value, short=True)) + "\n\t".join(utils.parse_binary(ord(value[0]), compact_access_descriptions, True))
@@ -737,7 +737,7 @@ class TCOS_3_Card(TCOS_Card):
             ("3bbf.6008131fe5d0064........31c073f701d0009000..", None),
         ]
 
-    file_status_descriptions = (
+    file_status_descriptions = utils.compile_bytemasks((
         (0xe0, 0x00, "RFU",  "Data file"),
         (0x1f, 0x00, None, "General data file"), 
         (0x1f, 0x01, None, "EF_ATR"), 
@@ -756,7 +756,7 @@ class TCOS_3_Card(TCOS_Card):
         (0x1f, 0x0e, None, "RFU"), 
         (0x1f, 0x0f, None, "RFU"), 
         (0x10, 0x10, None, "RFU"), 
-    )
+    ))
 
     def decode_file_descriptor_extension_HACK(*args, **kwargs): return TCOS_3_Card.decode_file_descriptor_extension(*args,  **kwargs)
     
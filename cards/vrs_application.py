@@ -49,11 +49,12 @@ class VrsTicket(object):
     def _parse(self, contents):
         self._rawdata = contents
         self._tlvdata = TLV_utils.unpack(contents)
+        self._tlvindex = TLV_utils.tlv_index(self._tlvdata)
         
-        tmp = TLV_utils.tlv_find_tag(self._tlvdata, 0xEA, num_results = 1)
+        tmp = self._tlvindex.find(0xEA, num_results = 1)
         if len(tmp) == 0:
             raise ValueError, "Can't parse information file, tag 0xEA not found"
-        tmp = TLV_utils.tlv_find_tag(tmp, 0x85, num_results = 1)
+        tmp = self._tlvindex.find(0x85, num_results = 1, within = tmp)
         if len(tmp) == 0:
             raise ValueError, "Can't parse information file, tag 0x85 not found"
         self._mainblob = tmp[0][2]
@@ -1,3 +1,5 @@
+import sys
+
 try:
     import smartcard, smartcard.CardRequest
 except ImportError:
@@ -8,9 +10,20 @@ pycsc you'll need to downgrade to SVN revision 246.
 """
     raise
 
-import sys, utils, getopt, binascii, time
+import os, utils, getopt, binascii, time, threading, Queue, card_emulator, apdu_trace
+
+def _remaining(deadline):
+    "Return the number of seconds until deadline (a time.time() value), or None for no deadline"
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
 
 class Smartcard_Reader(object):
+    def __init__(self):
+        self._cancel_event = threading.Event()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+    
     def list_readers(cls):
         "Return a list of tuples: (reader name, implementing object)"
         return []
@@ -20,28 +33,73 @@ class Smartcard_Reader(object):
     _CONNECT_NO_CARD = object()
     _CONNECT_MUTE_CARD = object()
     _CONNECT_DONE = object()
-    def _internal_connect(self):
+    def _internal_connect(self, deadline = None):
         """Must implement the iterator protocol and yield 
         one of self._CONNECT_NO_CARD, self._CONNECT_MUTE_CARD or self._CONNECT_DONE.
         The iterator will not be called again after yielding _CONNECT_DONE, so it must
-        clean itself up before that."""
+        clean itself up before that.
+        Between two _CONNECT_NO_CARD it should block until something changes, deadline
+        (a time.time() value or None) has passed or cancel_connect() has been called."""
         raise NotImplementedError, "Please implement in a sub-class"
     
-    def connect(self):
+    def connect(self, timeout = None, quiet = False):
+        """Wait for a card and connect to it. Waits forever if timeout is None, otherwise
+        for at most timeout seconds. Returns True if there is a connection.
+        With quiet = True nothing is printed while waiting."""
+        return self._connect(timeout, quiet)
+    
+    def _connect(self, timeout, quiet = False):
+        ## The cancel event is only cleared when the wait is over, so that a cancel_connect()
+        ## which comes in before the wait has started is not lost
+        try:
+            return self._wait_and_connect(timeout, quiet)
+        finally:
+            self._cancel_event.clear()
+    
+    def _wait_and_connect(self, timeout, quiet = False):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
         have_card = False
-        printed = False
-        for result in self._internal_connect():
+        printed = quiet
+        for result in self._internal_connect(deadline):
             if result is self._CONNECT_DONE:
                 have_card = True
                 break
             elif result is self._CONNECT_MUTE_CARD:
-                print "Card is mute or absent. Please retry."
+                if not quiet:
+                    print "Card is mute or absent. Please retry."
             elif result is self._CONNECT_NO_CARD:
                 if not printed:
                     print "Please insert card ..."
                     printed = True
+            
+            if self._cancel_event.isSet() or _remaining(deadline) == 0:
+                break
         return have_card
     
+    def connect_async(self, callback, timeout = None):
+        """Like connect(), but wait in a background thread and call callback(reader, have_card)
+        when done. Note that the callback is called from that thread, GUIs must pass the result
+        on to their main loop (e.g. with gobject.idle_add). Returns the thread."""
+        def run():
+            have_card = False
+            try:
+                have_card = self._connect(timeout)
+            finally:
+                callback(self, have_card)
+        
+        thread = threading.Thread(target = run, name = "connect %s" % self.name)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+    
+    def cancel_connect(self):
+        """Make a connect() that is waiting for a card (in another thread) return False as soon
+        as possible. If no connect() is running the next one returns False immediately."""
+        self._cancel_event.set()
+    
     def get_ATR(self):
         "Get the ATR of the inserted card as a binary string"
         raise NotImplementedError, "Please implement in a sub-class"
@@ -49,19 +107,68 @@ class Smartcard_Reader(object):
     def transceive(self, data):
         "Send a binary blob, receive a binary blob"
         raise NotImplementedError, "Please implement in a sub-class"
+    
+    def supports_extended_length(self):
+        "Return True if extended length APDUs can be sent through this reader"
+        return False
+    
+    def get_wrapped_names(self):
+        """Return the names of the readers that this one accesses the device through,
+        these must not be used at the same time as this reader"""
+        return []
 
     def disconnect(self):
         "Disconnect from the card and release all resources"
         raise NotImplementedError, "Please implement in a sub-class"
+    
+    def get_executor(self):
+        """Return the Reader_Executor that runs the asynchronous calls for this reader,
+        it is started on first use."""
+        self._executor_lock.acquire()
+        try:
+            if self._executor is None:
+                self._executor = Reader_Executor(self.name)
+            return self._executor
+        finally:
+            self._executor_lock.release()
+    
+    def stop_executor(self):
+        "Stop the executor thread (after all jobs submitted so far)"
+        self._executor_lock.acquire()
+        try:
+            executor, self._executor = self._executor, None
+        finally:
+            self._executor_lock.release()
+        if executor is not None:
+            executor.stop()
+    
+    def run_async(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) in the executor thread of this reader and return a
+        ReaderJob. All asynchronous calls for one reader are run one after the other, in the
+        order they were made, so they must not be mixed with synchronous calls in other threads."""
+        job = ReaderJob(function, *args, **kwargs)
+        self.get_executor().submit(job)
+        return job
+    
+    def transceive_async(self, data):
+        "Like transceive(), but returns a ReaderJob, see run_async()"
+        return self.run_async(self.transceive, data)
 
 class PCSC_Reader(Smartcard_Reader):
     def __init__(self, reader):
+        Smartcard_Reader.__init__(self)
         self._reader = reader
         self._name = str(reader)
         self._cardservice = None
+        self._connection_state = None
+        self._context = None
     
     name = property(lambda self: self._name, None, None, "The human readable name of the reader")
     
+    ## Longest single SCardGetStatusChange call in milliseconds, bounds the time that a
+    ## cancel_connect() which comes in just before the call starts can go unnoticed
+    MAX_STATUS_WAIT = 1000
+    
     def list_readers(cls):
         try:
             return [ (str(r), cls(r)) for r in smartcard.System.readers() ]
@@ -69,9 +176,84 @@ class PCSC_Reader(Smartcard_Reader):
             return []
     list_readers = classmethod(list_readers)
     
-    def _internal_connect(self):
+    def _get_context(self):
+        "Return the PC/SC context used to wait for status changes of this reader"
+        if self._context is None:
+            hresult, self._context = smartcard.scard.SCardEstablishContext(smartcard.scard.SCARD_SCOPE_USER)
+            if hresult != smartcard.scard.SCARD_S_SUCCESS:
+                self._context = None
+                raise IOError, "Couldn't establish PC/SC context: %s" % smartcard.scard.SCardGetErrorMessage(hresult)
+        return self._context
+    
+    def _release_context(self):
+        context, self._context = self._context, None
+        if context is not None:
+            smartcard.scard.SCardReleaseContext(context)
+    
+    def __del__(self):
+        try:
+            self._release_context()
+        except:
+            pass ## smartcard may already be gone at interpreter shutdown
+    
+    def _wait_for_card(self, timeout, after_change = False):
+        """Block until there is a responsive card in the reader, using SCardGetStatusChange.
+        If after_change is set the reader state must change first (e.g. after a mute card).
+        Returns False if timeout (seconds, None for no limit) has passed or the
+        wait has been cancelled."""
+        scard = smartcard.scard
+        hcontext = self._get_context()
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        state = scard.SCARD_STATE_UNAWARE
+        first = True
+        
+        while not self._cancel_event.isSet():
+            if first:
+                wait = 0 ## Just get the current state
+            elif deadline is None:
+                wait = self.MAX_STATUS_WAIT
+            else:
+                wait = min(int(_remaining(deadline) * 1000), self.MAX_STATUS_WAIT)
+            
+            hresult, states = scard.SCardGetStatusChange(hcontext, wait, [(self._name, state)])
+            if hresult == scard.SCARD_E_CANCELLED:
+                if not first:
+                    return False
+            elif hresult == scard.SCARD_E_TIMEOUT:
+                pass ## Check for cancellation and the deadline, then wait again
+            elif hresult != scard.SCARD_S_SUCCESS:
+                raise IOError, "Couldn't get reader status: %s" % scard.SCardGetErrorMessage(hresult)
+            else:
+                state = states[0][1] & ~scard.SCARD_STATE_CHANGED
+                if state & scard.SCARD_STATE_PRESENT and not state & scard.SCARD_STATE_MUTE \
+                        and not (first and after_change):
+                    return True
+            
+            if not first and _remaining(deadline) == 0:
+                return False
+            first = False
+        
+        return False
+    
+    def cancel_connect(self):
+        Smartcard_Reader.cancel_connect(self)
+        context = self._context
+        if context is not None:
+            smartcard.scard.SCardCancel(context)
+    
+    def _internal_connect(self, deadline = None):
         unpatched = False
+        after_change = False
         while True:
+            if not self._wait_for_card(0, after_change):
+                yield self._CONNECT_NO_CARD
+                if not self._wait_for_card(_remaining(deadline), after_change):
+                    yield self._CONNECT_NO_CARD
+                    continue
+            after_change = False
+            
             try:
                 if not unpatched:
                     cardrequest = smartcard.CardRequest.CardRequest( readers=[self._reader], timeout=0.1 )
@@ -80,6 +262,7 @@ class PCSC_Reader(Smartcard_Reader):
                 
                 self._cardservice = cardrequest.waitforcard()
                 self._cardservice.connection.connect()
+                self.invalidate_connection_state()
                 del cardrequest
                 yield self._CONNECT_DONE
             except TypeError:
@@ -94,33 +277,75 @@ class PCSC_Reader(Smartcard_Reader):
             except smartcard.Exceptions.CardRequestTimeoutException:
                 yield self._CONNECT_NO_CARD
             except smartcard.Exceptions.NoCardException:
+                after_change = True
                 yield self._CONNECT_MUTE_CARD
             except smartcard.Exceptions.CardConnectionException:
+                after_change = True
                 yield self._CONNECT_MUTE_CARD
     
-    def get_ATR(self):
-        return smartcard.util.toASCIIString(self._cardservice.connection.getATR())
-    
-    def get_protocol(self):
-        hresult, reader, state, protocol, atr = smartcard.scard.SCardStatus( self._cardservice.connection.component.hcard )
-        return ((protocol == smartcard.scard.SCARD_PROTOCOL_T0) and (0,) or (1,))[0]
-
     PROTOMAP = {
         0: smartcard.scard.SCARD_PCI_T0,
         1: smartcard.scard.SCARD_PCI_T1,
     }
     
+    def invalidate_connection_state(self):
+        """Forget the cached protocol, PCI structure and ATR. Must be called whenever
+        the card has been (re)connected or reset."""
+        self._connection_state = None
+    
+    def _get_connection_state(self):
+        "Return (protocol, PCI structure, ATR) of the current connection, these are only queried once"
+        if self._connection_state is None:
+            connection = self._cardservice.connection
+            hresult, reader, state, protocol, atr = smartcard.scard.SCardStatus( connection.component.hcard )
+            protocol = ((protocol == smartcard.scard.SCARD_PROTOCOL_T0) and (0,) or (1,))[0]
+            self._connection_state = (protocol, self.PROTOMAP[protocol], str(bytearray(connection.getATR())))
+        return self._connection_state
+    
+    def get_ATR(self):
+        return self._get_connection_state()[2]
+    
+    def get_protocol(self):
+        return self._get_connection_state()[0]
+    
+    def supports_extended_length(self):
+        ## T=1 transports APDUs of any length, T=0 would need ENVELOPE
+        return self.get_protocol() == 1
+    
     def transceive(self, data):
-        data_bytes = map(lambda x: ord(x), data)
-        data, sw1, sw2 = self._cardservice.connection.transmit(data_bytes, protocol=self.PROTOMAP[self.get_protocol()])
-        result_binary = map(lambda x: chr(x), data + [sw1,sw2])
-        return result_binary
+        data, sw1, sw2 = self._cardservice.connection.transmit(list(bytearray(data)), protocol=self._get_connection_state()[1])
+        data.append(sw1)
+        data.append(sw2)
+        return str(bytearray(data))
     
     def disconnect(self):
+        ## The context for waiting is established again by the next connect()
+        self._release_context()
         self._cardservice.connection.disconnect()
         del self._cardservice
         self._cardservice = None
+        self.invalidate_connection_state()
+    
+class ACR122_Target(object):
+    """A target found by ACR122_Reader.pn532_inventory(). state is a dictionary in which
+    the caller can keep per-target session state, it is kept across inventories for as
+    long as the card stays in the field."""
+    def __init__(self, type, number, target):
+        self.type = type        ## Baud rate/modulation type it was listed with
+        self.number = number    ## Logical target number (Tg) in the PN532
+        self.target = target    ## The utils.PN532_Target
+        self.state = {}
     
+    def get_uid(self):
+        "Return the UID (type A) or PUPI (type B) as a binary string"
+        if self.target.type == utils.PN532_Target.TYPE_ISO14443B:
+            return "".join(map(chr, self.target.atqb[1:5]))
+        return "".join(map(chr, self.target.nfcid))
+    uid = property(get_uid)
+    
+    def __repr__(self):
+        return "<ACR122_Target %s Tg=%s UID=%s>" % (self.target.type, self.number, binascii.b2a_hex(self.uid).upper())
+
 class ACR122_Reader(Smartcard_Reader):
     """This class implements ISO 14443-4 access through the
     PN532 in an ACR122 reader with firmware version 1.x"""
@@ -137,62 +362,249 @@ class ACR122_Reader(Smartcard_Reader):
     name = property(lambda self: self._name, None, None, "The human readable name of the reader")
     
     def __init__(self, parent):
+        Smartcard_Reader.__init__(self)
         self._parent = parent
         self._name = self._parent.name+"-RFID"
         self._current_target = None
         self._current_target_number = 0
+        self._current = None
+        self._targets = []
+        self._listed_type = None
+        self._selected_number = None
+        self._last_target_type = None
+        self._field_reset_needed = True
     
-    def pn532_transceive_raw(self, command):
-        c_apdu = "\xff\x00\x00\x00" + chr(len(command)) + command
+    def _direct_transmit(self, c_apdu):
+        "Send a direct transmit pseudo-APDU to the parent reader, fetch the response if it answers 61xx"
         r_apdu = self._parent.transceive(c_apdu)
         
         if len(r_apdu) == 2 and r_apdu[0] == "\x61":
-            c_apdu = "\xff\xc0\x00\x00" + r_apdu[1]
-            r_apdu = self._parent.transceive(c_apdu)
+            r_apdu = self._parent.transceive("\xff\xc0\x00\x00" + r_apdu[1])
         
         return r_apdu
     
+    def pn532_transceive_raw(self, command):
+        return self._direct_transmit("\xff\x00\x00\x00" + chr(len(command)) + command)
+    
     def pn532_transceive(self, command):
         response = self.pn532_transceive_raw(command)
         
-        if len(response) < 2 or response[-2:] != ["\x90", "\x00"]:
+        if len(response) < 2 or response[-2:] != "\x90\x00":
             raise IOError, "Couldn't communicate with PN532"
         
         if not (response[0] == "\xd5" and ord(response[1]) == ord(command[1])+1 ): 
             raise IOError, "Wrong response from PN532"
         
-        return "".join(response[:-2])
+        return response[:-2]
     
-    def pn532_acquire_card(self):
-        # Turn antenna power off and on to forcefully reinitialize the card
+    ## InListPassiveTarget initiator data by baud rate/modulation type: 106 kbps type A and type B
+    LIST_PASSIVE_TARGET = {
+        0x00: "",
+        0x03: "\x00",
+    }
+    
+    ## The PN532 can handle at most this many targets at the same time
+    MAX_TARGETS = 2
+    
+    ## Try to reactivate the last target with InDeselect/InSelect before searching for a new one.
+    ## If False, the field is cycled and the targets are listed on every connect.
+    REACTIVATE_TARGET = True
+    
+    def _pn532_status_ok(response):
+        "Return True if the status byte of an In* response signals success"
+        return len(response) > 2 and ord(response[2]) & 0x3f == 0
+    _pn532_status_ok = staticmethod(_pn532_status_ok)
+    
+    def _polling_order(self):
+        "Return the target types to list, the type that was seen last first"
+        types = self.LIST_PASSIVE_TARGET.keys()
+        types.sort()
+        if self._last_target_type in types:
+            types.remove(self._last_target_type)
+            types.insert(0, self._last_target_type)
+        return types
+    
+    def _pn532_list_targets(self, type, max_targets):
+        """Send InListPassiveTarget for one type, return the ACR122_Targets found. The PN532
+        forgets all targets it knew before, the first new one is selected."""
+        response = self.pn532_transceive("\xd4\x4a" + chr(max_targets) + chr(type) + self.LIST_PASSIVE_TARGET[type])
+        r = utils.PN532_Frame(response)
+        r.parse_result(type)
+        
+        self._listed_type = type
+        self._selected_number = None
+        targets = [ ACR122_Target(type, number, target) for number, target in sorted(r.targets.items()) ]
+        if targets:
+            self._selected_number = targets[0].number
+        return targets
+    
+    def _set_current(self, target):
+        self._current = target
+        if target is None:
+            self._current_target, self._current_target_number = None, 0
+        else:
+            self._current_target, self._current_target_number = target.target, target.number
+            self._last_target_type = target.type
+    
+    def pn532_target_present(self):
+        """Check whether the current target is still in the field, with the presence
+        detection of the PN532 Diagnose command. Does not change the state of the target.
+        This is much cheaper than InDeselect/InSelect on a target that has gone away."""
+        if self._current_target is None:
+            return False
+        try:
+            response = self.pn532_transceive("\xd4\x00\x06")
+        except IOError:
+            return False
+        return response[2:3] == "\x00"
+    
+    def pn532_reactivate_target(self):
+        """Deselect and select the current target again, which starts a new
+        ISO 14443-4 session without switching the field off. Returns False
+        if the target does not answer."""
+        if self._current_target is None:
+            return False
+        tg = chr(self._current_target_number)
+        try:
+            self.pn532_transceive("\xd4\x44" + tg)
+            if not self._pn532_status_ok( self.pn532_transceive("\xd4\x54" + tg) ):
+                return False
+        except IOError:
+            return False
+        self._selected_number = self._current_target_number
+        return True
+    
+    def pn532_reset_field(self):
+        "Turn antenna power off and on to forcefully reinitialize all cards in the field"
         self.pn532_transceive("\xd4\x32\x01\x00")
         self.pn532_transceive("\xd4\x32\x01\x01")
+        self._field_reset_needed = False
+        self._listed_type = None
+        self._selected_number = None
+    
+    def pn532_acquire_card(self):
+        """Establish a session with a card. The last target is reactivated if the presence check
+        finds it still there. Otherwise the field is cycled (only if a card may have been left in
+        a halted state, not on every poll) and targets are listed, starting with the type that
+        was seen last."""
+        if self.REACTIVATE_TARGET and self._current_target is not None:
+            if self.pn532_target_present() and self.pn532_reactivate_target():
+                return True
+            self._set_current(None)
+            self._field_reset_needed = True
+        
+        if self._field_reset_needed or not self.REACTIVATE_TARGET:
+            self.pn532_reset_field()
         
         self._last_ats = []
         
-        response = self.pn532_transceive("\xd4\x4a\x01\x00")
-        r = utils.PN532_Frame(response)
-        r.parse_result(0)
-        if len(r.targets) > 0:
-            self._current_target_number, self._current_target = r.targets.items()[0]
-            return True
-        else:
-            response = self.pn532_transceive("\xd4\x4a\x01\x03\x00")
-            r = utils.PN532_Frame(response)
-            r.parse_result(3)
-            if len(r.targets) > 0:
-                self._current_target_number, self._current_target = r.targets.items()[0]
+        for type in self._polling_order():
+            targets = self._pn532_list_targets(type, 1)
+            if targets:
+                self._targets = self._merge_inventory(targets)
+                self._set_current(targets[0])
                 return True
+        return False
     
-    def _internal_connect(self):
-        self._parent.connect()
+    def _merge_inventory(self, found):
+        "Carry the session state of known targets over to the same cards in a new inventory"
+        known = dict([ (target.uid, target) for target in self._targets ])
+        for target in found:
+            if target.uid in known:
+                target.state = known[target.uid].state
+        return found
+    
+    def pn532_inventory(self, types = None):
+        """List all targets in the field: up to MAX_TARGETS of each type in types (all types in
+        LIST_PASSIVE_TARGET if None). Targets that were in the last inventory keep their state.
+        The first target found becomes the current target. Returns the list of ACR122_Targets."""
+        if types is None:
+            types = self._polling_order()
+        
+        ## List the first type last: the PN532 then still knows its targets, and as they come
+        ## first in the result they can be selected without listing them again
+        by_type = {}
+        for type in reversed(types):
+            by_type[type] = self._pn532_list_targets(type, self.MAX_TARGETS)
+        
+        found = []
+        for type in types:
+            found.extend(by_type[type])
+        
+        self._targets = self._merge_inventory(found)
+        if found:
+            self.pn532_select_target(found[0])
+        else:
+            self._set_current(None)
+        return list(self._targets)
+    
+    def get_targets(self):
+        "Return the ACR122_Targets from the last inventory"
+        return list(self._targets)
+    
+    def pn532_select_target(self, target):
+        """Make target (an ACR122_Target from the inventory) the current target, so that
+        transceive() talks to it. Raises IOError if it can't be selected."""
+        if target.type != self._listed_type:
+            ## The PN532 only knows the targets of the type that was listed last, list this type again
+            listed = dict([ (t.uid, t) for t in self._pn532_list_targets(target.type, self.MAX_TARGETS) ])
+            for t in self._targets:
+                if t.type == target.type:
+                    if t.uid in listed:
+                        t.number, t.target = listed[t.uid].number, listed[t.uid].target
+                    else:
+                        t.number = None
+        
+        if target.number is None:
+            raise IOError, "Target %s is no longer in the field" % binascii.b2a_hex(target.uid).upper()
+        
+        if target.number != self._selected_number:
+            if not self._pn532_status_ok( self.pn532_transceive("\xd4\x54" + chr(target.number)) ):
+                raise IOError, "Couldn't select target %s" % binascii.b2a_hex(target.uid).upper()
+            self._selected_number = target.number
+        
+        self._set_current(target)
+    
+    def process_all_targets(self, function, *args, **kwargs):
+        """Take an inventory and call function(reader, target, *args, **kwargs) for every
+        target in the field, with that target selected. Returns a list of finished
+        ReaderJobs, one per target, an exception for one target does not stop the others."""
+        jobs = []
+        for target in self.pn532_inventory():
+            job = ReaderJob(function, target, *args, **kwargs)
+            job.reader_name = self.name
+            try:
+                self.pn532_select_target(target)
+            except IOError, e:
+                job.set_exception(e)
+            else:
+                job.run(self)
+            jobs.append(job)
+        return jobs
+    
+    ## The PN532 can't signal a card in the field through PC/SC, so it must be polled.
+    ## Seconds between two polls:
+    POLL_INTERVAL = 0.2
+    
+    def cancel_connect(self):
+        Smartcard_Reader.cancel_connect(self)
+        self._parent.cancel_connect()
+    
+    def _internal_connect(self, deadline = None):
+        if not self._parent.connect(_remaining(deadline)):
+            yield self._CONNECT_NO_CARD
+            return
+        
         self.pn532_transceive("\xd4\x32\x05\x00\x00\x00")
         while True:
             if self.pn532_acquire_card():
                 yield self._CONNECT_DONE
             else:
                 yield self._CONNECT_NO_CARD
-                time.sleep(1)
+                interval = self.POLL_INTERVAL
+                if deadline is not None:
+                    interval = min(interval, _remaining(deadline))
+                self._cancel_event.wait(interval)
     
     @staticmethod
     def _extract_historical_bytes_from_ats(ats):
@@ -234,68 +646,223 @@ class ACR122_Reader(Smartcard_Reader):
         return "".join(map(chr, atr))
 
 
+    def _pseudo_get_data(self, data):
+        "Handle the PC/SC GET DATA pseudo-APDU (FF CA): UID/PUPI (P1=00) or ATS historical bytes (P1=01)"
+        if len(data) == 4:
+            le = None
+        elif len(data) == 5:
+            le = ord(data[4])
+        else:
+            return None
+        
+        p1 = data[2]
+        target = self._current_target
+        if target is None:
+            return "\x6a\x81"
+        elif p1 == "\x00" and target.type == utils.PN532_Target.TYPE_ISO14443A:
+            result = target.nfcid
+        elif p1 == "\x00" and target.type == utils.PN532_Target.TYPE_ISO14443B:
+            result = target.atqb[1:5]
+        elif p1 == "\x01" and target.type == utils.PN532_Target.TYPE_ISO14443A:
+            result = self._extract_historical_bytes_from_ats(target.ats)
+        else:
+            return "\x6a\x81"
+        
+        if le == 0 or le == len(result):
+            return "".join(map(chr, result)) + "\x90\x00"
+        elif le is None or le < len(result):
+            return "\x6c" + chr(len(result))
+        else:
+            return "".join(map(chr, result)) + "\x00" * (le - len(result)) + "\x62\x82"
+    
+    ## Pseudo-APDUs that are answered by the reader instead of the card, by their CLA and INS
+    ## bytes. The handler returns the response, or None to send the command to the card after all.
+    PSEUDO_APDUS = {
+        "\xff\xca": _pseudo_get_data,
+    }
+    
     def transceive(self, data):
-        try:
-            command = utils.C_APDU(data)
-            result = []
-            error = None
-            response = None
-            
-            if command.cla == 0xff and command.ins == 0xca:
-                if command.p1 == 0x00: 
-                    # Get UID/PUPI
-                    if self._current_target is None: 
-                        error = "\x6a\x81"
-                    elif self._current_target.type == utils.PN532_Target.TYPE_ISO14443A:
-                        result = self._current_target.nfcid
-                    elif self._current_target.type == utils.PN532_Target.TYPE_ISO14443B:
-                        result = self._current_target.atqb[1:5]
-                    else:
-                        error = "\x6a\x81"
-                
-                elif command.p1 == 0x01:
-                    # Get ATS historical bytes
-                    if self._current_target is None: 
-                        error = "\x6a\x81"
-                    elif self._current_target.type == utils.PN532_Target.TYPE_ISO14443A:
-                        ats = self._current_target.ats
-                        result = self._extract_historical_bytes_from_ats(ats)
-                    else:
-                        error = "\x6a\x81"
-                
-                else:
-                    error = "\x6a\x81"
-                
-                if error is not None:
-                    response = utils.R_APDU(error)
-                else:
-                    if command.le is 0 or command.le == len(result):
-                        response = utils.R_APDU(data=result, sw1=0x90, sw2=0)
-                    elif command.le < len(result):
-                        response = utils.R_APDU(sw1=0x6c, sw2=len(result))
-                    elif command.le > len(result):
-                        response = utils.R_APDU(data=result + [0] * (command.le-len(result)),
-                            sw1=0x62, sw2=0x82)
-                
-                if response is not None:
-                    return response.render()
-        except:
-            # Just go on and try to process the data normally
-            pass
+        handler = self.PSEUDO_APDUS.get(data[:2], None)
+        if handler is not None:
+            response = handler(self, data)
+            if response is not None:
+                return response
         
-        response = self.pn532_transceive("\xd4\x40" + chr(self._current_target_number) + data)
+        ## InDataExchange, wrapped in a direct transmit pseudo-APDU
+        response = self._direct_transmit("\xff\x00\x00\x00%c\xd4\x40%c%s" % (len(data) + 3, self._current_target_number, data))
+        
+        if len(response) < 2 or response[-2:] != "\x90\x00":
+            raise IOError, "Couldn't communicate with PN532"
+        if response[:2] != "\xd5\x41" or len(response) < 5:
+            raise IOError, "Wrong response from PN532"
         if response[2] != "\x00":
             # FIXME Proper error processing
             raise IOError, "Error while transceiving"
-        return response[3:]
+        return response[3:-2]
 
+    def get_wrapped_names(self):
+        return [self._parent.name]
+    
     def disconnect(self):
         self._parent.disconnect()
 
+class Emulated_Reader(Smartcard_Reader):
+    """A reader with a card_emulator.Emulated_Card that is always present.
+    list_readers() shows one of these for each card that has been registered
+    with add_card() and for each JSON spec file named in the environment
+    variable CYBERFLEX_EMULATED_CARDS (separated by os.pathsep)."""
+    ENVIRONMENT_VARIABLE = "CYBERFLEX_EMULATED_CARDS"
+    _cards = []
+    
+    def add_card(cls, card):
+        "Register an Emulated_Card (or the file name of a JSON spec) to be listed by list_readers()"
+        if isinstance(card, basestring):
+            card = card_emulator.load_card(card)
+        cls._cards.append(card)
+        return card
+    add_card = classmethod(add_card)
+    
+    def list_readers(cls):
+        cards = list(cls._cards)
+        for filename in os.environ.get(cls.ENVIRONMENT_VARIABLE, "").split(os.pathsep):
+            if filename:
+                cards.append( card_emulator.load_card(filename) )
+        
+        readers = []
+        for card in cards:
+            reader = cls(card)
+            readers.append( (reader.name, reader) )
+        return readers
+    list_readers = classmethod(list_readers)
+    
+    name = property(lambda self: self._name, None, None, "The human readable name of the reader")
+    card = property(lambda self: self._card, None, None, "The Emulated_Card in this reader")
+    
+    def __init__(self, card):
+        Smartcard_Reader.__init__(self)
+        self._card = card
+        self._name = "Emulator: %s" % card.name
+        self._connected = False
+    
+    def _internal_connect(self, deadline = None):
+        self._card.reset()
+        self._connected = True
+        yield self._CONNECT_DONE
+    
+    def get_ATR(self):
+        return self._card.get_ATR()
+    
+    def get_protocol(self):
+        return self._card.protocol
+    
+    def supports_extended_length(self):
+        return self._card.extended_length
+    
+    def transceive(self, data):
+        if not self._connected:
+            raise smartcard.Exceptions.CardConnectionException, "Not connected to the emulated card"
+        return self._card.transceive(data)
+    
+    def disconnect(self):
+        self._connected = False
+
+class Recording_Reader(Smartcard_Reader):
+    """Wraps another reader and writes everything that goes through it to a
+    binary trace file (see apdu_trace). All other attributes are taken from
+    the wrapped reader."""
+    def __init__(self, reader, target):
+        Smartcard_Reader.__init__(self)
+        self._reader = reader
+        self._writer = apdu_trace.Trace_Writer(target)
+    
+    name = property(lambda self: self._reader.name, None, None, "The human readable name of the reader")
+    
+    def __getattr__(self, name):
+        if name == "_reader":
+            raise AttributeError, name
+        return getattr(self._reader, name)
+    
+    def record_atr(self):
+        "Write the ATR of the current card to the trace, connect() does this automatically"
+        self._writer.write_record(apdu_trace.RECORD_ATR, self._reader.get_ATR())
+    
+    def connect(self, timeout = None, quiet = False):
+        have_card = self._reader.connect(timeout, quiet)
+        if have_card:
+            self.record_atr()
+        return have_card
+    
+    def connect_async(self, callback, timeout = None):
+        def connected(reader, have_card):
+            if have_card:
+                self.record_atr()
+            callback(self, have_card)
+        return self._reader.connect_async(connected, timeout)
+    
+    def cancel_connect(self):
+        self._reader.cancel_connect()
+    
+    def get_ATR(self):
+        return self._reader.get_ATR()
+    
+    def supports_extended_length(self):
+        return self._reader.supports_extended_length()
+    
+    def transceive(self, data):
+        self._writer.write_record(apdu_trace.RECORD_COMMAND, data)
+        try:
+            response = self._reader.transceive(data)
+        except Exception, e:
+            self._writer.write_record(apdu_trace.RECORD_ERROR, str(e))
+            raise
+        self._writer.write_record(apdu_trace.RECORD_RESPONSE, response)
+        return response
+    
+    def disconnect(self):
+        self._writer.flush()
+        self._reader.disconnect()
+    
+    def close(self):
+        "Close the trace file"
+        self._writer.close()
+
+class Replay_Reader(Smartcard_Reader):
+    """A reader that answers from a trace file written by Recording_Reader,
+    without any delay. policies and default_policy control how commands are
+    matched against the trace, see apdu_trace.Trace_Replayer."""
+    def __init__(self, source, policies = None, default_policy = apdu_trace.MATCH_STRICT):
+        Smartcard_Reader.__init__(self)
+        self._replayer = apdu_trace.Trace_Replayer(source, policies, default_policy)
+        self._name = "Replay"
+        if isinstance(source, basestring):
+            self._name = "Replay: %s" % source
+    
+    name = property(lambda self: self._name, None, None, "The human readable name of the reader")
+    trace = property(lambda self: self._replayer.trace, None, None, "The apdu_trace.Trace that is replayed")
+    
+    def _internal_connect(self, deadline = None):
+        self._replayer.reset()
+        yield self._CONNECT_DONE
+    
+    def get_ATR(self):
+        if not self.trace.atrs:
+            return ""
+        return self.trace.atrs[0]
+    
+    def supports_extended_length(self):
+        return self.trace.has_extended_length()
+    
+    def transceive(self, data):
+        return self._replayer.transceive(data)
+    
+    def disconnect(self):
+        pass
+
 def list_readers():
     "Collect readers from all known drivers"
     readers = PCSC_Reader.list_readers()
     readers.extend( ACR122_Reader.list_readers() )
+    readers.extend( Emulated_Reader.list_readers() )
     return readers
 
 def connect_to(reader):
@@ -308,7 +875,7 @@ def connect_to(reader):
         reader = int(reader)
         readerObject = readers[reader][1]
     else:
-        for i, name, obj in readers:
+        for name, obj in readers:
             if str(name).startswith(reader):
                 readerObject = obj
     
@@ -322,19 +889,342 @@ def connect_to(reader):
     print "ATR:          %s" % utils.hexdump(readerObject.get_ATR(), short = True)
     return readerObject
 
+class ReaderJob(object):
+    """A piece of work that is run in another thread, e.g. by a ReaderPool. This is
+    a future: result() waits for the job to finish and then returns its result or
+    raises its exception."""
+    
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.reader_name = None ## Name of the reader that ran the job
+        self.attempts = 0
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    def _execute(self, *args):
+        "Run the function (the args are prepended to the job's own), return (result, exception)"
+        self.attempts = self.attempts + 1
+        try:
+            return self.function(*(args + self.args), **self.kwargs), None
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            return None, sys.exc_info()[1]
+    
+    def run(self, *args):
+        "Run the job (the args are prepended to the job's own) and record the result"
+        result, exception = self._execute(*args)
+        if exception is not None:
+            self.set_exception(exception)
+        else:
+            self.set_result(result)
+    
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+    
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+    
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+    
+    def add_done_callback(self, callback):
+        """Call callback(job) when the job is done (immediately if it already is). Note that
+        the callback is usually called from the thread that ran the job."""
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+    
+    def done(self):
+        return self._done.isSet()
+    
+    def exception(self, timeout = None):
+        "Wait for the job and return its exception, or None if it was successful"
+        if not self._done.wait(timeout) and not self._done.isSet():
+            raise RuntimeError, "Job not finished after %s seconds" % timeout
+        return self._exception
+    
+    def result(self, timeout = None):
+        "Wait for the job and return its result (or raise its exception)"
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+def wait_all(jobs, timeout = None):
+    """Wait for all jobs (ReaderJob objects) and return the list of their results. Raises
+    the exception of the first failed job."""
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    return [job.result(_remaining(deadline)) for job in jobs]
+
+class Reader_Executor(threading.Thread):
+    "Runs ReaderJobs one after the other, in the order they were submitted, in a thread of its own"
+    
+    def __init__(self, name):
+        threading.Thread.__init__(self, name = "Reader_Executor %s" % name)
+        self.setDaemon(True)
+        self._jobs = Queue.Queue()
+        self.start()
+    
+    def submit(self, job):
+        self._jobs.put(job)
+        return job
+    
+    def stop(self):
+        self._jobs.put(None)
+    
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            job.run()
+
+class _Reader_Worker(threading.Thread):
+    "The thread that serves one reader of a ReaderPool"
+    
+    def __init__(self, pool, name, reader):
+        threading.Thread.__init__(self, name = "ReaderPool %s" % name)
+        self.setDaemon(True)
+        self.pool = pool
+        self.reader_name = name
+        self.reader = reader
+        self.card = None
+        
+        self.jobs = 0
+        self.errors = 0
+        self.apdus = 0
+        self.cards = 0
+        self.busy_time = 0.0
+    
+    def _drop_card(self):
+        card, self.card = self.card, None
+        try:
+            card.close_card()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            pass
+    
+    def run(self):
+        closed = self.pool._closed
+        while not closed.isSet():
+            if self.card is None and not self._get_card():
+                continue
+            
+            job = self.pool._jobs.get()
+            if job is None:
+                break
+            
+            job.reader_name = self.reader_name
+            apdus_before = getattr(self.card, "_i", 0)
+            start = time.time()
+            result, exception = job._execute(self.card)
+            self.busy_time = self.busy_time + (time.time() - start)
+            self.apdus = self.apdus + getattr(self.card, "_i", 0) - apdus_before
+            self.jobs = self.jobs + 1
+            
+            if exception is None:
+                job.set_result(result)
+                continue
+            
+            self.errors = self.errors + 1
+            if isinstance(exception, (IOError, smartcard.Exceptions.CardConnectionException)):
+                ## Card is probably gone, let another reader retry the job
+                self._drop_card()
+                if job.attempts < self.pool.MAX_ATTEMPTS and self.pool._enqueue(job):
+                    continue
+            job.set_exception(exception)
+        
+        if self.card is not None:
+            self._drop_card()
+    
+    def _get_card(self):
+        "Wait for a card and create the card object, returns False if there is none (yet)"
+        closed = self.pool._closed
+        try:
+            if not self.reader.connect(quiet = True):
+                return False
+            if closed.isSet():
+                self.reader.disconnect()
+                return False
+            self.card = self.pool.card_factory(self.reader)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            ## E.g. the reader was unplugged, don't let the worker die but try again later
+            self.errors = self.errors + 1
+            try:
+                self.reader.disconnect()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                pass
+            closed.wait(self.pool.RETRY_DELAY)
+            return False
+        self.cards = self.cards + 1
+        return True
+
+class ReaderPool(object):
+    """Opens all readers (or those whose names start with one of the given prefixes) and
+    runs one worker thread per reader. The readers are taken from list_readers(), or from
+    readers (a list of (name, reader) tuples) if given. A reader that another one wraps
+    (e.g. the PC/SC reader of an ACR122) is skipped, the wrapping reader is used instead.
+    Each worker waits for a card in its reader and creates a card object for it with
+    card_factory (cards.new_card_object by default).
+    Jobs submitted with submit() are run by whichever reader has a card and is free."""
+    
+    ## How often a job is tried if it fails because the card went away
+    MAX_ATTEMPTS = 2
+    ## Seconds to wait before connecting again after a reader failed
+    RETRY_DELAY = 1
+    
+    def __init__(self, reader_names = None, card_factory = None, readers = None):
+        if card_factory is None:
+            import cards
+            card_factory = cards.new_card_object
+        self.card_factory = card_factory
+        self._jobs = Queue.Queue()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        
+        if readers is None:
+            readers = list_readers()
+        wrapped = {}
+        for name, reader in readers:
+            for wrapped_name in reader.get_wrapped_names():
+                wrapped[wrapped_name] = True
+        
+        self.workers = []
+        for name, reader in readers:
+            if wrapped.has_key(name):
+                continue
+            if reader_names is not None and not [prefix for prefix in reader_names if name.startswith(prefix)]:
+                continue
+            self.workers.append( _Reader_Worker(self, name, reader) )
+        
+        for worker in self.workers:
+            worker.start()
+    
+    def submit(self, function, *args, **kwargs):
+        """Run function(card, *args, **kwargs) on the card in the next free reader.
+        Returns a ReaderJob."""
+        job = ReaderJob(function, *args, **kwargs)
+        if not self._enqueue(job):
+            job.set_exception(RuntimeError("The reader pool has been closed"))
+        return job
+    
+    def _enqueue(self, job):
+        "Put job into the queue, returns False (and does nothing) if the pool is closed"
+        self._lock.acquire()
+        try:
+            if self._closed.isSet():
+                return False
+            self._jobs.put(job)
+            return True
+        finally:
+            self._lock.release()
+    
+    def map(self, function, iterable):
+        "Submit function(card, item) for each item, returns the list of ReaderJobs"
+        return [self.submit(function, item) for item in iterable]
+    
+    def stats(self):
+        """Return a list with a dictionary of statistics for each reader: name, cards,
+        jobs, errors, apdus, busy_time (in seconds) and throughput (jobs per second
+        since the pool was started)."""
+        elapsed = max(time.time() - self._start_time, 1e-6)
+        return [ {
+                "name": worker.reader_name,
+                "cards": worker.cards,
+                "jobs": worker.jobs,
+                "errors": worker.errors,
+                "apdus": worker.apdus,
+                "busy_time": worker.busy_time,
+                "throughput": worker.jobs / elapsed,
+            } for worker in self.workers ]
+    
+    def print_stats(self):
+        print "%-40s %6s %6s %6s %8s %9s" % ("Reader", "Cards", "Jobs", "Errors", "APDUs", "Jobs/s")
+        for entry in self.stats():
+            print "%(name)-40s %(cards)6i %(jobs)6i %(errors)6i %(apdus)8i %(throughput)9.2f" % entry
+    
+    def close(self, timeout = 5):
+        """Stop all workers (after their current job) and disconnect the cards. Waits at most
+        timeout seconds (None for no limit), returns False if a worker is still running then.
+        Jobs that have not been started yet fail with a RuntimeError."""
+        self._lock.acquire()
+        try:
+            self._closed.set()
+            pending = []
+            while True:
+                try:
+                    pending.append(self._jobs.get_nowait())
+                except Queue.Empty:
+                    break
+        finally:
+            self._lock.release()
+        for job in pending:
+            if job is not None: ## close() may be called twice
+                job.set_exception(RuntimeError("The reader pool has been closed"))
+        
+        for worker in self.workers:
+            worker.reader.cancel_connect()
+            self._jobs.put(None)
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(_remaining(deadline))
+        return not [worker for worker in self.workers if worker.isAlive()]
+
 class CommandLineArgumentHelper:
     OPTIONS = "r:l"
-    LONG_OPTIONS = ["reader=", "list-readers"]
+    LONG_OPTIONS = ["reader=", "list-readers", "emulate=", "record=", "replay="]
     exit_now = False
     reader = None
+    record = None
+    replay = None
     
     def connect(self):
         "Open the connection to a card"
         
-        if self.reader is None:
-            self.reader = 0
+        if self.replay is not None:
+            readerObject = Replay_Reader(self.replay)
+            readerObject.connect()
+        else:
+            if self.reader is None:
+                self.reader = 0
+            readerObject = connect_to(self.reader)
+        
+        if self.record is not None:
+            readerObject = Recording_Reader(readerObject, self.record)
+            readerObject.record_atr()
         
-        return connect_to(self.reader)
+        return readerObject
     
     def getopt(self, argv, opts="", long_opts=[]):
         "Wrapper around getopt.gnu_getopt. Handles common arguments, returns everything else."
@@ -345,6 +1235,14 @@ class CommandLineArgumentHelper:
         for (option, value) in options:
             if option in ("-r","--reader"):
                 self.reader = value
+            elif option in ("--record",):
+                self.record = value
+            elif option in ("--replay",):
+                self.replay = value
+            elif option in ("--emulate",):
+                card = Emulated_Reader.add_card(value)
+                if self.reader is None:
+                    self.reader = Emulated_Reader(card).name
             elif option in ("-l","--list-readers"):
                 for i, (name, obj) in enumerate(list_readers()):
                     print "%i: %s" % (i,name)
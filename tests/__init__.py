@@ -1 +1,6 @@
 from utilstest import *
+from tlvtest import *
+from emulatortest import *
+from tracetest import *
+from readertest import *
+from cardtest import *
@@ -0,0 +1,110 @@
+"""Unit test for the APDU handling in cards/generic_card.py"""
+
+import card_emulator, utils, TLV_utils
+import unittest, binascii
+
+try:
+    import cards, cards.generic_card, cards.iso_card
+except ImportError:
+    cards = None
+
+def _b(hexstring):
+    return binascii.a2b_hex("".join(hexstring.split()))
+
+class Script(object):
+    "Answers the commands with a list of responses"
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def transceive(self, data):
+        return self.responses.pop(0)
+
+class Logging_Reader(object):
+    "Passes the commands on to target (anything with transceive()) and records them"
+    def __init__(self, target):
+        self.target = target
+        self.commands = []
+
+    def transceive(self, data):
+        self.commands.append(data)
+        return self.target.transceive(data)
+
+if cards is not None:
+    class Retry_Card(cards.iso_card.ISO_Card):
+        STATUS_MAP = dict(cards.iso_card.ISO_Card.STATUS_MAP)
+        STATUS_MAP[cards.iso_card.ISO_Card.PURPOSE_RETRY] = ("6C??", )
+        MAX_RESPONSE_ROUNDS = 3
+
+class SendWithRetryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.debug = cards.generic_card.DEBUG
+        cards.generic_card.DEBUG = False
+
+    def tearDown(self):
+        cards.generic_card.DEBUG = self.debug
+
+    def _card(self, target):
+        reader = Logging_Reader(target)
+        return Retry_Card(reader), reader
+
+    def testGetResponseRounds(self):
+        card, reader = self._card(Script([_b("01 02 61 04"), _b("03 04 05 06 61 02"), _b("07 08 90 00")]))
+        result = card.send_apdu(utils.C_APDU(_b("80 ca 00 00 00")))
+        self.assertEqual(_b("01 02 03 04 05 06 07 08"), result.data)
+        self.assertEqual("\x90\x00", result.sw)
+        self.assertEqual([_b("80 ca 00 00 00"), _b("80 c0 00 00 04"), _b("80 c0 00 00 02")], reader.commands)
+
+    def testRetry(self):
+        card, reader = self._card(Script([_b("6c 03"), _b("0a 0b 0c 90 00")]))
+        result = card.send_apdu(utils.C_APDU(_b("00 b0 00 00 00")))
+        self.assertEqual(_b("0a 0b 0c 90 00"), result.render())
+        self.assertEqual([_b("00 b0 00 00 00"), _b("00 b0 00 00 03")], reader.commands)
+
+        ## No endless loop if the card asks for the Le that was just sent
+        card, reader = self._card(Script([_b("6c 03"), _b("6c 03")]))
+        self.assertEqual(_b("6c 03"), card.send_apdu(utils.C_APDU(_b("00 b0 00 00 00"))).sw)
+        self.assertEqual(2, len(reader.commands))
+
+    def testRoundLimit(self):
+        card, reader = self._card(Script([_b("ff 61 01")] * 10))
+        self.assertRaises(IOError, card.send_apdu, utils.C_APDU(_b("00 b0 00 00 00")))
+        self.assertEqual(1 + Retry_Card.MAX_RESPONSE_ROUNDS, len(reader.commands))
+
+    def testProtocols(self):
+        select = utils.C_APDU(_b("00 a4 08 04 04 50 00 01 1e 00"))
+        spec = {"name": "Test card", "mf": {"children": [
+            {"type": "df", "fid": "5000", "children": [{"type": "ef", "fid": "011E", "data": "60 05 01 02 03 04 05"}]},
+        ]}}
+
+        card, reader = self._card(card_emulator.Emulated_Card.from_spec(spec))
+        direct = card.send_apdu(select)
+        self.assertEqual("\x90\x00", direct.sw)
+        self.assertEqual(0x62, ord(direct.data[0]))
+        self.assertEqual([select.render()], reader.commands)
+
+        spec["protocol"] = 0
+        card, reader = self._card(card_emulator.Emulated_Card.from_spec(spec))
+        self.assertEqual(direct.render(), card.send_apdu(select).render())
+        self.assertEqual(2, len(reader.commands))
+        self.assertEqual(0xc0, ord(reader.commands[1][1]))
+
+SendWithRetryTests = unittest.skipIf(cards is None, "pyscard or pycrypto is not installed")(SendWithRetryTests)
+
+class CardmultiplexerTests(unittest.TestCase):
+
+    def testMerge(self):
+        card = cards.Cardmultiplexer((cards.iso_card.ISO_Card, ), Script([]))
+        tlv_objects = card.TLV_OBJECTS
+        self.assertTrue(isinstance(tlv_objects, TLV_utils.tlv_tag_table))
+
+        ## Nothing to merge if the set of classes stays the same
+        card.add_classes([cards.iso_card.ISO_Card])
+        self.assertTrue(card.TLV_OBJECTS is tlv_objects)
+        card.add_classes([Retry_Card])
+        self.assertTrue(card.TLV_OBJECTS is not tlv_objects)
+
+CardmultiplexerTests = unittest.skipIf(cards is None, "pyscard or pycrypto is not installed")(CardmultiplexerTests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Unit test for card_emulator.py"""
+
+import card_emulator, utils
+import unittest, binascii, time
+
+def _b(hexstring):
+    return binascii.a2b_hex("".join(hexstring.split()))
+
+class EmulatedCardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = {
+            "name": "Test card",
+            "mf": {"children": [
+                {"type": "df", "fid": "5000", "name": "A0000002471001", "children": [
+                    {"type": "ef", "fid": "011E", "sfi": 30, "data": "60 05 01 02 03 04 05"},
+                    {"type": "ef", "fid": "0101", "data": "61 00", "protected": True},
+                ]},
+                {"type": "record", "fid": "2F00", "sfi": 1, "records": ["61 01 aa", "61 02 bb cc"]},
+                {"type": "ef", "fid": "2F01", "data": "00" * 300},
+            ]},
+        }
+        self.card = card_emulator.Emulated_Card.from_spec(self.spec)
+
+    def testSelectAndReadBinary(self):
+        self.assertEqual("\x90\x00", self.card.transceive(_b("00 a4 04 0c 07 a0 00 00 02 47 10 01")))
+        self.assertEqual("\x90\x00", self.card.transceive(_b("00 a4 02 0c 02 01 1e")))
+        self.assertEqual(_b("60 05 01 02 03 04 05 90 00"), self.card.transceive(_b("00 b0 00 00 00")))
+        self.assertEqual(_b("02 03 04 05 62 82"), self.card.transceive(_b("00 b0 00 03 06")))
+        self.assertEqual(_b("6b 00"), self.card.transceive(_b("00 b0 00 08 01")))
+        self.assertEqual(_b("6a 82"), self.card.transceive(_b("00 a4 02 0c 02 2f 00")))
+
+    def testSelectResponse(self):
+        response = utils.R_APDU(self.card.transceive(_b("00 a4 08 04 04 50 00 01 1e 00")))
+        self.assertEqual("\x90\x00", response.sw)
+        self.assertEqual(0x62, ord(response.data[0]))
+        self.assertTrue("\x80\x02\x00\x07" in response.data)
+        self.assertEqual(_b("60 05 90 00"), self.card.transceive(_b("00 b0 00 00 02")))
+
+    def testReadBinarySFI(self):
+        self.card.transceive(_b("00 a4 04 0c 07 a0 00 00 02 47 10 01"))
+        self.assertEqual(_b("05 90 00"), self.card.transceive(_b("00 b0 9e 06 00")))
+
+    def testReadRecord(self):
+        self.assertEqual(_b("61 02 bb cc 90 00"), self.card.transceive(_b("00 b2 02 0c 00")))
+        self.assertEqual(_b("61 01 aa 90 00"), self.card.transceive(_b("00 b2 00 08 00")))
+        self.assertEqual(_b("61 02 bb cc 90 00"), self.card.transceive(_b("00 b2 00 0a 00")))
+        self.assertEqual(_b("6a 83"), self.card.transceive(_b("00 b2 00 0a 00")))
+        self.assertEqual(_b("69 81"), self.card.transceive(_b("00 b0 00 00 00")))
+
+    def testProtected(self):
+        self.card.transceive(_b("00 a4 04 0c 07 a0 00 00 02 47 10 01"))
+        self.card.transceive(_b("00 a4 02 0c 02 01 01"))
+        self.assertEqual(_b("69 82"), self.card.transceive(_b("00 b0 00 00 00")))
+
+    def testStatusWordsAndResponses(self):
+        self.spec["status_words"] = {"file_not_found": "6A 80"}
+        self.spec["responses"] = [ ["0084*", "69 85"] ]
+        card = card_emulator.Emulated_Card.from_spec(self.spec)
+        self.assertEqual(_b("6a 80"), card.transceive(_b("00 a4 02 0c 02 ff ff")))
+        self.assertEqual(_b("69 85"), card.transceive(_b("00 84 00 00 08")))
+        self.assertEqual(_b("6d 00"), card.transceive(_b("00 ca 00 00 00")))
+
+    def testGetResponse(self):
+        self.spec["protocol"] = 0
+        card = card_emulator.Emulated_Card.from_spec(self.spec)
+        self.assertEqual(_b("61 10"), card.transceive(_b("00 a4 08 04 04 50 00 01 1e")))
+        response = card.transceive(_b("00 c0 00 00 0a"))
+        self.assertEqual(_b("62 0e 80 02 00 07"), response[:6])
+        self.assertEqual(_b("61 06"), response[-2:])
+        self.assertEqual(_b("90 00"), card.transceive(_b("00 c0 00 00 06"))[-2:])
+        self.assertEqual(_b("69 85"), card.transceive(_b("00 c0 00 00 06")))
+
+    def testExtendedLength(self):
+        self.card.transceive(_b("00 a4 02 0c 02 2f 01"))
+        self.assertEqual(_b("67 00"), self.card.transceive(_b("00 b0 00 00 00 00 00")))
+
+        self.spec["extended_length"] = True
+        card = card_emulator.Emulated_Card.from_spec(self.spec)
+        self.assertEqual("\x40", utils.atr_card_capabilities(card.get_ATR())[2])
+        card.transceive(_b("00 a4 02 0c 02 2f 01"))
+        self.assertEqual(300 + 2, len(card.transceive(_b("00 b0 00 00 00 00 00"))))
+
+    def testLatency(self):
+        self.spec["latency"] = {"B0": 0.05}
+        card = card_emulator.Emulated_Card.from_spec(self.spec)
+        self.assertEqual(0, card.get_latency(utils.C_APDU(_b("00 a4 00 0c"))))
+        self.assertEqual(0.05, card.get_latency(utils.C_APDU(_b("00 b0 00 00 00"))))
+        start = time.time()
+        card.transceive(_b("00 b0 00 00 00"))
+        self.assertTrue(time.time() - start >= 0.04)
+
+    def testGetChallenge(self):
+        response = self.card.transceive(_b("00 84 00 00 08"))
+        self.assertEqual(10, len(response))
+        self.assertEqual(_b("6d 00"), self.card.transceive(_b("00 82 00 00 28") + "\x00" * 40 + "\x28"))
+
+if __name__ == '__main__':
+    unittest.main()
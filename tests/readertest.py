@@ -0,0 +1,284 @@
+"""Unit test for readers.py, with emulated cards"""
+
+import card_emulator, utils
+import unittest, sys, threading, time, StringIO
+
+try:
+    import readers
+except ImportError:
+    readers = None
+
+try:
+    import cards.iso_card, cards.generic_card
+except ImportError:
+    cards = None
+
+SPEC = {
+    "name": "Test card",
+    "mf": {"children": [
+        {"type": "df", "fid": "5000", "name": "A0000002471001", "children": [
+            {"type": "ef", "fid": "011E", "data": "60 05 01 02 03 04 05"},
+        ]},
+    ]},
+}
+
+SELECT_DF = "\x00\xa4\x04\x0c\x07\xa0\x00\x00\x02\x47\x10\x01"
+GET_CHALLENGE = "\x00\x84\x00\x00\x08"
+
+if readers is not None:
+    class Slot_Reader(readers.Emulated_Reader):
+        "An emulated reader that is empty until insert() is called"
+        def __init__(self, card):
+            readers.Emulated_Reader.__init__(self, card)
+            self._name = "Slot: %s" % card.name
+            self.inserted = threading.Event()
+            self.waiting = threading.Event()
+
+        def insert(self):
+            self.inserted.set()
+
+        def _internal_connect(self, deadline = None):
+            while not self.inserted.isSet():
+                self.waiting.set()
+                yield self._CONNECT_NO_CARD
+                self._cancel_event.wait(0.01)
+            for result in readers.Emulated_Reader._internal_connect(self, deadline):
+                yield result
+
+def _new_reader(cls = None, name = "Test card"):
+    spec = dict(SPEC)
+    spec["name"] = name
+    return (cls or readers.Emulated_Reader)(card_emulator.Emulated_Card.from_spec(spec))
+
+def _transceive(reader, command):
+    return reader.transceive(command)
+
+class ReaderTestCase(unittest.TestCase):
+    "Hides the messages of connect() and the pool workers"
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+class ReaderPoolTests(ReaderTestCase):
+
+    def _pool(self, *reader_objects):
+        return readers.ReaderPool(card_factory = lambda reader: reader,
+            readers = [(reader.name, reader) for reader in reader_objects])
+
+    def testJobs(self):
+        pool = self._pool(_new_reader(), _new_reader(name = "Second card"))
+        try:
+            jobs = pool.map(_transceive, [SELECT_DF, GET_CHALLENGE, "\x00\xca\x00\x00\x00"])
+            results = readers.wait_all(jobs, 5)
+            self.assertEqual("\x90\x00", results[0])
+            self.assertEqual(10, len(results[1]))
+            self.assertEqual("\x6d\x00", results[2])
+            self.assertEqual(3, sum([entry["jobs"] for entry in pool.stats()]))
+        finally:
+            self.assertTrue(pool.close())
+
+    def testExceptions(self):
+        attempts = []
+        def flaky(reader):
+            attempts.append(reader)
+            if len(attempts) == 1:
+                raise IOError, "Card removed"
+            return "ok"
+        def broken(reader):
+            raise ValueError, "Broken"
+
+        pool = self._pool(_new_reader())
+        try:
+            job = pool.submit(flaky)
+            self.assertEqual("ok", job.result(5))
+            self.assertEqual(2, job.attempts)
+
+            job = pool.submit(broken)
+            self.assertTrue(isinstance(job.exception(5), ValueError))
+            self.assertRaises(ValueError, job.result)
+            self.assertRaises(ValueError, readers.wait_all, [pool.submit(_transceive, SELECT_DF), job], 5)
+        finally:
+            self.assertTrue(pool.close())
+
+    def testClose(self):
+        ## One worker is idle with a card, the other one waits for a card
+        slot = _new_reader(Slot_Reader)
+        pool = self._pool(_new_reader(), slot)
+        self.assertEqual("\x90\x00", pool.submit(_transceive, SELECT_DF).result(5))
+        self.assertTrue(slot.waiting.wait(5))
+        start = time.time()
+        self.assertTrue(pool.close(5))
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(slot.inserted.isSet())
+        ## The workers wait for cards without printing anything
+        self.assertEqual("", sys.stdout.getvalue())
+
+    def testClosePending(self):
+        slot = _new_reader(Slot_Reader)
+        pool = self._pool(slot)
+        job = pool.submit(_transceive, SELECT_DF)
+        self.assertTrue(slot.waiting.wait(5))
+        self.assertTrue(pool.close())
+        self.assertTrue(isinstance(job.exception(1), RuntimeError))
+        self.assertTrue(isinstance(pool.submit(_transceive, SELECT_DF).exception(1), RuntimeError))
+        
+        ## A job whose card goes away while the pool is closed is not put back into the queue
+        pool = self._pool(_new_reader())
+        started = threading.Event()
+        def card_removed(reader):
+            started.set()
+            pool._closed.wait(5)
+            raise IOError, "Card removed"
+        job = pool.submit(card_removed)
+        self.assertTrue(started.wait(5))
+        self.assertTrue(pool.close())
+        self.assertTrue(isinstance(job.exception(1), IOError))
+        self.assertEqual(1, job.attempts)
+
+    def testConnectErrors(self):
+        reader = _new_reader()
+        connect, failures = reader.connect, []
+        def unplugged(*args, **kwargs):
+            if not failures:
+                failures.append(True)
+                raise IOError, "Reader unplugged"
+            return connect(*args, **kwargs)
+        reader.connect = unplugged
+        
+        pool = self._pool(reader)
+        pool.RETRY_DELAY = 0.01
+        try:
+            self.assertEqual("\x90\x00", pool.submit(_transceive, SELECT_DF).result(5))
+            self.assertEqual(1, pool.stats()[0]["errors"])
+            self.assertEqual(1, pool.stats()[0]["cards"])
+        finally:
+            self.assertTrue(pool.close())
+
+    def testSkipWrapped(self):
+        emulated = _new_reader()
+        self.assertEqual([emulated.name], readers.ACR122_Reader(emulated).get_wrapped_names())
+
+        wrapper = _new_reader(name = "Wrapper")
+        wrapper.get_wrapped_names = lambda: [emulated.name]
+        pool = self._pool(emulated, wrapper)
+        try:
+            self.assertEqual([wrapper.name], [worker.reader_name for worker in pool.workers])
+        finally:
+            self.assertTrue(pool.close())
+
+ReaderPoolTests = unittest.skipIf(readers is None, "pyscard is not installed")(ReaderPoolTests)
+
+class Scripted_Reader(object):
+    "Answers the commands with a list of responses and records them"
+    name = "Scripted"
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.commands = []
+
+    def transceive(self, data):
+        self.commands.append(data[5:7])
+        return self.responses.pop(0)
+
+class ACR122Tests(unittest.TestCase):
+
+    def _reader(self, responses):
+        parent = Scripted_Reader(responses)
+        reader = readers.ACR122_Reader(parent)
+        reader._current_target = object()
+        reader._current_target_number = 1
+        reader._field_reset_needed = False
+        return reader, parent
+
+    def testReactivate(self):
+        reader, parent = self._reader(["\xd5\x01\x00\x90\x00", "\xd5\x45\x00\x90\x00", "\xd5\x55\x00\x90\x00"])
+        self.assertTrue(reader.pn532_acquire_card())
+        self.assertEqual(["\xd4\x00", "\xd4\x44", "\xd4\x54"], parent.commands)
+
+    def testTargetGone(self):
+        ## No InDeselect/InSelect if the presence check fails, the field is cycled instead
+        reader, parent = self._reader(["\xd5\x01\x01\x90\x00", "\xd5\x33\x90\x00", "\xd5\x33\x90\x00",
+            "\xd5\x4b\x00\x90\x00", "\xd5\x4b\x00\x90\x00"])
+        self.assertFalse(reader.pn532_acquire_card())
+        self.assertEqual(["\xd4\x00", "\xd4\x32", "\xd4\x32", "\xd4\x4a", "\xd4\x4a"], parent.commands)
+
+ACR122Tests = unittest.skipIf(readers is None, "pyscard is not installed")(ACR122Tests)
+
+class AsyncTests(ReaderTestCase):
+
+    def testExecutor(self):
+        reader = _new_reader()
+        reader.connect()
+        jobs = [reader.transceive_async(SELECT_DF), reader.transceive_async("\x00\xa4\x02\x0c\x02\x01\x1e"),
+            reader.transceive_async("\x00\xb0\x00\x00\x02")]
+        self.assertEqual(["\x90\x00", "\x90\x00", "\x60\x05\x90\x00"], readers.wait_all(jobs, 5))
+
+        executor = reader.get_executor()
+        self.assertTrue(executor is reader.get_executor())
+        threads = []
+        job = reader.run_async(lambda: threads.append(threading.currentThread()))
+        called = []
+        job.result(5)
+        job.add_done_callback(called.append)
+        self.assertEqual([executor], threads)
+        self.assertEqual([job], called)
+
+        reader.stop_executor()
+        executor.join(5)
+        self.assertFalse(executor.isAlive())
+
+        reader.run_async(reader.disconnect).result(5)
+        job = reader.transceive_async(GET_CHALLENGE)
+        self.assertTrue(isinstance(job.exception(5), readers.smartcard.Exceptions.CardConnectionException))
+        self.assertTrue(reader.get_executor() is not executor)
+        reader.stop_executor()
+
+    def testCancelBeforeConnect(self):
+        reader = _new_reader(Slot_Reader)
+        reader.cancel_connect()
+        self.assertFalse(reader.connect())
+        reader.insert()
+        self.assertTrue(reader.connect(5))
+
+    def testConnectAsync(self):
+        reader = _new_reader(Slot_Reader)
+        results = []
+        done = threading.Event()
+        def callback(reader, have_card):
+            results.append(have_card)
+            done.set()
+
+        thread = reader.connect_async(callback)
+        self.assertTrue(reader.waiting.wait(5))
+        reader.cancel_connect()
+        thread.join(5)
+        self.assertEqual([False], results)
+
+        done.clear()
+        reader.connect_async(callback, 5)
+        reader.insert()
+        self.assertTrue(done.wait(5))
+        self.assertEqual([False, True], results)
+
+    def testSendApduAsync(self):
+        debug, cards.generic_card.DEBUG = cards.generic_card.DEBUG, False
+        try:
+            reader = _new_reader()
+            reader.connect()
+            card = cards.iso_card.ISO_Card(reader)
+            job = card.send_apdu_async(utils.C_APDU(GET_CHALLENGE))
+            self.assertEqual(8, len(job.result(5).data))
+            self.assertEqual(1, card._i)
+            reader.stop_executor()
+        finally:
+            cards.generic_card.DEBUG = debug
+    testSendApduAsync = unittest.skipIf(cards is None, "pycrypto is not installed")(testSendApduAsync)
+
+AsyncTests = unittest.skipIf(readers is None, "pyscard is not installed")(AsyncTests)
+
+if __name__ == '__main__':
+    unittest.main()
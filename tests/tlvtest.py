@@ -0,0 +1,253 @@
+"""Unit test for TLV_utils.py"""
+
+import TLV_utils
+import unittest, StringIO, copy, pickle
+
+class TLVParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "\x00\x6F\x0D\x84\x02\xA0\x01\xA5\x07\x5F\x2E\x04abcd\xFF\x82\x81\x02\x01\x02"
+
+    def testHeader(self):
+        self.assertEqual((0x6F, True, 3, 16), TLV_utils.tlv_header(self.data, 1))
+        self.assertEqual((0x5F2E, False, 12, 16), TLV_utils.tlv_header(self.data, 9))
+        self.assertEqual((0x82, False, 20, 22), TLV_utils.tlv_header(self.data, 17))
+
+    def testTruncatedHeader(self):
+        self.assertRaises(IndexError, TLV_utils.tlv_header, "\x5F", 0)
+        self.assertRaises(IndexError, TLV_utils.tlv_header, "\x04\x82\x01", 0)
+
+    def testRecords(self):
+        self.assertEqual([(0x6F, True, 3, 16), (0x82, False, 20, 22)],
+            list(TLV_utils.tlv_records(self.data)))
+        self.assertEqual([(0x00, None, 0, 1), (0x6F, True, 3, 16), (0xFF, None, 16, 17), (0x82, False, 20, 22)],
+            list(TLV_utils.tlv_records(self.data, include_filler=True)))
+
+    def testUnpack(self):
+        self.assertEqual([
+                (0x6F, 0x0D, [
+                    (0x84, 2, "\xA0\x01"),
+                    (0xA5, 7, [ (0x5F2E, 4, "abcd") ]),
+                ]),
+                (0x82, 2, "\x01\x02"),
+            ], TLV_utils.unpack(self.data))
+
+    def testUnpackWithMarks(self):
+        result = TLV_utils.unpack("\x87\x02ab\x8E\x01c", with_marks = [("mac", 2, 4), ("cc", 6, 7)], include_filler = True)
+        self.assertEqual([(0x87, 2, "ab", ["mac"]), (0x8E, 1, "c", ["cc"])], result)
+
+    def testFindTag(self):
+        structure = TLV_utils.unpack(self.data)
+        self.assertEqual([(0x5F2E, 4, "abcd")], TLV_utils.tlv_find_tag(structure, 0x5F2E))
+        self.assertEqual([(0x5F2E, 4, "abcd")], TLV_utils.tlv_find_tag(self.data, 0x5F2E))
+        self.assertEqual(TLV_utils.tlv_find_tag(structure, 0xA5), TLV_utils.tlv_find_tag(self.data, 0xA5))
+        self.assertEqual(1, len(TLV_utils.tlv_find_tag(self.data, 0x84, 1)))
+
+    def testTruncatedValue(self):
+        self.assertEqual([(0x04, 5, "ab")], TLV_utils.unpack("\x04\x05ab"))
+
+    def testDecode(self):
+        self.assertEqual(
+            "Tag 0x82, Len 0x02, 'Unknown field (context-specific class)': 01 02 (..)",
+            TLV_utils.decode("\x82\x02\x01\x02"))
+
+class LazyTLVTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "\x00\x6F\x0D\x84\x02\xA0\x01\xA5\x07\x5F\x2E\x04abcd\xFF\x82\x81\x02\x01\x02"
+
+    def testEquality(self):
+        lazy = TLV_utils.unpack_lazy(self.data)
+        self.assertEqual(TLV_utils.unpack(self.data), lazy)
+
+    def testOnDemand(self):
+        lazy = TLV_utils.unpack_lazy(self.data)
+        self.assertFalse(lazy.is_expanded())
+        tag, length, value = lazy[0]
+        self.assertEqual((0x6F, 0x0D), (tag, length))
+        self.assertFalse(value.is_expanded())
+        self.assertEqual((0x5F2E, 4, "abcd"), tuple(value[1][2][0]))
+
+    def testFindTag(self):
+        lazy = TLV_utils.unpack_lazy(self.data)
+        self.assertEqual([(0x5F2E, 4, "abcd")], TLV_utils.tlv_find_tag(lazy, 0x5F2E))
+        self.assertEqual(TLV_utils.tlv_find_tag(TLV_utils.unpack(self.data), 0x82), TLV_utils.tlv_find_tag(lazy, 0x82))
+
+    def testPack(self):
+        lazy = TLV_utils.unpack_lazy(self.data, 1)
+        self.assertEqual(TLV_utils.pack(TLV_utils.unpack(self.data)), TLV_utils.pack(lazy))
+    
+    def testCopy(self):
+        expected = TLV_utils.unpack(self.data)
+        for duplicate in (copy.copy, copy.deepcopy, lambda l: pickle.loads(pickle.dumps(l)),
+                lambda l: pickle.loads(pickle.dumps(l, pickle.HIGHEST_PROTOCOL))):
+            lazy = TLV_utils.unpack_lazy(self.data)
+            self.assertEqual(expected, duplicate(lazy))
+            lazy[0][2][1]
+            self.assertEqual(expected, duplicate(lazy))
+            self.assertEqual(expected[0], duplicate(lazy[0]))
+    
+    def testConcatenation(self):
+        expected = TLV_utils.unpack(self.data)
+        lazy = TLV_utils.unpack_lazy(self.data)
+        self.assertEqual([None] + expected, [None] + lazy)
+        self.assertEqual(expected + [None], lazy + [None])
+        self.assertEqual(expected, list(TLV_utils.unpack_lazy(self.data)))
+        self.assertEqual(tuple(expected), tuple(TLV_utils.unpack_lazy(self.data)))
+
+class StreamDecoderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "\x00\x6F\x0D\x84\x02\xA0\x01\xA5\x07\x5F\x2E\x04abcd" + "\x90\x00"
+
+    def testChunks(self):
+        decoder = TLV_utils.tlv_stream_decoder()
+        self.assertEqual([("start", 0x6F, True, 0x0D)], decoder.feed(self.data[:4]))
+        self.assertEqual(0x0F, decoder.total_length)
+        self.assertEqual(12, decoder.remaining)
+        
+        self.assertEqual([("start", 0x84, False, 2), ("value", 0x84, "\xA0\x01"), ("start", 0xA5, True, 7)],
+            decoder.feed(self.data[4:12]))
+        self.assertFalse(decoder.finished)
+        self.assertEqual(4, decoder.remaining)
+        
+        self.assertEqual([("start", 0x5F2E, False, 4), ("value", 0x5F2E, "abcd"), ("end", 0xA5), ("end", 0x6F)],
+            decoder.feed(self.data[12:]))
+        self.assertTrue(decoder.finished)
+        self.assertEqual(0, decoder.remaining)
+        self.assertEqual(self.data[1:16], decoder.value())
+        self.assertEqual([], decoder.feed("more"))
+
+    def testBytewise(self):
+        events = []
+        decoder = TLV_utils.tlv_stream_decoder(callback = events.append)
+        for c in self.data:
+            decoder.feed(c)
+        self.assertTrue(decoder.finished)
+        self.assertEqual(8, len(events))
+    
+    def testLongValue(self):
+        value = "".join([chr(i % 256) for i in range(300)])
+        data = "\x77\x82\x01\x31\x5F\x2E\x82\x01\x2C" + value + "\x90\x00"
+        decoder = TLV_utils.tlv_stream_decoder()
+        events = []
+        for i in range(0, len(data), 7):
+            events.extend(decoder.feed(data[i:i+7]))
+        self.assertEqual(("value", 0x5F2E, value), events[2])
+        self.assertEqual(data, decoder.data)
+        self.assertEqual(data[:-2], decoder.value())
+
+class TLVIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        ## 30 { 02, A0 { 30 { 04 "a" }, 30 { 04 "b", A0 { 04 "c" } } } }
+        self.data = "\x30\x14\x02\x01\x01\xA0\x0F\x30\x03\x04\x01a\x30\x08\x04\x01b\xA0\x03\x04\x01c"
+        self.structure = TLV_utils.unpack(self.data)
+        self.index = TLV_utils.tlv_index(self.structure)
+
+    def testFind(self):
+        for tag in (0x30, 0x02, 0xA0, 0x04, 0x05):
+            self.assertEqual(TLV_utils.tlv_find_tag(self.structure, tag), self.index.find(tag))
+        self.assertEqual(TLV_utils.tlv_find_tag(self.structure, 0x04, 2), self.index.find(0x04, 2))
+
+    def testFindWithin(self):
+        body = self.index.find(0xA0, 1)[0][2]
+        self.assertEqual(TLV_utils.tlv_find_tag(body, 0xA0), self.index.find(0xA0, within=body))
+        self.assertEqual([(0x04, 1, "c")], self.index.find(0x04, within=self.index.find(0xA0, within=body)))
+
+    def testQuery(self):
+        self.assertEqual([(0x04, 1, "b")], self.index.query("30/A0/30[1]/04"))
+        self.assertEqual([(0x04, 1, "a"), (0x04, 1, "b")], self.index.query("30/A0/30/04"))
+        self.assertEqual((0x04, 1, "c"), self.index.get("30/a0/30/a0/04"))
+        self.assertEqual(None, self.index.get("30/A0/31"))
+        self.assertRaises(ValueError, self.index.query, "30/xy")
+
+class TLVPackTests(unittest.TestCase):
+
+    def testRoundTrip(self):
+        data = "\x6F\x0D\x84\x02\xA0\x01\xA5\x07\x5F\x2E\x04abcd\x82\x02\x01\x02"
+        self.assertEqual(data, TLV_utils.pack(TLV_utils.unpack(data)))
+
+    def testRecalculateLength(self):
+        structure = [ (0xFF, None, None), (0x87, 0, "\x01" + "a"*0x7F), (0x8E, 0, [ (0x04, 0, "x"*0x100) ]) ]
+        self.assertEqual("\xFF" + "\x87\x81\x80\x01" + "a"*0x7F + "\x8E\x82\x01\x04\x04\x82\x01\x00" + "x"*0x100,
+            TLV_utils.pack(structure, recalculate_length = True))
+        self.assertEqual("\xFF\x87\x00\x01" + "a"*0x7F + "\x8E\x00\x04\x00" + "x"*0x100,
+            TLV_utils.pack(structure))
+
+class TLVDecodeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "\x30\x18\x04\x14" + "".join([chr(i) for i in range(0x14)]) + "\x30\x00"
+
+    def testStream(self):
+        stream = StringIO.StringIO()
+        TLV_utils.decode_to_stream(self.data, stream)
+        self.assertEqual(TLV_utils.decode(self.data), stream.getvalue())
+
+    def testLimits(self):
+        stream = StringIO.StringIO()
+        TLV_utils.decode_to_stream(self.data, stream, max_bytes = 4)
+        self.assertEqual("Tag 0x30, Len 0x18, 'Sequence':\n"
+            + "\tTag 0x04, Len 0x14, 'Octet string': 00 01 02 03 (....)\n"
+            + "\t\t[16 more bytes not shown]\n"
+            + "\tTag 0x30, Len 0x00, 'Sequence':\n", stream.getvalue())
+        
+        stream = StringIO.StringIO()
+        TLV_utils.decode_to_stream(self.data, stream, max_depth = 0)
+        self.assertEqual("Tag 0x30, Len 0x18, 'Sequence':\n"
+            + "\t[24 bytes not decoded]", stream.getvalue())
+
+class TagTableTests(unittest.TestCase):
+
+    def testResolve(self):
+        table = TLV_utils.compile_tags(TLV_utils.tags)
+        self.assertTrue(table is TLV_utils.tags)
+        self.assertTrue(table.resolve(TLV_utils.context_FCP)[0] is TLV_utils.tags[TLV_utils.context_FCP])
+        self.assertTrue(table.resolve(TLV_utils.context_FMD)[0] is TLV_utils.tags[None])
+        ## Contexts the table refers to are resolved when it is compiled
+        self.assertTrue(table.resolve(TLV_utils.context_FMD) is table.resolve(TLV_utils.context_FMD))
+        
+        ## Plain dictionaries are compiled once, and again after a context has been added
+        tags = {None: {0x04: (TLV_utils.ascii, "Text")}}
+        table = TLV_utils.compile_tags(tags)
+        self.assertTrue(table is TLV_utils.compile_tags(tags))
+        tags["ctx"] = {}
+        self.assertTrue(table is not TLV_utils.compile_tags(tags))
+        self.assertEqual(tags, TLV_utils.compile_tags(tags))
+
+    def testUnknown(self):
+        table = TLV_utils.tlv_tag_table({None: {}})
+        self.assertEqual((TLV_utils.binary, "Unknown field (context-specific class)"), table.unknown(None, 0x82, False))
+        self.assertEqual((TLV_utils.recurse, "Unknown structure (application class)", "ctx"), table.unknown("ctx", 0x7F60, True))
+        self.assertEqual((TLV_utils.recurse, "Unknown structure (private class)", None), table.unknown("ctx", 0xE1, True))
+
+    def testReset(self):
+        table = TLV_utils.tlv_tag_table({None: {0x04: (TLV_utils.ascii, "Text")}})
+        self.assertEqual("Tag 0x04, Len 0x01, 'Text': a", TLV_utils.decode("\x04\x01a", tags=table, context="ctx"))
+        table["ctx"] = {0x04: (TLV_utils.binary, "Binary")}
+        self.assertEqual("Tag 0x04, Len 0x01, 'Binary': 61 (a)", TLV_utils.decode("\x04\x01a", tags=table, context="ctx"))
+        
+        del table["ctx"]
+        table[None] = {}
+        self.assertTrue(table.resolve("ctx")[0] is table[None])
+
+class OIDRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = TLV_utils.oid_registry()
+        self.registry.add( (1, 2, 840, 113549), "rsadsi", "RSA Security Data Inc.")
+        self.registry.add( (1, 2, 840, 113549, 1, 1, 1), "rsaEncryption", "rsaEncryption")
+
+    def testLookup(self):
+        self.assertEqual(2, len(self.registry))
+        self.assertEqual( (7, ("rsaEncryption", "rsaEncryption")), self.registry.lookup( (1, 2, 840, 113549, 1, 1, 1) ) )
+        self.assertEqual( (4, ("rsadsi", "RSA Security Data Inc.")), self.registry.lookup( (1, 2, 840, 113549, 1, 1, 5) ) )
+        self.assertEqual( (0, None), self.registry.lookup( (1, 3, 6) ) )
+
+    def testDecode(self):
+        self.assertEqual(" 1.2.840.113549.1.1.1 (rsaEncryption)", TLV_utils.decode_oid("\x2A\x86\x48\x86\xF7\x0D\x01\x01\x01"))
+        self.assertEqual(" 1.2.840.113549.1.1.99 (pkcs-1 99)", TLV_utils.decode_oid("\x2A\x86\x48\x86\xF7\x0D\x01\x01\x63"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Unit test for apdu_trace.py"""
+
+import apdu_trace
+import unittest, StringIO
+
+class TraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.atr = "\x3b\x85\x80\x01\x80\x73\x00\x00\x40\xb7"
+        self.exchanges = [
+            ("\x00\xa4\x04\x0c\x02\x3f\x00", "\x90\x00"),
+            ("\x00\x84\x00\x00\x08", "\x01\x02\x03\x04\x05\x06\x07\x08\x90\x00"),
+            ("\x00\xb0\x00\x00\x02", "\x60\x05\x90\x00"),
+            ("\x00\xb0\x00\x02\x02", "\x01\x02\x90\x00"),
+            ("\x00\xb0\x00\x00\x02", "\x61\x05\x90\x00"),
+        ]
+        self.stream = StringIO.StringIO()
+        writer = apdu_trace.Trace_Writer(self.stream)
+        writer.write_record(apdu_trace.RECORD_ATR, self.atr)
+        for command, response in self.exchanges:
+            writer.write_record(apdu_trace.RECORD_COMMAND, command)
+            writer.write_record(apdu_trace.RECORD_RESPONSE, response)
+        writer.write_record(apdu_trace.RECORD_COMMAND, "\x00\xb2\x01\x04\x00")
+        writer.write_record(apdu_trace.RECORD_ERROR, "Card was removed")
+        self.data = self.stream.getvalue()
+
+    def _trace(self, data = None):
+        return apdu_trace.Trace(StringIO.StringIO(data or self.data))
+
+    def testRoundTrip(self):
+        trace = self._trace()
+        self.assertEqual([self.atr], trace.atrs)
+        self.assertEqual(self.exchanges + [("\x00\xb2\x01\x04\x00", None)],
+            [exchange[:2] for exchange in trace.exchanges])
+        self.assertEqual({5: "Card was removed"}, trace.errors)
+        self.assertTrue(trace.get_card_time() >= 0)
+        self.assertFalse(trace.has_extended_length())
+
+    def testTruncated(self):
+        self.assertEqual(5, len(self._trace(self.data[:-3]).exchanges))
+        self.assertRaises(ValueError, self._trace, "CFTX" + self.data[4:])
+
+    def testStrictReplay(self):
+        replayer = apdu_trace.Trace_Replayer(self._trace())
+        for command, response in self.exchanges:
+            self.assertEqual(response, replayer.transceive(command))
+        self.assertRaises(IOError, replayer.transceive, "\x00\xb2\x01\x04\x00")
+        self.assertRaises(apdu_trace.ReplayError, replayer.transceive, "\x00\xb0\x00\x00\x02")
+
+        replayer.reset()
+        self.assertEqual("\x60\x05\x90\x00", replayer.transceive("\x00\xb0\x00\x00\x02"))
+        self.assertEqual("\x61\x05\x90\x00", replayer.transceive("\x00\xb0\x00\x00\x02"))
+        self.assertEqual("\x90\x00", replayer.transceive("\x00\xa4\x04\x0c\x02\x3f\x00"))
+
+    def testPolicies(self):
+        replayer = apdu_trace.Trace_Replayer(self._trace(), policies = {0x84: apdu_trace.MATCH_HEADER})
+        self.assertEqual(self.exchanges[1][1], replayer.transceive("\x00\x84\x00\x00\x10"))
+        self.assertRaises(apdu_trace.ReplayError, replayer.transceive, "\x00\xa4\x04\x0c\x02\x3f\x01")
+
+        replayer = apdu_trace.Trace_Replayer(self._trace(), default_policy = apdu_trace.MATCH_INS)
+        self.assertEqual("\x60\x05\x90\x00", replayer.transceive("\x00\xb0\x00\x10\x02"))
+        self.assertEqual("\x01\x02\x90\x00", replayer.transceive("\x00\xb0\x00\x10\x02"))
+
+if __name__ == '__main__':
+    unittest.main()
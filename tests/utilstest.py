@@ -1,7 +1,7 @@
 """Unit test for utils.py"""
 
 import utils
-import unittest
+import unittest, StringIO
 
 class APDUCase1Tests(unittest.TestCase):
     
@@ -45,3 +45,200 @@ class APDUChainTests(unittest.TestCase):
         c = a.append(b)
         
         self.assertEqual("abcdefgh\x90\x00", c.render())
+
+class APDUFrameTests(unittest.TestCase):
+    
+    def testCase4(self):
+        a = utils.C_APDU("\x00\xa4\x04\x0c\x02\x3f\x00\x00")
+        self.assertEqual(4, a.case())
+        self.assertEqual(2, a.Lc)
+        self.assertEqual("\x3f\x00", a.data)
+        self.assertEqual("\x00\xa4\x04\x0c\x02\x3f\x00\x00", a.render())
+    
+    def testDataList(self):
+        a = utils.C_APDU(ins=0xd6, data=[1, 2, 3])
+        self.assertEqual(3, a.Lc)
+        self.assertEqual("\x00\xd6\x00\x00\x03\x01\x02\x03", a.render())
+    
+    def testDeleteLe(self):
+        a = utils.C_APDU(ins=0xb0, le=0)
+        self.assertEqual(2, a.case())
+        del a.le
+        self.assertEqual(1, a.case())
+        self.assertEqual("\x00\xb0\x00\x00", a.render())
+    
+    def testResponse(self):
+        r = utils.R_APDU("abc\x6c\x03")
+        self.assertEqual((0x6c, 0x03, "abc"), (r.sw1, r.sw2, r.data))
+        r = utils.R_APDU(data=[0x61, 0x62], sw="\x90\x00")
+        self.assertEqual("ab\x90\x00", r.render())
+
+class APDUTemplateTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.select = utils.C_APDU(ins=0xa4, le=0)
+    
+    def testMake(self):
+        template = utils.apdu_template(self.select)
+        for fields in ( {}, {"p1": 2, "p2": "\x0c", "data": "\x3f\x00"}, {"P1": 4, "data": "", "le": None}, {"le": 0x10, "cla": 0x0c} ):
+            expected = utils.C_APDU(self.select, **fields)
+            self.assertEqual(expected.render(), template.make(**fields).render())
+            self.assertEqual(expected.render(), template.render(**fields))
+        self.assertEqual(2, template.make(data="ab").Lc)
+    
+    def testRecompile(self):
+        template = utils.apdu_template(self.select)
+        self.assertTrue(template is utils.apdu_template(self.select))
+        self.select.p2 = 0x0c
+        template = utils.apdu_template(self.select)
+        self.assertEqual("\x00\xa4\x00\x0c\x00", template.render())
+    
+    def testCacheSize(self):
+        template = utils.apdu_template(self.select)
+        for i in range(2 * utils.APDU_TEMPLATE_CACHE_SIZE):
+            utils.apdu_template(utils.C_APDU(ins=i))
+            self.assertTrue(template is utils.apdu_template(self.select))
+        self.assertEqual(utils.APDU_TEMPLATE_CACHE_SIZE, len(utils._apdu_templates))
+    
+    def testCopy(self):
+        a = utils.C_APDU(self.select, data="\x3f\x00")
+        b = utils.C_APDU(a)
+        self.assertEqual(a.render(), b.render())
+        b.p1 = 1
+        self.assertEqual(0, a.p1)
+
+class ExtendedLengthTests(unittest.TestCase):
+    
+    def testParse(self):
+        for case, binary in [ (2, "\x00\xb0\x00\x00\x00\x10\x00"),
+                (3, "\x00\xd6\x00\x00\x00\x01\x00" + "a"*256),
+                (4, "\x00\x2a\x80\x86\x00\x01\x00" + "a"*256 + "\x00\x00") ]:
+            a = utils.C_APDU(binary)
+            self.assertEqual(case, a.case())
+            self.assertTrue(a.extended)
+            self.assertEqual(binary, a.render())
+    
+    def testRender(self):
+        a = utils.C_APDU(ins=0xb0, le=0x1000)
+        self.assertEqual("\x00\xb0\x00\x00\x00\x10\x00", a.render())
+        a.le = 0xe7
+        self.assertEqual("\x00\xb0\x00\x00\xe7", a.render())
+        a.extended = True
+        self.assertEqual("\x00\xb0\x00\x00\x00\x00\xe7", a.render())
+        self.assertEqual(a.render(), utils.apdu_template(a).render())
+    
+    def testRoundTrip(self):
+        for case, binary, extended in [ (1, "\x00\xa4\x00\x00", "\x00\xa4\x00\x00"),
+                (2, "\x00\xb0\x00\x00\x10", "\x00\xb0\x00\x00\x00\x00\x10"),
+                (3, "\x00\xd6\x00\x00\x01a", "\x00\xd6\x00\x00\x00\x00\x01a"),
+                (4, "\x00\x2a\x80\x86\x01a\x00", "\x00\x2a\x80\x86\x00\x00\x01a\x00\x00") ]:
+            a = utils.C_APDU(utils.C_APDU(binary), extended=True)
+            self.assertEqual(extended, a.render())
+            b = utils.C_APDU(a.render())
+            self.assertEqual(case, b.case())
+            self.assertEqual(a.data, b.data)
+            self.assertEqual(a.le, b.le)
+    
+    def testFancy(self):
+        a = utils.C_APDU.parse_fancy("0cd60000 YY 87[01 %s] 8E()00" % ("aa"*0x100))
+        self.assertEqual("\x0c\xd6\x00\x00\x00\x01\x07\x87\x82\x01\x01\x01", a.render()[:12])
+        self.assertEqual("\x8e\x00\x00\x00", a.render()[-4:])
+        self.assertEqual([("[", 4, 0x105)], a.marks)
+    
+    def testATR(self):
+        atr = "\x3b\x8a\x80\x01\x00\x31\xc1\x73\xc8\x40\x00\x00\x90\x00\x90"
+        self.assertEqual("\x00\x31\xc1\x73\xc8\x40\x00\x00\x90\x00", utils.atr_historical_bytes(atr))
+        self.assertEqual("\xc8\x40\x00", utils.atr_card_capabilities(atr))
+        self.assertEqual("", utils.atr_card_capabilities("\x3b\x02\x14\x50"))
+
+class PN532FrameTests(unittest.TestCase):
+    
+    def testSubclass(self):
+        self.assertEqual(utils.PN532_Response_InListPassiveTarget, type(utils.PN532_Frame("\xd5\x4b\x01")))
+        self.assertEqual(utils.PN532_Response, type(utils.PN532_Frame("\xd5\x4a")))
+        self.assertEqual(utils.PN532_Command, type(utils.PN532_Frame("\xd4\x4b")))
+        self.assertEqual(utils.PN532_Frame, type(utils.PN532_Frame("\x00\x00")))
+        self.assertEqual(utils.PN532_Response_InListPassiveTarget, type(utils.PN532_Response(cmd=0x4b)))
+    
+    def testTwoTargets(self):
+        frame = utils.PN532_Frame("\xd5\x4b\x02" + "\x01\x00\x04\x08\x04\x11\x11\x11\x11"
+            + "\x02\x00\x04\x20\x04\x22\x22\x22\x22\x05\x78\x80\x70\x02")
+        frame.parse_result(0)
+        self.assertEqual([1, 2], sorted(frame.targets.keys()))
+        self.assertEqual(([0x11] * 4, []), (frame.targets[1].nfcid, frame.targets[1].ats))
+        self.assertEqual(([0x22] * 4, [0x05, 0x78, 0x80, 0x70, 0x02]), (frame.targets[2].nfcid, frame.targets[2].ats))
+
+class ParseBinaryTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.bytemasks = [
+            (0x80, 0x80, "Low", "High"),
+            (0x0F, 0x01, None, "One"),
+        ]
+    
+    def testParse(self):
+        self.assertEqual(["High", "One"], utils.parse_binary(0x81, self.bytemasks))
+        self.assertEqual(["1... ....: High", ".... 0001: One"], utils.parse_binary(0x81, self.bytemasks, True))
+        self.assertEqual(["Low"], utils.parse_binary(0x02, self.bytemasks))
+    
+    def testCompiled(self):
+        compiled = utils.compile_bytemasks(self.bytemasks)
+        self.assertTrue(compiled is utils.compile_bytemasks(compiled))
+        self.assertEqual(256, len(compiled.table()))
+        self.assertEqual(("Low", "One"), compiled.table()[0x11])
+        self.assertTrue(compiled.table(True) is compiled.table(True))
+        for value in (0x02, 0x81):
+            for verbose in (False, True):
+                self.assertEqual(utils.parse_binary(value, self.bytemasks, verbose),
+                    list(utils.parse_binary(value, compiled, verbose)))
+        self.assertEqual(["Low"], utils.parse_binary(0x102, compiled, value_len = 9))
+        
+        self.bytemasks.append( (0x02, 0x02, None, "Two") )
+        self.assertEqual(["Low", "Two"], utils.parse_binary(0x02, self.bytemasks))
+        self.assertEqual(("Low", ), utils.parse_binary(0x02, compiled))
+
+class HexdumpTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = "".join([chr(i) for i in range(0x3e, 0x52)])
+        self.dump = "0000:  3e 3f 40 41 42 43 44 45 46 47 48 49 4a 4b 4c 4d   >?@ABCDEFGHIJKLM\n" \
+            + "  0010:  4e 4f 50 51                                       NOPQ            "
+    
+    def testHexdump(self):
+        self.assertEqual(self.dump, utils.hexdump(self.data, indent=2))
+        self.assertEqual("00 41 (.A)", utils.hexdump("\x00\x41", short=True))
+        self.assertEqual(" ()", utils.hexdump("", short=True))
+        self.assertEqual("", utils.hexdump(""))
+        self.assertEqual("41 42 (AB)", utils.hexdump(u"AB", short=True))
+        self.assertEqual(utils.hexdump("AB"), utils.hexdump(u"AB"))
+    
+    def testStream(self):
+        stream = StringIO.StringIO()
+        utils.hexdump_to_stream(self.data, stream, indent=2)
+        self.assertEqual(self.dump, stream.getvalue())
+        self.assertEqual(["0005:  3e 3f   >?"], list(utils.hexdump_lines(self.data[:2], linelen=2, offset=5)))
+
+class FancyAPDUTests(unittest.TestCase):
+    
+    def testParse(self):
+        a = utils.C_APDU.parse_fancy("0ca40000YY87[0102]97(e7)8E()00")
+        self.assertEqual("\x0c\xa4\x00\x00\x09\x87\x02\x01\x02\x97\x01\xe7\x8e\x00\x00", a.render())
+        self.assertEqual([("[", 2, 4)], a.marks)
+    
+    def testTemplate(self):
+        template = utils.C_APDU.compile_fancy("00000000 YY 87[01{0}] 97({1}) 8E()00")
+        self.assertTrue(template is utils.C_APDU.compile_fancy("00000000 YY 87[01{0}] 97({1}) 8E()00"))
+        a = template.fill("\x01\x02", "\xe7", cla=0x0c, ins=0xa4)
+        self.assertEqual(utils.C_APDU.parse_fancy("0ca40000YY87[010102]97(e7)8E()00").render(), a.render())
+        self.assertEqual([("[", 2, 5)], a.marks)
+        self.assertRaises(ValueError, template.fill, "\x01")
+        
+        ## The filled APDU has the same fields as the parsed binary form
+        for value in ("\x01\x02", "\x01" * 300):
+            a = template.fill(value, "\xe7")
+            b = utils.C_APDU(a.render())
+            self.assertEqual((b.case(), b.extended, b.Lc, b.le, b.data), (a.case(), a.extended, a.Lc, a.le, a.data))
+    
+    def testInvalid(self):
+        self.assertRaises(ValueError, utils.C_APDU.parse_fancy, "00 a4 xx 87[01")
+        self.assertRaises(ValueError, utils.C_APDU.parse_fancy, "hello")
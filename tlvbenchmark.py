@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Benchmark the TLV parser in TLV_utils on a synthetic nested structure.
+Usage: tlvbenchmark.py [size_in_kb [repetitions]]"""
+
+import TLV_utils, time, sys
+
+def _header(tag, length):
+    if tag > 0xff:
+        result = chr(tag >> 8) + chr(tag & 0xff)
+    else:
+        result = chr(tag)
+    if length < 0x80:
+        return result + chr(length)
+    elif length < 0x100:
+        return result + "\x81" + chr(length)
+    elif length < 0x10000:
+        return result + "\x82" + chr(length >> 8) + chr(length & 0xff)
+    else:
+        return result + "\x83" + chr(length >> 16) + chr((length >> 8) & 0xff) + chr(length & 0xff)
+
+def make_structure(size = 64*1024):
+    "Build a nested BER-TLV structure of (approximately) the given size"
+    entries = []
+    total = 0
+    i = 0
+    while total < size:
+        blob = "".join([chr( (i+j) & 0xff ) for j in range(200)])
+        inner = _header(0x02, 1) + chr(i & 0x7f) \
+            + _header(0x5F2E, len(blob)) + blob \
+            + _header(0x30, 6) + _header(0x04, 4) + "abcd"
+        entry = _header(0xA1, len(inner)) + inner
+        entries.append(entry)
+        total = total + len(entry)
+        i = i + 1
+    body = "".join(entries)
+    return _header(0x7F61, len(body)) + body
+
+def run(name, function, repetitions):
+    start = time.time()
+    for i in range(repetitions):
+        function()
+    duration = time.time() - start
+    print "%-24s %8.2f ms" % (name, duration * 1000.0 / repetitions)
+
+if __name__ == "__main__":
+    size = 64
+    repetitions = 10
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        repetitions = int(sys.argv[2])
+
+    data = make_structure(size * 1024)
+    print "Structure size: %i bytes, %i repetitions" % (len(data), repetitions)
+
+    run("unpack", lambda: TLV_utils.unpack(data), repetitions)
+    run("decode", lambda: TLV_utils.decode(data), repetitions)
+    run("tlv_find_tag (binary)", lambda: TLV_utils.tlv_find_tag(data, 0x04), repetitions)
+    structure = TLV_utils.unpack(data)
+    run("tlv_find_tag (unpacked)", lambda: TLV_utils.tlv_find_tag(structure, 0x04), repetitions)
+    run("tlv_records (top level)", lambda: list(TLV_utils.tlv_records(data, 4)), repetitions)
@@ -6,4 +6,5 @@ import binascii, sys
 
 if __name__ == "__main__":
     a = binascii.unhexlify("".join( sys.stdin.read().split() ))
-    print decode(a)
+    decode_to_stream(a, sys.stdout)
+    print
@@ -1,4 +1,4 @@
-import string, binascii, sys, re, inspect
+import string, binascii, sys, re, collections, threading
 
 def represent_binary_fancy(len, value, mask = 0):
     result = []
@@ -17,9 +17,7 @@ def represent_binary_fancy(len, value, mask = 0):
     
     return "".join(result).strip()
 
-def parse_binary(value, bytemasks, verbose = False, value_len = 8):
-    ## Parses a binary structure and gives information back
-    ##  bytemasks is a sequence of (mask, value, string_if_no_match, string_if_match) tuples
+def _parse_binary(value, bytemasks, verbose, value_len):
     result = []
     for mask, byte, nonmatch, match in bytemasks:
         
@@ -36,7 +34,76 @@ def parse_binary(value, bytemasks, verbose = False, value_len = 8):
     
     return result
 
+class Compiled_Bytemasks(tuple):
+    """An immutable bytemasks sequence (see parse_binary()) together with the tables of
+    the results of parse_binary() for all values of value_len bits. The non-verbose
+    table is built right away, the verbose one on first use."""
+    def __new__(cls, bytemasks, value_len = 8):
+        self = tuple.__new__(cls, bytemasks)
+        self.value_len = value_len
+        self._tables = [self._compile(False), None]
+        return self
+    
+    def _compile(self, verbose):
+        return tuple([tuple(_parse_binary(value, self, verbose, self.value_len))
+            for value in range(1 << self.value_len)])
+    
+    def table(self, verbose = False):
+        "Return the table, a tuple with the tuple of strings for each value"
+        verbose = verbose and 1 or 0
+        if self._tables[verbose] is None:
+            self._tables[verbose] = self._compile(verbose)
+        return self._tables[verbose]
+
+def compile_bytemasks(bytemasks, value_len = 8):
+    """Return bytemasks as Compiled_Bytemasks, for module or class constants that are
+    given to parse_binary() over and over."""
+    if isinstance(bytemasks, Compiled_Bytemasks) and bytemasks.value_len == value_len:
+        return bytemasks
+    return Compiled_Bytemasks(bytemasks, value_len)
+
+def parse_binary(value, bytemasks, verbose = False, value_len = 8):
+    ## Parses a binary structure and gives information back
+    ##  bytemasks is a sequence of (mask, value, string_if_no_match, string_if_match) tuples
+    ##  For Compiled_Bytemasks the result is a tuple from the table, otherwise a new list
+    if isinstance(bytemasks, Compiled_Bytemasks) and bytemasks.value_len == value_len \
+            and 0 <= value < (1 << value_len):
+        return bytemasks.table(verbose)[value]
+    else:
+        return _parse_binary(value, bytemasks, verbose, value_len)
+
 _myprintable = " " + string.letters + string.digits + string.punctuation
+## Translation table that replaces all non-printable characters with "."
+_printable_table = "".join([(chr(i) in _myprintable) and chr(i) or "." for i in range(256)])
+## Hex representation, followed by a space, of each byte value
+_hex_table = ["%02x " % i for i in range(256)]
+
+def _hexdump_parts(data):
+    """Return (hexable, printable) for data (a str): the hex representation with a space after
+    each byte and the printable representation, each for the whole buffer at once."""
+    return "".join([_hex_table[b] for b in bytearray(data)]), data.translate(_printable_table)
+
+def hexdump_lines(data, linelen = 16, offset = 0):
+    """Generate the lines (without indentation or newline) of the hexdump of data,
+    see hexdump()."""
+    data = _to_binary(data)
+    hexable, printable = _hexdump_parts(data)
+    formatstring = "%04x:  %-"+ str(linelen*3) +"s  %-"+ str(linelen) +"s"
+    
+    for pos in xrange(0, len(data), linelen):
+        yield formatstring % (pos+offset, hexable[pos*3:(pos+linelen)*3-1], printable[pos:pos+linelen])
+
+def hexdump_to_stream(data, stream, indent = 0, linelen = 16, offset = 0):
+    """Write the hexdump of data to stream, without building it in memory first.
+    The parameters are the same as for hexdump(), but there is no short form."""
+    separator = "\n" + " " * indent
+    first = True
+    for line in hexdump_lines(data, linelen, offset):
+        if not first:
+            stream.write(separator)
+        first = False
+        stream.write(line)
+
 def hexdump(data, indent = 0, short = False, linelen = 16, offset = 0):
     r"""Generates a nice hexdump of data and returns it. Consecutive lines will 
     be indented with indent spaces. When short is true, will instead generate 
@@ -47,26 +114,11 @@ def hexdump(data, indent = 0, short = False, linelen = 16, offset = 0):
     '0000:  00 41                                             .A              '
     hexdump('\x00\x41', short=True) -> '00 41 (.A)'"""
     
-    def hexable(data):
-        return " ".join([binascii.b2a_hex(a) for a in data])
-    
-    def printable(data):
-        return "".join([e in _myprintable and e or "." for e in data])
-    
     if short:
-        return "%s (%s)" % (hexable(data), printable(data))
+        hexable, printable = _hexdump_parts(_to_binary(data))
+        return "%s (%s)" % (hexable[:-1], printable)
     
-    FORMATSTRING = "%04x:  %-"+ str(linelen*3) +"s  %-"+ str(linelen) +"s"
-    result = ""
-    (head, tail) = (data[:linelen], data[linelen:])
-    pos = 0
-    while len(head) > 0:
-        if pos > 0:
-            result = result + "\n%s" % (' ' * indent)
-        result = result + FORMATSTRING % (pos+offset, hexable(head), printable(head))
-        pos = pos + len(head)
-        (head, tail) = (tail[:linelen], tail[linelen:])
-    return result
+    return ("\n" + " " * indent).join(hexdump_lines(data, linelen, offset))
 
 LIFE_CYCLES = {0x01: "Load file = loaded",
     0x03: "Applet instance / security domain = Installed",
@@ -118,6 +170,51 @@ def parse_status(data):
         parse_segment(segment)
         pos = pos + lgth
 
+def atr_historical_bytes(atr):
+    "Return the historical bytes of an ATR (binary string)"
+    if len(atr) < 2:
+        return ""
+    
+    t0 = ord(atr[1])
+    pos = 2
+    indicator = t0
+    while True:
+        ## TA, TB and TC are skipped, TD announces the next set of interface bytes
+        pos = pos + len([bit for bit in (0x10, 0x20, 0x40) if indicator & bit])
+        if not indicator & 0x80 or pos >= len(atr):
+            break
+        indicator = ord(atr[pos])
+        pos = pos + 1
+    
+    return atr[pos:pos + (t0 & 0x0f)]
+
+def parse_compact_tlv(data):
+    "Split compact-TLV data (tag and length in one byte) into a list of (tag, value)"
+    result = []
+    pos = 0
+    while pos < len(data):
+        tag, length = ord(data[pos]) >> 4, ord(data[pos]) & 0x0f
+        result.append( (tag, data[pos+1:pos+1+length]) )
+        pos = pos + 1 + length
+    return result
+
+def atr_card_capabilities(atr):
+    """Return the card capabilities (compact-TLV tag 7, usually three bytes: selection methods,
+    data coding byte and third software function table) from the historical bytes of an ATR, or
+    an empty string if the ATR doesn't contain them."""
+    historical_bytes = atr_historical_bytes(atr)
+    if historical_bytes[:1] == "\x80":
+        objects = historical_bytes[1:]
+    elif historical_bytes[:1] == "\x00":
+        objects = historical_bytes[1:-3] ## The last three bytes are status information
+    else:
+        return ""
+    
+    for tag, value in parse_compact_tlv(objects):
+        if tag == 0x7:
+            return value
+    return ""
+
 def _unformat_hexdump(dump):
     hexdump = " ".join([line[7:54] for line in dump.splitlines()])
     return binascii.a2b_hex("".join([e != " " and e or "" for e in hexdump]))
@@ -129,7 +226,62 @@ def _make_byte_property(prop):
             lambda self: delattr(self, "_"+prop),
             "The %s attribute of the APDU" % prop)
 
+def _make_header_property(prop, index):
+    """Make a byte property() that is stored at index in the _header bytearray of the frame.
+    Deleting it resets it to the class default. This is meta code."""
+    def getter(self):
+        return self._header[index]
+    def setter(self, value):
+        if isinstance(value, str):
+            value = ord(value)
+        elif not isinstance(value, (int, long)):
+            raise ValueError, "'%s' attribute can only be a byte, that is: int or str, not %s" % (prop, type(value))
+        self._header[index] = value
+    def deleter(self):
+        self._header[index] = self._DEFAULT_HEADER[index]
+    return property(getter, setter, deleter, "The %s attribute of the APDU" % prop)
+
+def _encode_apdu_body(lc, data, le, extended):
+    """Return the Lc, data and Le part of a command APDU. le may be None for no Le field.
+    The extended form (a 00 byte, then two bytes each for Lc and Le) is used if extended is
+    set or the values don't fit into one byte."""
+    if not extended and lc <= 0xff and (le is None or le <= 0xff):
+        result = ""
+        if len(data) > 0:
+            result = chr(lc) + data
+        if le is not None:
+            result = result + chr(le)
+        return result
+    
+    if lc > 0xffff or (le is not None and le > 0xffff):
+        raise ValueError, "Lc and Le are limited to two bytes, even in extended length APDUs"
+    if len(data) == 0 and le is None:
+        return "" ## Case 1 has no body, so there is nothing to mark as extended
+    
+    result = "\x00"
+    if len(data) > 0:
+        result = result + chr(lc >> 8) + chr(lc & 0xff) + data
+    if le is not None:
+        result = result + chr(le >> 8) + chr(le & 0xff)
+    return result
+
+def _to_binary(value):
+    "Convert a str, a unicode string, a sequence of ints or of one-byte strings into a str."
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return str(value)
+    try:
+        return str(bytearray(value))
+    except TypeError:
+        return "".join([isinstance(e, str) and e or chr(e) for e in value])
+
 class Transmission_Frame(object):
+    __slots__ = ()
+    
+    ## Subclasses that store their header in a bytearray set this to the default header
+    _DEFAULT_HEADER = None
+    
     def __init__(self, *args, **kwargs):
         """Creates a new frame instance. Can be given positional parameters which 
         must be sequences of either strings (or strings themselves) or integers
@@ -142,10 +294,15 @@ class Transmission_Frame(object):
         Keywords recognized are class-specific, but always include data
         """
         
+        if self._DEFAULT_HEADER is not None:
+            self._header = bytearray(self._DEFAULT_HEADER)
+        
         initbuff = list()
         
         if len(args) == 1 and isinstance(args[0], self.__class__):
-            self.parse( args[0].render() )
+            self._copy_from( args[0] )
+        elif len(args) == 1 and isinstance(args[0], str):
+            self.parse( args[0] )
         else:
             for arg in args:
                 if type(arg) == str:
@@ -172,20 +329,23 @@ class Transmission_Frame(object):
             if value is not None:
                 setattr(self, name, value)
     
+    def _copy_from(self, other):
+        "Make this frame a copy of other (an instance of the same class). Subclasses may do this more efficiently."
+        self.parse( other.render() )
+    
     def _getdata(self):
         return getattr(self, "_data", "")
     def _setdata(self, value): 
         if isinstance(value, str):
-            self._data = "".join([e for e in value])
-        elif isinstance(value, list):
-            self._data = "".join([chr(int(e)) for e in value])
+            self._data = value
+        elif isinstance(value, (list, bytearray)):
+            self._data = _to_binary(value)
         else:
             raise ValueError, "'data' attribute can only be a str or a list of int, not %s" % type(value)
-        self.Lc = len(value)
     def _deldata(self):
         del self._data; self.data = ""
     
-    data = property(_getdata, _setdata, None,
+    data = property(lambda self: self._getdata(), lambda self, value: self._setdata(value), None,
         "The data contents of this frame")
     
     def _setbyte(self, name, value):
@@ -195,7 +355,7 @@ class Transmission_Frame(object):
         elif isinstance(value, str):
             setattr(self, "_"+name, ord(value))
         else:
-            raise ValueError, "'%s' attribute can only be a byte, that is: int or str, not %s" % (namelower, type(value))
+            raise ValueError, "'%s' attribute can only be a byte, that is: int or str, not %s" % (name, type(value))
 
     def _format_parts(self, fields):
         "utility function to be used in __str__ and __repr__"
@@ -235,54 +395,99 @@ class Transmission_Frame(object):
         return cls(binascii.unhexlify(argstring))
 
 class Command_Frame(Transmission_Frame):
-    pass
+    __slots__ = ()
 
 class Response_Frame(Transmission_Frame):
-    pass
+    __slots__ = ()
 
 Transmission_Frame.COMMAND_CLASS = Command_Frame
 Transmission_Frame.RESPONSE_CLASS = Response_Frame
 
 class APDU(Transmission_Frame):
     "Base class for an APDU"
+    __slots__ = ()
 
 class C_APDU(Command_Frame,APDU):
     """Class for a command APDU
     
     Recognized keywords for __init__ are:
-        cla, ins, p1, p2, lc, le, data
+        cla, ins, p1, p2, lc, le, data, marks, extended
+    
+    Lc and Le are stored as integers. In the short form Le=0 means 256, in
+    the extended form (used automatically if Lc or Le are larger than 255, or
+    if extended is set) Le=0 means 65536.
     """
+    __slots__ = ("_header", "_Lc", "_Le", "_data", "marks", "_extended")
+    _DEFAULT_HEADER = "\x00\x00\x00\x00"
     
     def parse(self, apdu):
         "Parse a full command APDU and assign the values to our object, overwriting whatever there was."
         
-        apdu = map( lambda a: (isinstance(a, str) and (ord(a),) or (a,))[0], apdu)
-        apdu = apdu + [0] * max(4-len(apdu), 0)
+        apdu = _to_binary(apdu)
+        if len(apdu) < 4:
+            apdu = apdu + "\x00" * (4-len(apdu))
         
-        self.CLA, self.INS, self.P1, self.P2 = apdu[:4] # case 1, 2, 3, 4
+        self._header[:] = apdu[:4]                      # case 1, 2, 3, 4
+        self._extended = False
         if len(apdu) == 5:                              # case 2
-            self.Le = apdu[-1]
+            self._Le = ord(apdu[4])
             self.data = ""
+        elif len(apdu) > 6 and apdu[4] == "\x00":       # case 2E, 3E, 4E
+            self._extended = True
+            if len(apdu) == 7:                          # case 2E
+                self._Le = (ord(apdu[5]) << 8) | ord(apdu[6])
+                self.data = ""
+                return
+            
+            lc = (ord(apdu[5]) << 8) | ord(apdu[6])
+            if len(apdu) == 7 + lc:                     # case 3E
+                self.data = apdu[7:]
+            elif len(apdu) == 7 + lc + 2:               # case 4E
+                self.data = apdu[7:-2]
+                self._Le = (ord(apdu[-2]) << 8) | ord(apdu[-1])
+            else:
+                raise ValueError, "Invalid extended Lc value. Is %s, should be %s or %s" % (lc,
+                    7 + lc, 7 + lc + 2)
         elif len(apdu) > 5:                             # case 3, 4
-            self.Lc = apdu[4]
-            if len(apdu) == 5 + self.Lc:                # case 3
+            self._Lc = lc = ord(apdu[4])
+            if len(apdu) == 5 + lc:                     # case 3
                 self.data = apdu[5:]
-            elif len(apdu) == 5 + self.Lc + 1:          # case 4
+            elif len(apdu) == 5 + lc + 1:               # case 4
                 self.data = apdu[5:-1]
-                self.Le = apdu[-1]
+                self._Le = ord(apdu[-1])
             else:
-                raise ValueError, "Invalid Lc value. Is %s, should be %s or %s" % (self.Lc,
-                    5 + self.Lc, 5 + self.Lc + 1)
+                raise ValueError, "Invalid Lc value. Is %s, should be %s or %s" % (lc,
+                    5 + lc, 5 + lc + 1)
         else:                                           # case 1
             self.data = ""
     
-    CLA = _make_byte_property("CLA"); cla = CLA
-    INS = _make_byte_property("INS"); ins = INS
-    P1 = _make_byte_property("P1");   p1 = P1
-    P2 = _make_byte_property("P2");   p2 = P2
+    CLA = _make_header_property("CLA", 0); cla = CLA
+    INS = _make_header_property("INS", 1); ins = INS
+    P1 = _make_header_property("P1", 2);   p1 = P1
+    P2 = _make_header_property("P2", 3);   p2 = P2
     Lc = _make_byte_property("Lc");   lc = Lc
     Le = _make_byte_property("Le");   le = Le
     
+    def _getextended(self):
+        return getattr(self, "_extended", False) or self.Lc > 0xff or getattr(self, "_Le", 0) > 0xff
+    def _setextended(self, value):
+        self._extended = bool(value)
+    
+    extended = property(_getextended, _setextended, None,
+        "True if this APDU is (or must be) rendered with extended length Lc and Le fields")
+    
+    def _setdata(self, value):
+        Transmission_Frame._setdata(self, value)
+        self._Lc = len(self._data)
+    
+    def _copy_from(self, other):
+        self._header[:] = other._header
+        self._data = other.data
+        self._Lc = len(self._data)
+        self._extended = getattr(other, "_extended", False)
+        if hasattr(other, "_Le"):
+            self._Le = other._Le
+    
     def _format_fields(self):
         fields = ["CLA", "INS", "P1", "P2"]
         if self.Lc > 0:
@@ -294,19 +499,8 @@ class C_APDU(Command_Frame,APDU):
     
     def render(self):
         "Return this APDU as a binary string"
-        buffer = []
-        
-        for i in self.CLA, self.INS, self.P1, self.P2:
-            buffer.append(chr(i))
-        
-        if len(self.data) > 0:
-            buffer.append(chr(self.Lc))
-            buffer.append(self.data)
-        
-        if hasattr(self, "_Le"):
-            buffer.append(chr(self.Le))
-        
-        return "".join(buffer)
+        return str(self._header) + _encode_apdu_body(self.Lc, self.data,
+            getattr(self, "_Le", None), getattr(self, "_extended", False))
     
     def case(self):
         "Return 1, 2, 3 or 4, depending on which ISO case we represent."
@@ -322,10 +516,163 @@ class C_APDU(Command_Frame,APDU):
                 return 4
     
     _apduregex = re.compile(r'^\s*([0-9a-f]{2}\s*){4,}$', re.I)
-    _fancyapduregex = re.compile(r'^\s*([0-9a-f]{2}\s*){4,}\s*((xx|yy)\s*)?(([0-9a-f]{2}|:|\)|\(|\[|\])\s*)*$', re.I)
+    _fancyapduregex = re.compile(r'^\s*([0-9a-f]{2}\s*){4,}\s*((xx|yy)\s*)?(([0-9a-f]{2}|:|\)|\(|\[|\]|\{\d+\})\s*)*$', re.I)
+    
+    FANCY_CACHE_SIZE = 64
+    _fancy_cache = collections.OrderedDict()
+    _fancy_cache_lock = threading.Lock()
+    
     @staticmethod
-    def parse_fancy(*args):
+    def compile_fancy(*args):
+        """Compile a fancy APDU string into a Fancy_APDU_Template. In addition to the syntax of
+        parse_fancy the string may contain slots {0}, {1}, ... that are filled with binary data
+        by Fancy_APDU_Template.fill(). The most recently used templates are cached."""
         apdu_string = " ".join(args)
+        cache = C_APDU._fancy_cache
+        C_APDU._fancy_cache_lock.acquire()
+        try:
+            template = cache.pop(apdu_string, None)
+        finally:
+            C_APDU._fancy_cache_lock.release()
+        if template is None:
+            template = Fancy_APDU_Template(apdu_string)
+        
+        C_APDU._fancy_cache_lock.acquire()
+        try:
+            cache.pop(apdu_string, None) ## Another thread may have compiled it, too
+            if len(cache) >= C_APDU.FANCY_CACHE_SIZE:
+                cache.popitem(last=False)
+            cache[apdu_string] = template
+        finally:
+            C_APDU._fancy_cache_lock.release()
+        return template
+    
+    @staticmethod
+    def parse_fancy(*args):
+        return C_APDU.compile_fancy(*args).fill()
+
+class R_APDU(Response_Frame,APDU):
+    """Class for a response APDU
+    
+    Recognized keywords for __init__ are:
+        sw, sw1, sw2, data
+    """
+    
+    __slots__ = ("_header", "_data")
+    _DEFAULT_HEADER = "\x00\x00"
+    
+    def _getsw(self):        return str(self._header)
+    def _setsw(self, value):
+        if len(value) != 2:
+            raise ValueError, "SW must be exactly two bytes"
+        self.SW1 = value[0]
+        self.SW2 = value[1]
+    
+    SW = property(_getsw, _setsw, None,
+        "The Status Word of this response APDU")
+    sw = SW
+    
+    SW1 = _make_header_property("SW1", 0); sw1 = SW1
+    SW2 = _make_header_property("SW2", 1); sw2 = SW2
+    
+    def parse(self, apdu):
+        "Parse a full response APDU and assign the values to our object, overwriting whatever there was."
+        if len(apdu) == 0: # To be filled in later
+            return
+        
+        if isinstance(apdu, str) and len(apdu) >= 2:
+            self._header[:] = apdu[-2:]
+            self._data = apdu[:-2]
+        else:
+            self.SW = apdu[-2:]
+            self.data = apdu[:-2]
+    
+    def _format_fields(self):
+        fields = ["SW1", "SW2"]
+        return self._format_parts(fields)
+    
+    def _copy_from(self, other):
+        self._header[:] = other._header
+        self._data = other.data
+    
+    def render(self):
+        "Return this APDU as a binary string"
+        return self.data + self.sw
+    
+    def append(self, other):
+        return R_APDU(self.data + other.data + other.sw)
+
+APDU.COMMAND_CLASS = C_APDU
+APDU.RESPONSE_CLASS = R_APDU
+
+class C_APDU_Template(object):
+    """A precompiled command APDU. make() returns a new C_APDU and render() returns the binary
+    form of one, with only the given fields changed (cla, ins, p1, p2, data and le, in upper or
+    lower case, None means unchanged). Both are much cheaper than C_APDU(template, p1=...)."""
+    __slots__ = ("_header", "_data", "_Le", "_extended")
+    
+    _FIELDS = {"cla": 0, "ins": 1, "p1": 2, "p2": 3, "CLA": 0, "INS": 1, "P1": 2, "P2": 3}
+    
+    def __init__(self, apdu):
+        self._header = str(apdu._header)
+        self._data = apdu.data
+        self._Le = getattr(apdu, "_Le", None)
+        self._extended = getattr(apdu, "_extended", False)
+    
+    def matches(self, apdu):
+        "Return True if this template still describes apdu."
+        return self._header == apdu._header and self._data == apdu.data \
+            and self._Le == getattr(apdu, "_Le", None) \
+            and self._extended == getattr(apdu, "_extended", False)
+    
+    def _patch(self, fields):
+        "Return (header, data, le) with fields applied"
+        header = self._header
+        data = self._data
+        le = self._Le
+        if len(fields) > 0:
+            patched = None
+            for name, value in fields.items():
+                if value is None:
+                    continue
+                index = self._FIELDS.get(name, None)
+                if index is not None:
+                    if patched is None:
+                        patched = bytearray(header)
+                    if isinstance(value, str):
+                        value = ord(value)
+                    patched[index] = value
+                elif name in ("data", "DATA"):
+                    data = _to_binary(value)
+                elif name in ("le", "Le", "LE"):
+                    le = value
+                else:
+                    raise TypeError, "Unknown field %r for C_APDU_Template" % name
+            if patched is not None:
+                header = str(patched)
+        return header, data, le
+    
+    def make(self, **fields):
+        header, data, le = self._patch(fields)
+        apdu = C_APDU.__new__(C_APDU)
+        apdu._header = bytearray(header)
+        apdu._data = data
+        apdu._Lc = len(data)
+        apdu._extended = self._extended
+        if le is not None:
+            apdu._Le = le
+        return apdu
+    
+    def render(self, **fields):
+        header, data, le = self._patch(fields)
+        return header + _encode_apdu_body(len(data), data, le, self._extended)
+
+class Fancy_APDU_Template(object):
+    """A compiled fancy APDU string (see C_APDU.parse_fancy and C_APDU.compile_fancy).
+    The string is only parsed once, fill() then just inserts the slot values and computes
+    the lengths and marks."""
+    
+    def __init__(self, apdu_string):
         if not C_APDU._fancyapduregex.match(apdu_string):
             raise ValueError
         
@@ -345,148 +692,169 @@ class C_APDU(Command_Frame,APDU):
         if apdu_head.strip() != "" and not C_APDU._apduregex.match(apdu_head):
             raise ValueError
         
-        class Node(list):
-            def __init__(self, parent = None, type = None):
-                list.__init__(self)
-                self.parent = parent
-                self.type = type
-            
-            def make_binary(self):
-                "Recursively transform hex strings to binary"
-                for index, child in enumerate(self):
-                    if isinstance(child,str):
-                        child = "".join( ("".join(child.split())).split(":") )
-                        assert len(child) % 2 == 0
-                        self[index] = binascii.a2b_hex(child)
-                    else:
-                        child.make_binary()
-            
-            def calculate_lengths(self):
-                "Recursively calculate lengths and insert length counts"
-                self.length = 0
-                index = 0
-                while index < len(self): ## Can't use enumerate() due to the insert() below
-                    child = self[index]
-                    
-                    if isinstance(child,str):
-                        self.length = self.length + len(child)
-                    else:
-                        child.calculate_lengths()
-                        
-                        formatted_len = binascii.a2b_hex("%02x" % child.length) ## FIXME len > 255?
-                        self.length = self.length + len(formatted_len) + child.length
-                        self.insert(index, formatted_len)
-                        index = index + 1
-                    
-                    index = index + 1
-            
-            def flatten(self, offset = 0, ignore_types=["("]):
-                "Recursively flatten, gather list of marks"
-                string_result = []
-                mark_result = []
-                for child in self:
-                    if isinstance(child,str):
-                        string_result.append(child)
-                        offset = offset + len(child)
-                    else:
-                        start = offset
-                        child_string, child_mark = child.flatten(offset, ignore_types)
-                        string_result.append(child_string)
-                        offset = end = offset + len(child_string)
-                        if not child.type in ignore_types:
-                            mark_result.append( (child.type, start, end) )
-                        mark_result.extend(child_mark)
-                
-                return "".join(string_result), mark_result
-        
-        
-        tree = Node()
+        apdu_head = "".join(apdu_head.split())
+        self.head = binascii.a2b_hex(apdu_head)
+        self.have_le = have_le
+        self.slots = 0
+        self.items = self._compile_tail(apdu_tail)
+    
+    def _compile_tail(self, apdu_tail):
+        """Parse the tail into a list of items. Each item is either a binary string, a slot
+        number or a (type, items) tuple for a parenthesized part."""
+        tree = []
+        stack = []
         current = tree
+        current_type = None
         allowed_parens = {"(": ")", "[":"]"}
+        text = []
         
-        for pos,char in enumerate(apdu_tail):
+        def flush_text():
+            if len(text) > 0:
+                child = "".join( ("".join("".join(text).split())).split(":") )
+                assert len(child) % 2 == 0
+                if len(child) > 0:
+                    current.append(binascii.a2b_hex(child))
+                del text[:]
+        
+        pos = 0
+        while pos < len(apdu_tail):
+            char = apdu_tail[pos]
             if char in (" ", "a", "b", "c", "d", "e", "f",":") or char.isdigit():
-                if len(current) > 0 and isinstance(current[-1],str):
-                    current[-1] = current[-1] + char
-                else:
-                    current.append(str(char))
-                
+                text.append(char)
+            
+            elif char == "{":
+                flush_text()
+                end = apdu_tail.find("}", pos)
+                if end == -1:
+                    raise ValueError
+                slot = int(apdu_tail[pos+1:end])
+                self.slots = max(self.slots, slot+1)
+                current.append(slot)
+                pos = end
+            
             elif char in allowed_parens.values():
-                if current.parent is None:
+                flush_text()
+                if len(stack) == 0:
                     raise ValueError
-                if allowed_parens[current.type] != char:
+                if allowed_parens[current_type] != char:
                     raise ValueError
                 
-                current = current.parent
+                child = (current_type, current)
+                current, current_type = stack.pop()
+                current.append(child)
                 
             elif char in allowed_parens.keys():
-                current.append( Node(current, char) )
-                current = current[-1]
+                flush_text()
+                stack.append( (current, current_type) )
+                current, current_type = [], char
                 
             else:
                 raise ValueError
+            
+            pos = pos + 1
         
-        if current != tree:
+        flush_text()
+        if len(stack) != 0:
             raise ValueError
         
-        tree.make_binary()
-        tree.calculate_lengths()
+        return tree
+    
+    def _render(self, items, values, ignore_types=("(",)):
+        "Recursively render items, insert length counts and gather the list of marks"
+        pieces = []
+        marks = []
+        length = 0
+        for item in items:
+            if isinstance(item, str):
+                pieces.append(item)
+                length = length + len(item)
+            elif isinstance(item, int):
+                value = values[item]
+                pieces.append(value)
+                length = length + len(value)
+            else:
+                type, children = item
+                child_string, child_marks = self._render(children, values, ignore_types)
+                if len(child_string) <= 0xff:
+                    formatted_len = chr(len(child_string))
+                else:
+                    ## Doesn't fit into one byte, use the BER-TLV form with two length bytes
+                    formatted_len = "\x82" + chr(len(child_string) >> 8) + chr(len(child_string) & 0xff)
+                pieces.append(formatted_len)
+                pieces.append(child_string)
+                start = length + len(formatted_len)
+                length = end = start + len(child_string)
+                if not type in ignore_types:
+                    marks.append( (type, start, end) )
+                marks.extend( [(t, s+start, e+start) for (t, s, e) in child_marks] )
         
-        apdu_head = apdu_head.strip()
-        if apdu_head != "":
-            l = tree.length
-            if have_le: 
-                l = l - 1 ## FIXME Le > 255?
-            formatted_len = "%02x" % l  ## FIXME len > 255?
-            apdu_head = binascii.a2b_hex("".join( (apdu_head + formatted_len).split() ))
+        return "".join(pieces), marks
+    
+    def fill(self, *values, **fields):
+        """Return a new C_APDU from this template. The positional arguments are the binary
+        values for the slots {0}, {1}, ... and any keyword arguments are applied to the
+        result (e.g. cla, ins, p1, p2)."""
+        if len(values) < self.slots:
+            raise ValueError, "This template needs %i values, not %i" % (self.slots, len(values))
+        values = [_to_binary(v) for v in values]
         
-        apdu_tail, marks = tree.flatten(offset=0)
+        apdu_tail, marks = self._render(self.items, values)
+        
+        if len(self.head) == 4 and len(apdu_tail) > 0:
+            ## The usual case: header, data and maybe Le, set the fields directly
+            apdu = C_APDU.__new__(C_APDU)
+            apdu._header = bytearray(self.head)
+            if self.have_le:
+                apdu._data = apdu_tail[:-1]
+                apdu._Le = ord(apdu_tail[-1])
+            else:
+                apdu._data = apdu_tail
+            apdu._Lc = len(apdu._data)
+            apdu._extended = apdu._Lc > 0xff
+            apdu.marks = marks
+            for name, value in fields.items():
+                if value is not None:
+                    setattr(apdu, name, value)
+            return apdu
+        
+        apdu_head = self.head
+        if apdu_head != "":
+            l = len(apdu_tail)
+            if self.have_le: 
+                l = l - 1
+            if l <= 0xff:
+                apdu_head = apdu_head + chr(l)
+            else:
+                ## Extended length: three byte Lc and, if present, two byte Le
+                apdu_head = apdu_head + "\x00" + chr(l >> 8) + chr(l & 0xff)
+                if self.have_le:
+                    apdu_tail = apdu_tail[:-1] + "\x00" + apdu_tail[-1]
         
         apdu = C_APDU(apdu_head + apdu_tail, marks = marks)
+        for name, value in fields.items():
+            if value is not None:
+                setattr(apdu, name, value)
         return apdu
 
-class R_APDU(Response_Frame,APDU):
-    """Class for a response APDU
-    
-    Recognized keywords for __init__ are:
-        sw, sw1, sw2, data
-    """
-    
-    def _getsw(self):        return chr(self.SW1) + chr(self.SW2)
-    def _setsw(self, value):
-        if len(value) != 2:
-            raise ValueError, "SW must be exactly two bytes"
-        self.SW1 = value[0]
-        self.SW2 = value[1]
-    
-    SW = property(_getsw, _setsw, None,
-        "The Status Word of this response APDU")
-    sw = SW
-    
-    SW1 = _make_byte_property("SW1"); sw1 = SW1
-    SW2 = _make_byte_property("SW2"); sw2 = SW2
-    
-    def parse(self, apdu):
-        "Parse a full response APDU and assign the values to our object, overwriting whatever there was."
-        if len(apdu) == 0: # To be filled in later
-            return
-        
-        self.SW = apdu[-2:]
-        self.data = apdu[:-2]
-    
-    def _format_fields(self):
-        fields = ["SW1", "SW2"]
-        return self._format_parts(fields)
-    
-    def render(self):
-        "Return this APDU as a binary string"
-        return self.data + self.sw
-    
-    def append(self, other):
-        return R_APDU(self.data + other.data + other.sw)
-
-APDU.COMMAND_CLASS = C_APDU
-APDU.RESPONSE_CLASS = R_APDU
+APDU_TEMPLATE_CACHE_SIZE = 64
+## id(apdu) -> (apdu, template), the most recently used last. Holding apdu keeps its id from being reused.
+_apdu_templates = collections.OrderedDict()
+_apdu_templates_lock = threading.Lock()
+def apdu_template(apdu):
+    """Return a C_APDU_Template for apdu (usually a class constant). The templates for the most
+    recently used APDUs are cached, and recompiled when apdu has been changed in the meantime."""
+    cache = _apdu_templates
+    _apdu_templates_lock.acquire()
+    try:
+        entry = cache.pop(id(apdu), None)
+        if entry is None or entry[0] is not apdu or not entry[1].matches(apdu):
+            entry = (apdu, C_APDU_Template(apdu))
+            if len(cache) >= APDU_TEMPLATE_CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[id(apdu)] = entry
+    finally:
+        _apdu_templates_lock.release()
+    return entry[1]
 
 class Raw_APDU(APDU):
     """Raw APDU that doesn't do any parsing"""
@@ -502,9 +870,48 @@ class Raw_APDU(APDU):
     def _format_fields(self):
         return ""
 
+## Registry of PN532 frame classes: maps the sorted ((field, value), ...) tuple of the
+## MATCH_BY_* class variables of a class to the list of classes with these rules
+_pn532_registry = {}
+## All field names that appear in any MATCH_BY_* rule, in a fixed order
+_pn532_match_fields = []
+## Resolved subclasses: (class, field values) -> most specific matching subclass
+_pn532_dispatch = {}
+
+class _PN532_Frame_Type(type):
+    """Metaclass for PN532_Frame. Registers each class, when it is defined, by the
+    rules given through class variables called MATCH_BY_* where * may be any field."""
+    
+    def __init__(cls, name, bases, namespace):
+        super(_PN532_Frame_Type, cls).__init__(name, bases, namespace)
+        
+        rules = [ (var[len("MATCH_BY_"):], getattr(cls, var)) for var in dir(cls)
+            if var.startswith("MATCH_BY_") ]
+        rules.sort()
+        _pn532_registry.setdefault(tuple(rules), []).append(cls)
+        
+        for fieldname, value in rules:
+            if fieldname not in _pn532_match_fields:
+                _pn532_match_fields.append(fieldname)
+        _pn532_dispatch.clear()
+    
+    def _resolve_subclass(cls, values):
+        """Return the subclass of cls whose rules all match values (a dictionary field -> value),
+        preferring the one with the most rules, or cls itself if there is none."""
+        for rules in sorted(_pn532_registry.keys(), key=len, reverse=True):
+            for fieldname, value in rules:
+                if values[fieldname] != value:
+                    break
+            else:
+                for candidate in _pn532_registry[rules]:
+                    if candidate is not cls and issubclass(candidate, cls):
+                        return candidate
+        return cls
+
 class PN532_Frame(Transmission_Frame):
     """This is not really an ISO 7816 APDU, but close enough to use the same
     class infrastructure."""
+    __metaclass__ = _PN532_Frame_Type
     
     def __init__(self, *args, **kwargs):
         """If applicable: redirect instance creation to a subclass"""
@@ -514,41 +921,15 @@ class PN532_Frame(Transmission_Frame):
     def _autosubclass(self):
         """If a more appropriate subclass is known about, change __class__ to 
         point to that class."""
+        cls = self.__class__
+        key = (cls, tuple([getattr(self, fieldname) for fieldname in _pn532_match_fields]))
+        target = _pn532_dispatch.get(key, None)
+        if target is None:
+            target = cls._resolve_subclass(dict(zip(_pn532_match_fields, key[1])))
+            _pn532_dispatch[key] = target
         
-        # Find all global classes that are a (possibly indirect) subclass of the current class
-        candidates = [ e for e in globals().values() 
-                      if inspect.isclass(e) and issubclass(e, self.__class__)
-                      and not e == self.__class__ ]
-        
-        # For each candidate: Find if it specifies any matching rules
-        # through class variables called MATCH_BY_* where * may be any field
-        # and if so, remove those classes that don't match. Also count the number
-        # of matches, to determine the best match
-        matches = {}
-        for candidate in candidates:
-            m = 0
-            for var in dir(candidate):
-                if var.startswith("MATCH_BY_"):
-                    fieldname = var[len("MATCH_BY_"):]
-                    if getattr(self, fieldname) == getattr(candidate, var):
-                        m = m + 1
-                    else:
-                        m = -1
-                        break
-            if m != -1:
-                matches[candidate] = m
-        
-        if len(matches) > 0:
-            # Remove all candidates that don't have maximal score
-            max_score = max(matches.values())
-            candidates = [ k for k,v in matches.items() if v == max_score ]
-            
-            # If there is still more than one candidate remaining, randomly choose
-            # the first one.
-            if len(candidates) > 0:
-                c = candidates[0]
-                if c != self.__class__:
-                    self.__class__ = c
+        if target is not cls:
+            self.__class__ = target
     
     DIR = _make_byte_property("DIR"); dir = DIR
     CMD = _make_byte_property("CMD"); cmd = CMD
@@ -570,10 +951,10 @@ class PN532_Frame(Transmission_Frame):
     def render(self):
         return chr(self.cmd) + chr(self.dir) + self.data
     
-class PN532_Command(Command_Frame, PN532_Frame):
+class PN532_Command(PN532_Frame, Command_Frame):
     MATCH_BY_dir = _DEFAULT_DIR = 0xd4
 
-class PN532_Response(Response_Frame, PN532_Frame):
+class PN532_Response(PN532_Frame, Response_Frame):
     MATCH_BY_dir = _DEFAULT_DIR = 0xd5
 
 PN532_Frame.COMMAND_CLASS = PN532_Command
@@ -611,7 +992,8 @@ class PN532_Response_InListPassiveTarget(PN532_Response):
                     target.nfcid = []
                 pos = pos + 1 # NFCID length does not count length byte
                 
-                if len(response) > pos and response[pos] > 0:
+                if target.sel_res & 0x20 and len(response) > pos and response[pos] > 0:
+                    ## Only ISO 14443-4 compliant targets (SEL_RES bit 6) have an ATS
                     target.ats = response[pos:(pos+response[pos])]
                     pos = pos + response[pos]
                 else: